@@ -26,10 +26,10 @@ When we break the application down into its key components we get:
 - A calculation to possibly withdraw the trade based on state for that symbol
 """
 
-import struct
 import time
 
 import wallaroo
+import wallaroo.schema
 
 
 FIXTYPE_ORDER = 1
@@ -111,51 +111,52 @@ class MarketDataMessage(object):
         self.offer = offer
         self.mid = (bid + offer) / 2.0
 
-@wallaroo.decoder(header_length=4, length_fmt=">I")
-def order_decoder(bs):
-    """
-    0 -  1b - FixType (U8)
-    1 -  1b - side (U8)
-    2 -  4b - account (U32)
-    6 -  6b - order id (String)
-    12 -  4b - symbol (String)
-    16 -  8b - order qty (F64)
-    24 -  8b - price (F64)
-    32 - 21b - transact_time (String)
-    """
-    order_type = struct.unpack(">B", bs[0:1])[0]
-    if order_type != FIXTYPE_ORDER:
+# Orders and market data make up nearly all of the inter-worker traffic, so
+# give them compact fixed-layout codecs instead of pickling them.
+wallaroo.serialization.register(Order, wallaroo.serialization.StructCodec(
+    ">BI6s4sdd21s",
+    ["side", "account", "order_id", "symbol", "qty", "price", "transact_time"],
+    factory=Order))
+
+wallaroo.serialization.register(MarketDataMessage,
+    wallaroo.serialization.StructCodec(
+        ">4s21sdd", ["symbol", "transact_time", "bid", "offer"],
+        factory=MarketDataMessage))
+
+# Wire layouts of the incoming FIX messages. Each is parsed with a single
+# precompiled struct.
+order_schema = wallaroo.schema.Schema("OrderFix", [
+    ("fix_type", "B"),
+    ("side", "B"),
+    ("account", "I"),
+    ("order_id", "6s"),
+    ("symbol", "4s"),
+    ("qty", "d"),
+    ("price", "d"),
+    ("transact_time", "21s")])
+
+market_data_schema = wallaroo.schema.Schema("MarketDataFix", [
+    ("fix_type", "B"),
+    ("symbol", "4s"),
+    ("transact_time", "21s"),
+    ("bid", "d"),
+    ("offer", "d")])
+
+@order_schema.decoder()
+def order_decoder(msg):
+    if msg.fix_type != FIXTYPE_ORDER:
         raise MarketSpreadError("Wrong Fix message type. Did you connect "
                                 "the senders the wrong way around?")
-    side = struct.unpack(">B", bs[1:2])[0]
-    account = struct.unpack(">I", bs[2:6])[0]
-    order_id = struct.unpack("6s", bs[6:12])[0]
-    symbol = struct.unpack("4s", bs[12:16])[0]
-    qty = struct.unpack(">d", bs[16:24])[0]
-    price = struct.unpack(">d", bs[24:32])[0]
-    transact_time = struct.unpack("21s", bs[32:53])[0]
-
-    return Order(side, account, order_id, symbol, qty, price,
-                 transact_time)
-
-@wallaroo.decoder(header_length=4, length_fmt=">I")
-def market_data_decoder(bs):
-    """
-    0 -  1b - FixType (U8)
-    1 -  4b - symbol (String)
-    5 -  21b - transact_time (String)
-    26 - 8b - bid_px (F64)
-    34 - 8b - offer_px (F64)
-    """
-    order_type = struct.unpack(">B", bs[0:1])[0]
-    if order_type != FIXTYPE_MARKET_DATA:
+    return Order(msg.side, msg.account, msg.order_id, msg.symbol, msg.qty,
+                 msg.price, msg.transact_time)
+
+@market_data_schema.decoder()
+def market_data_decoder(msg):
+    if msg.fix_type != FIXTYPE_MARKET_DATA:
         raise MarketSpreadError("Wrong Fix message type. Did you connect "
                                 "the senders the wrong way around?")
-    symbol = struct.unpack(">4s", bs[1:5])[0]
-    transact_time = struct.unpack(">21s", bs[5:26])[0]
-    bid = struct.unpack(">d", bs[26:34])[0]
-    offer = struct.unpack(">d", bs[34:42])[0]
-    return MarketDataMessage(symbol, transact_time, bid, offer)
+    return MarketDataMessage(msg.symbol, msg.transact_time, msg.bid,
+                             msg.offer)
 
 class OrderResult(object):
     def __init__(self, order, last_bid, last_offer, timestamp):
@@ -164,17 +165,19 @@ class OrderResult(object):
         self.offer = last_offer
         self.timestamp = timestamp
 
-@wallaroo.encoder
+order_result_schema = wallaroo.schema.Schema("OrderResultFix", [
+    ("side", "B"),
+    ("account", "I"),
+    ("order_id", "6s"),
+    ("symbol", "4s"),
+    ("qty", "d"),
+    ("price", "d"),
+    ("bid", "d"),
+    ("offer", "d"),
+    ("timestamp", "Q")])
+
+@order_result_schema.encoder()
 def order_result_encoder(data):
-    p = struct.pack(">BI6s4sddddQ",
-                    data.order.side,
-                    data.order.account,
-                    data.order.order_id,
-                    data.order.symbol,
-                    data.order.qty,
-                    data.order.price,
-                    data.bid,
-                    data.offer,
-                    data.timestamp)
-    out = struct.pack(">I{}s".format(len(p)), len(p), p)
-    return out
+    order = data.order
+    return (order.side, order.account, order.order_id, order.symbol,
+            order.qty, order.price, data.bid, data.offer, data.timestamp)
@@ -25,6 +25,8 @@ import wallaroo
 def application_setup(args):
     in_host, in_port = wallaroo.tcp_parse_input_addrs(args)[0]
     out_host, out_port = wallaroo.tcp_parse_output_addrs(args)[0]
+    # Counts are logged with --log-level debug
+    wallaroo.log.configure(*wallaroo.log_parse_options(args))
 
     lines = wallaroo.source("Split and Count",
                         wallaroo.TCPSourceConfig(in_host, in_port, decoder))
@@ -71,8 +73,10 @@ def extract_word(data):
 def decoder(bs):
     return bs.decode("utf-8")
 
+encoder_log = wallaroo.log.logger("encoder")
+
 @wallaroo.encoder
 def encoder(data):
     output = data.word + " => " + str(data.count) + "\n"
-    print output
+    encoder_log.debug("{}", output.rstrip())
     return output.encode("utf-8")
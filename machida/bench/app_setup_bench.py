@@ -0,0 +1,114 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Benchmark for application setup time with many generated stages, like the
+topologies built by testing/correctness/tests/topology/app_gen.py.
+
+It decorates `--stages` generated functions, cycling through stateless
+computations, key_by and state computations, builds the pipeline and calls
+`build_application`, and reports the time spent in each part.
+
+Run from the machida directory:
+
+    PYTHONPATH=lib python bench/app_setup_bench.py [--stages 1000]
+"""
+
+import argparse
+import time
+
+import wallaroo
+
+
+class State(object):
+    def __init__(self):
+        self.count = 0
+
+
+def make_stateless(identifier):
+    def tag(data, state=None):
+        return data
+    tag.__name__ = identifier
+    return tag
+
+
+def make_state(identifier):
+    def tagstate(data, state):
+        state.count += 1
+        return data
+    tagstate.__name__ = identifier
+    return tagstate
+
+
+def key_extractor(data):
+    return data
+
+
+@wallaroo.decoder(header_length=4, length_fmt=">I")
+def decoder(bs):
+    return bs
+
+
+@wallaroo.encoder
+def encoder(data):
+    return data
+
+
+def setup(stages):
+    start = time.time()
+    steps = []
+    for i in range(stages):
+        kind = i % 3
+        if kind == 0:
+            f = make_stateless("stateless_{}".format(i))
+            steps.append(("to", wallaroo.computation(f.__name__)(f)))
+        elif kind == 1:
+            steps.append(("key_by", wallaroo.key_extractor(key_extractor)))
+        else:
+            f = make_state("state_{}".format(i))
+            steps.append(("to", wallaroo.state_computation(
+                f.__name__, State)(f)))
+    decorated = time.time()
+
+    p = wallaroo.source("Bench", wallaroo.TCPSourceConfig(
+        "127.0.0.1", "7000", decoder))
+    for node, comp in steps:
+        if node == "to":
+            p = p.to(comp)
+        else:
+            p = p.key_by(comp)
+    p = p.to_sink(wallaroo.TCPSinkConfig("127.0.0.1", "7001", encoder))
+    built = time.time()
+
+    wallaroo.build_application("Bench", p)
+    done = time.time()
+    return decorated - start, built - decorated, done - built
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stages", type=int, default=1000)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    results = sorted(setup(args.stages) for _ in range(args.runs))
+    decorate, build, to_tuple = results[len(results) // 2]
+    print("{} stages: decorate {:.1f} ms, pipeline {:.1f} ms, "
+          "build_application {:.1f} ms, total {:.1f} ms".format(
+              args.stages, decorate * 1e3, build * 1e3, to_tuple * 1e3,
+              (decorate + build + to_tuple) * 1e3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Benchmark for framing connector messages.
+
+It frames `--messages` messages of `--size` bytes, with and without a
+partition, the way connector encoders used to (formatting and packing two
+struct formats per message), with `ConnectorCodec.encode` and with
+`ConnectorCodec.encode_many`, and times taking the message back out of
+each frame.
+
+Run from the machida directory:
+
+    PYTHONPATH=lib python bench/connector_codec_bench.py [--messages 100000]
+"""
+
+import argparse
+import struct
+import time
+
+import wallaroo
+
+
+def old_encode(encoded, partition=None, sequence=None):
+    if partition is not None:
+        part = str(partition).encode('utf-8')
+    else:
+        part = b''
+    if sequence is not None:
+        seq = int(sequence)
+    else:
+        seq = -1
+    meta = struct.pack('<H{}sq'.format(len(part)), len(part) + 8, part, seq)
+    return struct.pack(
+        '<I{}s{}s'.format(len(meta), len(encoded)),
+        len(meta) + len(encoded), meta, encoded)
+
+
+def old_message(bs):
+    meta_len = struct.unpack_from('<H', bs)[0]
+    return bs[2 + meta_len:]
+
+
+def timed(f):
+    start = time.time()
+    f()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--size", type=int, default=100)
+    args = parser.parse_args()
+
+    codec = wallaroo.ConnectorCodec()
+    messages = [b"x" * args.size] * args.messages
+    sequences = list(range(args.messages))
+    n = args.messages
+
+    for partition in (None, "partition-1"):
+        old = timed(lambda: [old_encode(m, partition, i)
+                             for i, m in enumerate(messages)])
+        new = timed(lambda: [codec.encode(m, partition, i)
+                             for i, m in enumerate(messages)])
+        many = timed(lambda: codec.encode_many(messages, partition,
+                                               sequences))
+        print("encode, partition {}: old {:.0f} ns, encode {:.0f} ns, "
+              "encode_many {:.0f} ns per message".format(
+                  partition, old / n * 1e9, new / n * 1e9, many / n * 1e9))
+
+    frames = [codec.encode(m, "partition-1", i)[4:]
+              for i, m in enumerate(messages)]
+    old = timed(lambda: [old_message(f) for f in frames])
+    new = timed(lambda: [codec.message(f) for f in frames])
+    print("message: old {:.0f} ns, new {:.0f} ns per message".format(
+        old / n * 1e9, new / n * 1e9))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Benchmark for the cold-start cost of `import wallaroo`, which every worker
+and connector process pays when it starts.
+
+Each run starts a fresh interpreter, times `import wallaroo` (and, with
+`--module`, importing an application module such as `word_count`), and
+counts the modules it loaded. The first run also writes the bytecode
+caches, so it is reported separately.
+
+Run from the machida directory:
+
+    PYTHONPATH=lib:../examples/python/word_count \\
+        python bench/import_bench.py [--runs 20] [--module word_count]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+
+SCRIPT = """
+import sys, time
+before = set(sys.modules)
+start = time.time()
+import wallaroo
+{extra}
+elapsed = time.time() - start
+print("%f %d" % (elapsed, len(set(sys.modules) - before)))
+"""
+
+
+def run_once(module):
+    extra = "import {}".format(module) if module else ""
+    out = subprocess.check_output(
+        [sys.executable, "-c", SCRIPT.format(extra=extra)],
+        env=dict(os.environ, PYTHONDONTWRITEBYTECODE=""))
+    elapsed, modules = out.decode("ascii").split()
+    return float(elapsed), int(modules)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--module", default=None)
+    args = parser.parse_args()
+
+    first, modules = run_once(args.module)
+    times = sorted(run_once(args.module)[0] for _ in range(args.runs))
+    median = times[len(times) // 2]
+    print("python {}.{}: first run {:.1f} ms, median of {} warm runs "
+          "{:.1f} ms (min {:.1f} ms), {} modules loaded".format(
+              sys.version_info[0], sys.version_info[1], first * 1e3,
+              args.runs, median * 1e3, times[0] * 1e3, modules))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Microbenchmark for the per-message cost of looking up decorated methods by
+name versus calling a method that was resolved once.
+
+It drives the market_spread decoder -> key_by -> state computation path the
+way machida does: once with an attribute lookup and bound method per call
+(what the C bridge used to do) and once with the methods resolved up front
+(what it does now).
+
+Run from the machida directory:
+
+    PYTHONPATH=lib:../examples/python/market_spread \\
+        python bench/method_cache_bench.py [messages]
+"""
+
+import struct
+import sys
+import time
+
+import market_spread as ms
+
+
+SYMBOLS = [("SYM%d" % i).encode("ascii")[:4].ljust(4) for i in range(20)]
+
+
+def build_frames(count):
+    frames = []
+    for i in range(count):
+        symbol = SYMBOLS[i % len(SYMBOLS)]
+        if i % 2:
+            frames.append((ms.order_decoder, struct.pack(
+                ">BBI6s4sdd21s", ms.FIXTYPE_ORDER, ms.SIDETYPE_BUY, i,
+                b"ord001", symbol, 100.0, 10.5, b"20180101-00:00:00.000")))
+        else:
+            frames.append((ms.market_data_decoder, struct.pack(
+                ">B4s21sdd", ms.FIXTYPE_MARKET_DATA, symbol,
+                b"20180101-00:00:00.000", 10.0, 10.5)))
+    return frames
+
+
+def run_lookup(frames):
+    states = {}
+    start = time.time()
+    for decoder, bs in frames:
+        msg = getattr(decoder, "decode")(bs)
+        key = getattr(ms.extract_symbol, "extract_key")(msg)
+        state = states.get(key)
+        if state is None:
+            state = states[key] = ms.check_market_data.initial_state()
+        getattr(ms.check_market_data, "compute")(msg, state)
+    return time.time() - start
+
+
+def run_cached(frames):
+    states = {}
+    decode = dict((d, d.decode) for d in
+                  (ms.order_decoder, ms.market_data_decoder))
+    extract_key = ms.extract_symbol.extract_key
+    compute = ms.check_market_data.compute
+    initial_state = ms.check_market_data.initial_state
+    start = time.time()
+    for decoder, bs in frames:
+        msg = decode[decoder](bs)
+        key = extract_key(msg)
+        state = states.get(key)
+        if state is None:
+            state = states[key] = initial_state()
+        compute(msg, state)
+    return time.time() - start
+
+
+def main(args):
+    count = int(args[1]) if len(args) > 1 else 500000
+    frames = build_frames(count)
+    # Take the best of a few runs to reduce noise.
+    lookup = min(run_lookup(frames) for _ in range(3))
+    cached = min(run_cached(frames) for _ in range(3))
+    print("messages:           {}".format(count))
+    print("per-call lookup:    {:.1f} ns/msg".format(lookup * 1e9 / count))
+    print("resolved once:      {:.1f} ns/msg".format(cached * 1e9 / count))
+    print("saving:             {:.1f} ns/msg ({:.1%})".format(
+        (lookup - cached) * 1e9 / count, (lookup - cached) / lookup))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
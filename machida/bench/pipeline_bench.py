@@ -0,0 +1,98 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Benchmark for building deep pipelines with the `Pipeline` builder calls.
+
+It chains `--stages` alternating state computation and key_by stages onto
+one source, merging in another source every `--merge-every` stages, ends
+the pipeline with a sink and calls `build_application`. The computations
+are decorated once up front so only the builder calls and `to_tuple` are
+timed.
+
+Run from the machida directory:
+
+    PYTHONPATH=lib python bench/pipeline_bench.py [--stages 10000]
+"""
+
+import argparse
+import time
+
+import wallaroo
+
+
+class State(object):
+    pass
+
+
+@wallaroo.state_computation(name="Count", state=State)
+def count(data, state):
+    return data
+
+
+@wallaroo.key_extractor
+def key(data):
+    return data
+
+
+@wallaroo.decoder(header_length=4, length_fmt=">I")
+def decoder(bs):
+    return bs
+
+
+@wallaroo.encoder
+def encoder(data):
+    return data
+
+
+def source(name):
+    return wallaroo.source(name, wallaroo.TCPSourceConfig(
+        "127.0.0.1", "7000", decoder))
+
+
+def build(stages, merge_every):
+    start = time.time()
+    p = source("Bench")
+    for i in range(stages):
+        if i % 2:
+            p = p.key_by(key)
+        else:
+            p = p.to(count)
+        if merge_every and i % merge_every == merge_every - 1:
+            p = p.merge(source("Merged {}".format(i)))
+    p = p.to_sink(wallaroo.TCPSinkConfig("127.0.0.1", "7001", encoder))
+    built = time.time()
+    wallaroo.build_application("Bench", p)
+    done = time.time()
+    return built - start, done - built
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stages", type=int, default=10000)
+    parser.add_argument("--merge-every", type=int, default=0)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    results = sorted(build(args.stages, args.merge_every)
+                     for _ in range(args.runs))
+    builder, to_tuple = results[len(results) // 2]
+    print("{} stages: builder calls {:.1f} ms, build_application {:.1f} ms, "
+          "total {:.1f} ms".format(args.stages, builder * 1e3,
+                                   to_tuple * 1e3,
+                                   (builder + to_tuple) * 1e3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Benchmark for reading messages in a sink connector.
+
+A thread standing in for Wallaroo workers sends `--messages` framed
+messages of `--size` bytes over `--connections` local sockets, and they are
+read one at a time with `SinkConnector.read`, and with the reader
+SinkConnector had before it used a bytearray buffer and a selector (bytes
+concatenation and slicing, 4096-byte receives, `select.select`).
+
+Run from the machida directory:
+
+    PYTHONPATH=lib python bench/sink_connector_bench.py [--messages 200000]
+"""
+
+import argparse
+import socket
+import threading
+import time
+from select import select
+
+import wallaroo.experimental
+
+
+@wallaroo.experimental.stream_message_encoder
+def encoder(data):
+    return data
+
+
+@wallaroo.experimental.stream_message_decoder
+def decoder(data):
+    return data
+
+
+class BytesReader(object):
+    # SinkConnector's reader before it used a bytearray buffer.
+    def __init__(self, decoder, conns):
+        self._decoder = decoder
+        self._connections = list(conns)
+        self._buffers = dict((conn, b"") for conn in conns)
+        self._pending = []
+
+    def read(self, timeout=None):
+        while True:
+            for socket in self._pending:
+                ok, message = self._read_one(socket)
+                if ok: return message
+            self._select_any(timeout)
+
+    def _select_any(self, timeout=None):
+        readable, _, _ = select(self._connections, [], [], timeout)
+        for socket in readable:
+            buffered = self._buffers[socket] + socket.recv(4096)
+            self._buffers[socket] = buffered
+            self._pending.append(socket)
+
+    def _read_one(self, socket):
+        buffered = self._buffers[socket]
+        header_len = self._decoder.header_length()
+        if len(buffered) < header_len:
+            return (False, None)
+        expected = self._decoder.payload_length(buffered[:header_len])
+        if len(buffered) < header_len + expected:
+            return (False, None)
+        data = buffered[header_len:header_len+expected]
+        buffered = buffered[header_len + expected:]
+        self._buffers[socket] = buffered
+        if len(buffered) < header_len:
+            self._pending.remove(socket)
+        return (True, self._decoder.decode(data))
+
+
+def send(conns, messages, size):
+    frame = encoder.encode(b"x" * size)
+    chunk = frame * 1000
+    for i in range(messages // 1000):
+        conns[i % len(conns)].sendall(chunk)
+
+
+def run(reader_type, messages, size, recv_size, connections):
+    pairs = [socket.socketpair() for _ in range(connections)]
+    writers = [a for a, _ in pairs]
+    readers = [b for _, b in pairs]
+    if reader_type == "bytes":
+        for b in readers:
+            b.setblocking(0)
+        reader = BytesReader(decoder, readers)
+    else:
+        reader = wallaroo.experimental.SinkConnector.__new__(
+            wallaroo.experimental.SinkConnector)
+        reader._init_reader(decoder, 0, recv_size)
+        for b in readers:
+            reader._setup_connection(b)
+    writer = threading.Thread(target=send, args=(writers, messages, size))
+    start = time.time()
+    writer.start()
+    for _ in range(messages // 1000 * 1000):
+        reader.read()
+    elapsed = time.time() - start
+    writer.join()
+    for a, b in pairs:
+        a.close()
+        b.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--size", type=int, default=100)
+    parser.add_argument("--connections", type=int, default=1)
+    parser.add_argument("--recv-size", type=int,
+                        default=wallaroo.experimental.DEFAULT_RECV_SIZE)
+    args = parser.parse_args()
+
+    for reader_type in ("bytes", "bytearray"):
+        elapsed = run(reader_type, args.messages, args.size, args.recv_size,
+                      args.connections)
+        print("{:>9}: {:.0f} messages/s".format(
+            reader_type, args.messages / elapsed))
+
+
+if __name__ == "__main__":
+    main()
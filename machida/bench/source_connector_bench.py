@@ -0,0 +1,89 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Benchmark for writing messages from a source connector.
+
+It encodes `--messages` messages of `--size` bytes with a connector encoder
+and sends them over a local socket, read by a thread standing in for
+Wallaroo, one `sendall` per message (what `SourceConnector.write` used to
+do), through the send buffer with `write` and through it with
+`write_many`.
+
+Run from the machida directory:
+
+    PYTHONPATH=lib python bench/source_connector_bench.py [--messages 200000]
+"""
+
+import argparse
+import socket
+import threading
+import time
+
+import wallaroo.experimental
+from wallaroo.experimental import _SendBuffer
+
+
+@wallaroo.experimental.stream_message_encoder
+def encoder(data):
+    return data
+
+
+def drain(conn):
+    while conn.recv(65536):
+        pass
+
+
+def run(mode, messages, size):
+    a, b = socket.socketpair()
+    reader = threading.Thread(target=drain, args=(b,))
+    reader.start()
+    message = b"x" * size
+    encode = encoder.encode
+    start = time.time()
+    if mode == "sendall":
+        for _ in range(messages):
+            a.sendall(encode(message))
+    else:
+        sender = _SendBuffer(a)
+        if mode == "write":
+            for _ in range(messages):
+                sender.write(encode(message))
+        else:
+            batch = [message] * 100
+            for _ in range(messages // 100):
+                sender.write(b''.join([encode(m) for m in batch]))
+        sender.close()
+    elapsed = time.time() - start
+    a.shutdown(socket.SHUT_WR)
+    reader.join()
+    a.close()
+    b.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--size", type=int, default=100)
+    args = parser.parse_args()
+
+    for mode in ("sendall", "write", "write_many"):
+        elapsed = run(mode, args.messages, args.size)
+        print("{:>10}: {:.0f} messages/s".format(
+            mode, args.messages / elapsed))
+
+
+if __name__ == "__main__":
+    main()
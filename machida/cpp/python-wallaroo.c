@@ -87,6 +87,68 @@ extern char *get_application_setup_action(PyObject *item)
   return rtn;
 }
 
+/*
+** The per-message entry points below take a callable that was resolved once
+** with get_method() when the Pony wrapper object was created, instead of
+** looking up and binding the method by name on every call.
+*/
+static PyObject *call_1(PyObject *pFunc, PyObject *a)
+{
+  return PyObject_CallFunctionObjArgs(pFunc, a, NULL);
+}
+
+static PyObject *call_2(PyObject *pFunc, PyObject *a, PyObject *b)
+{
+  return PyObject_CallFunctionObjArgs(pFunc, a, b, NULL);
+}
+
+extern PyObject *get_method(PyObject *o, char *method)
+{
+  return PyObject_GetAttrString(o, method);
+}
+
+/*
+** Decoders created with zero_copy=True are handed a memoryview instead of
+** bytes. Python 2 memoryviews can't be released, so a view over the
+** Pony-owned frame would stay readable after Pony frees it if the decoder
+** kept it or a slice of it. The view is made over a copy of the frame
+** instead: decoders behave the same as under machida3, without the saving.
+*/
+static PyObject *frame_object(char *bytes, size_t size, int zero_copy)
+{
+  PyObject *pBytes, *pView;
+
+  pBytes = PyBytes_FromStringAndSize(bytes, size);
+  if (!zero_copy || pBytes == NULL)
+    return pBytes;
+
+  pView = PyMemoryView_FromObject(pBytes);
+  Py_DECREF(pBytes);
+  return pView;
+}
+
+extern int source_decoder_zero_copy(PyObject *source_decoder)
+{
+  PyObject *pFunc, *pValue;
+  int zero_copy = 0;
+
+  pFunc = PyObject_GetAttrString(source_decoder, "zero_copy");
+  if (pFunc == NULL) {
+    PyErr_Clear();
+    return 0;
+  }
+  pValue = PyObject_CallFunctionObjArgs(pFunc, NULL);
+  Py_DECREF(pFunc);
+  if (pValue == NULL) {
+    PyErr_Clear();
+    return 0;
+  }
+  zero_copy = PyObject_IsTrue(pValue) == 1;
+  Py_DECREF(pValue);
+
+  return zero_copy;
+}
+
 extern size_t source_decoder_header_length(PyObject *source_decoder)
 {
   PyObject *pFunc, *pValue;
@@ -104,18 +166,19 @@ extern size_t source_decoder_header_length(PyObject *source_decoder)
   }
 }
 
-extern size_t source_decoder_payload_length(PyObject *source_decoder, char *bytes, size_t size)
+extern size_t source_decoder_payload_length(PyObject *payload_length_fn,
+  char *bytes, size_t size, int zero_copy)
 {
-  PyObject *pFunc, *pValue, *pBytes;
+  PyObject *pValue, *pBytes;
 
-  pFunc = PyObject_GetAttrString(source_decoder, "payload_length");
-  pBytes = PyBytes_FromStringAndSize(bytes, size);
-  pValue = PyObject_CallFunctionObjArgs(pFunc, pBytes, NULL);
+  pBytes = frame_object(bytes, size, zero_copy);
+  if (pBytes == NULL)
+    return 0;
+  pValue = call_1(payload_length_fn, pBytes);
 
-  size_t sz = PyInt_AsSsize_t(pValue);
+  size_t sz = pValue == NULL ? 0 : PyInt_AsSsize_t(pValue);
 
-  Py_XDECREF(pFunc);
-  Py_XDECREF(pBytes);
+  Py_DECREF(pBytes);
   Py_XDECREF(pValue);
 
   /*
@@ -131,15 +194,15 @@ extern size_t source_decoder_payload_length(PyObject *source_decoder, char *byte
   }
 }
 
-extern PyObject *source_decoder_decode(PyObject *source_decoder, char *bytes, size_t size)
+extern PyObject *source_decoder_decode(PyObject *decode_fn, char *bytes,
+  size_t size, int zero_copy)
 {
-  PyObject *pFunc, *pBytes, *pValue;
+  PyObject *pBytes, *pValue;
 
-  pFunc = PyObject_GetAttrString(source_decoder, "decode");
-  pBytes = PyBytes_FromStringAndSize(bytes, size);
-  pValue = PyObject_CallFunctionObjArgs(pFunc, pBytes, NULL);
-
-  Py_DECREF(pFunc);
+  pBytes = frame_object(bytes, size, zero_copy);
+  if (pBytes == NULL)
+    return NULL;
+  pValue = call_1(decode_fn, pBytes);
   Py_DECREF(pBytes);
 
   return pValue;
@@ -185,27 +248,14 @@ extern PyObject *get_name(PyObject *pObject)
   return pValue;
 }
 
-extern PyObject *computation_compute(PyObject *computation, PyObject *data,
-  char* method)
+extern PyObject *computation_compute(PyObject *compute_fn, PyObject *data)
 {
-  PyObject *pFunc, *pValue;
-
-  pFunc = PyObject_GetAttrString(computation, method);
-  pValue = PyObject_CallFunctionObjArgs(pFunc, data, NULL);
-  Py_DECREF(pFunc);
-
-  return pValue;
+  return call_1(compute_fn, data);
 }
 
-extern PyObject *sink_encoder_encode(PyObject *sink_encoder, PyObject *data)
+extern PyObject *sink_encoder_encode(PyObject *encode_fn, PyObject *data)
 {
-  PyObject *pFunc, *pArgs, *pValue;
-
-  pFunc = PyObject_GetAttrString(sink_encoder, "encode");
-  pValue = PyObject_CallFunctionObjArgs(pFunc, data, NULL);
-  Py_DECREF(pFunc);
-
-  return pValue;
+  return call_1(encode_fn, data);
 }
 
 extern void py_incref(PyObject *o)
@@ -218,16 +268,10 @@ extern void py_decref(PyObject *o)
   Py_DECREF(o);
 }
 
-extern PyObject *stateful_computation_compute(PyObject *computation,
-  PyObject *data, PyObject *state, char *method)
+extern PyObject *stateful_computation_compute(PyObject *compute_fn,
+  PyObject *data, PyObject *state)
 {
-  PyObject *pFunc, *pValue;
-
-  pFunc = PyObject_GetAttrString(computation, method);
-  pValue = PyObject_CallFunctionObjArgs(pFunc, data, state, NULL);
-  Py_DECREF(pFunc);
-
-  return pValue;
+  return call_2(compute_fn, data, state);
 }
 
 extern PyObject *initial_state(PyObject *computation)
@@ -252,15 +296,9 @@ extern int key_eq(PyObject *key, PyObject* other)
   return PyObject_RichCompareBool(key, other, Py_EQ);
 }
 
-extern PyObject *extract_key(PyObject *key_extractor, PyObject *data)
+extern PyObject *extract_key(PyObject *extract_key_fn, PyObject *data)
 {
-  PyObject *pFunc, *pValue;
-
-  pFunc = PyObject_GetAttrString(key_extractor, "extract_key");
-  pValue = PyObject_CallFunctionObjArgs(pFunc, data, NULL);
-  Py_DECREF(pFunc);
-
-  return pValue;
+  return call_1(extract_key_fn, data);
 }
 
 extern void set_user_serialization_fns(PyObject *module)
@@ -296,15 +334,125 @@ extern void *user_deserialization(char *bytes)
   return ret;
 }
 
-extern size_t user_serialization_get_size(PyObject *o)
+/*
+** Pony serialises a graph of objects in two passes: it first asks every
+** custom-serialisable object for the space it needs and then asks each of
+** them to write itself. To avoid running the user serialize function (and
+** pickling) twice per object, the size pass opens a serialization session
+** entry that keeps the serialized buffer alive, and the write pass copies it
+** straight out of that buffer and closes the entry.
+**
+** Entries are keyed by object address and hold a reference to the object so
+** that the address can't be reused while the entry is open. Each entry is a
+** list of [object, contiguous memoryview, number of pending writes].
+*/
+static PyObject *g_serialization_session = NULL;
+
+static PyObject *serialize_to_buffer(PyObject *o)
 {
-  PyObject *user_bytes = PyObject_CallFunctionObjArgs(g_user_serialization_fn, o, NULL);
+  PyObject *user_bytes, *view;
+
+  user_bytes = PyObject_CallFunctionObjArgs(g_user_serialization_fn, o, NULL);
 
   // This will be null if there was an exception.
-  if (user_bytes)
+  if (user_bytes == NULL)
+    return NULL;
+
+  // Any object that supports the buffer protocol is accepted. This only
+  // copies if the buffer is not already contiguous.
+  view = PyMemoryView_GetContiguous(user_bytes, PyBUF_READ, 'C');
+  Py_DECREF(user_bytes);
+
+  return view;
+}
+
+static PyObject *serialization_session_open(PyObject *o)
+{
+  PyObject *key, *entry, *view, *pending;
+
+  if (g_serialization_session == NULL)
+  {
+    g_serialization_session = PyDict_New();
+    if (g_serialization_session == NULL)
+      return NULL;
+  }
+
+  key = PyLong_FromVoidPtr(o);
+  if (key == NULL)
+    return NULL;
+
+  entry = PyDict_GetItem(g_serialization_session, key);
+  if (entry != NULL)
+  {
+    // The same object is reachable more than once in this graph.
+    pending = PyLong_FromSsize_t(
+      PyLong_AsSsize_t(PyList_GET_ITEM(entry, 2)) + 1);
+    PyList_SetItem(entry, 2, pending);
+    Py_DECREF(key);
+    return entry;
+  }
+
+  view = serialize_to_buffer(o);
+  if (view == NULL)
+  {
+    Py_DECREF(key);
+    return NULL;
+  }
+
+  entry = PyList_New(3);
+  Py_INCREF(o);
+  PyList_SET_ITEM(entry, 0, o);
+  PyList_SET_ITEM(entry, 1, view);
+  PyList_SET_ITEM(entry, 2, PyLong_FromSsize_t(1));
+
+  PyDict_SetItem(g_serialization_session, key, entry);
+  Py_DECREF(entry);
+  Py_DECREF(key);
+
+  // borrowed, the session owns the entry
+  return entry;
+}
+
+static PyObject *serialization_session_take(PyObject *o)
+{
+  PyObject *key, *entry, *view;
+  Py_ssize_t pending;
+
+  if (g_serialization_session == NULL)
+    return NULL;
+
+  key = PyLong_FromVoidPtr(o);
+  if (key == NULL)
+    return NULL;
+
+  entry = PyDict_GetItem(g_serialization_session, key);
+  if (entry == NULL)
   {
-    size_t size = PyString_Size(user_bytes);
-    Py_DECREF(user_bytes);
+    Py_DECREF(key);
+    return NULL;
+  }
+
+  view = PyList_GET_ITEM(entry, 1);
+  Py_INCREF(view);
+
+  pending = PyLong_AsSsize_t(PyList_GET_ITEM(entry, 2)) - 1;
+  if (pending > 0)
+    PyList_SetItem(entry, 2, PyLong_FromSsize_t(pending));
+  else
+    PyDict_DelItem(g_serialization_session, key);
+
+  Py_DECREF(key);
+
+  return view;
+}
+
+extern size_t user_serialization_get_size(PyObject *o)
+{
+  PyObject *entry = serialization_session_open(o);
+
+  if (entry)
+  {
+    size_t size = PyMemoryView_GET_BUFFER(PyList_GET_ITEM(entry, 1))->len;
 
     // return the size of the buffer plus the 4 bytes needed to record that size.
     return 4 + size;
@@ -315,12 +463,17 @@ extern size_t user_serialization_get_size(PyObject *o)
 
 extern void user_serialization(PyObject *o, char *bytes)
 {
-  PyObject *user_bytes = PyObject_CallFunctionObjArgs(g_user_serialization_fn, o, NULL);
+  PyObject *view = serialization_session_take(o);
+
+  // Fall back to serializing now if the size pass didn't open an entry.
+  if (view == NULL)
+    view = serialize_to_buffer(o);
 
   // This will be null if there was an exception.
-  if (user_bytes)
+  if (view)
   {
-    size_t size = PyString_Size(user_bytes);
+    Py_buffer *buffer = PyMemoryView_GET_BUFFER(view);
+    size_t size = buffer->len;
 
     unsigned char *ubytes = (unsigned char *) bytes;
 
@@ -329,9 +482,9 @@ extern void user_serialization(PyObject *o, char *bytes)
     ubytes[2] = (unsigned char)(size >> 8);
     ubytes[3] = (unsigned char)(size);
 
-    memcpy(bytes + 4, PyString_AsString(user_bytes), size);
+    memcpy(bytes + 4, buffer->buf, size);
 
-    Py_DECREF(user_bytes);
+    Py_DECREF(view);
   }
 }
 
@@ -354,3 +507,44 @@ extern int py_tuple_check(PyObject *t)
 {
   return PyTuple_Check(t);
 }
+
+extern void flush_std_streams(int force)
+{
+  // Streams replaced with a wallaroo.LogWriter buffer their output. With
+  // `force` everything buffered is written out, otherwise only output that
+  // has waited for its stream's max latency. Records buffered by
+  // wallaroo.log are written to the streams first.
+  char *names[] = {"stdout", "stderr"};
+  char *method = force ? "flush" : "flush_due";
+  PyObject *pType, *pValue, *pTraceback, *pLog, *pStream, *pResult;
+  int i;
+
+  PyErr_Fetch(&pType, &pValue, &pTraceback);
+  pLog = PyDict_GetItemString(PyImport_GetModuleDict(), "wallaroo.log");
+  if (pLog != NULL) {
+    pResult = PyObject_CallMethod(pLog, "drain", NULL);
+    if (pResult == NULL)
+      PyErr_Clear();
+    Py_XDECREF(pResult);
+  }
+  for (i = 0; i < 2; i++) {
+    pStream = PySys_GetObject(names[i]);
+    if (pStream == NULL || !PyObject_HasAttrString(pStream, method))
+      continue;
+    pResult = PyObject_CallMethod(pStream, method, NULL);
+    if (pResult == NULL)
+      PyErr_Clear();
+    Py_XDECREF(pResult);
+  }
+  PyErr_Restore(pType, pValue, pTraceback);
+}
+
+static void flush_std_streams_at_exit(void)
+{
+  flush_std_streams(1);
+}
+
+extern int flush_std_streams_on_exit(void)
+{
+  return atexit(flush_std_streams_at_exit);
+}
@@ -13,54 +13,191 @@
 #  permissions and limitations under the License.
 
 
-import argparse
-import pickle
+# Workers and connectors import this module on every start, so only what
+# is needed at import time is imported here. Submodules and modules that
+# are only needed by some functions are imported when first used.
+import atexit
+import os
 import struct
-import inspect
 import sys
+import time
 
-import wallaroo.experimental
+import wallaroo
 
 
-class Unbuffered(object):
-   def __init__(self, stream):
-       self.stream = stream
-   def write(self, data):
-       self.stream.write(data)
-       self.stream.flush()
-   def writelines(self, datas):
-       self.stream.writelines(datas)
-       self.stream.flush()
-   def __getattr__(self, attr):
-       return getattr(self.stream, attr)
+# Submodules that are imported on first access as `wallaroo.<name>`.
+_LAZY_SUBMODULES = ('experimental', 'log', 'schema', 'serialization')
 
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name in _LAZY_SUBMODULES:
+            import importlib
+            return importlib.import_module('wallaroo.' + name)
+        raise AttributeError(
+            "module 'wallaroo' has no attribute '{}'".format(name))
 
-# If python is running with PIPE stdout/stderr, replace them with
-# ones that always flush
-if not sys.stdout.isatty():
-    sys.stdout = Unbuffered(sys.stdout)
-if not sys.stderr.isatty():
-    sys.stderr = Unbuffered(sys.stderr)
 
+# Buffered output is written out once it reaches this many bytes or once
+# the oldest buffered write is this many seconds old, whichever is first.
+DEFAULT_OUTPUT_MAX_SIZE = 64 * 1024
+DEFAULT_OUTPUT_MAX_LATENCY = 0.1
 
+if hasattr(time, 'monotonic'):
+    _monotonic = time.monotonic
+else:
+    _monotonic = time.time
+
+# Threads can't be started while Python shuts down, so output written then
+# is flushed straight away. Python 2 has no way to tell.
+_is_finalizing = getattr(sys, 'is_finalizing', lambda: False)
+
+
+class LogWriter(object):
+    """
+    A replacement for `sys.stdout` and `sys.stderr` that leaves writes in
+    the buffer of `stream` instead of flushing after each one. The stream
+    is flushed once `max_size` bytes have been written since the last
+    flush, or once the oldest unflushed write is `max_latency` seconds old.
+
+    A background thread flushes output that has waited `max_latency`.
+    Machida never releases the GIL while it is idle, so it also calls
+    `flush_due` from a timer. `flush()` is called when Python exits and
+    when machida reports a Python error.
+    """
+    def __init__(self, stream, max_latency=DEFAULT_OUTPUT_MAX_LATENCY,
+                 max_size=DEFAULT_OUTPUT_MAX_SIZE):
+        self.stream = stream
+        self.max_latency = max_latency
+        self.max_size = max_size
+        self._size = 0
+        self._oldest = None
+        self._pending = None
+        self._flusher_pid = None
+
+    def write(self, data):
+        self.stream.write(data)
+        self._size += len(data)
+        if self._oldest is None:
+            self._oldest = _monotonic()
+            if self.max_latency <= 0 or _is_finalizing():
+                self.flush()
+                return
+            if self._flusher_pid != os.getpid():
+                self._start_flusher()
+            self._pending.set()
+        if self._size >= self.max_size:
+            self.flush()
+
+    def writelines(self, datas):
+        for data in datas:
+            self.write(data)
+
+    def flush(self):
+        self._size = 0
+        self._oldest = None
+        self.stream.flush()
+
+    def flush_due(self):
+        """
+        Flush if the oldest unflushed write is at least `max_latency`
+        seconds old.
+        """
+        oldest = self._oldest
+        if oldest is not None and _monotonic() - oldest >= self.max_latency:
+            self.flush()
+
+    def _start_flusher(self):
+        # Threads don't survive a fork, so each process starts its own.
+        import threading
+        self._flusher_pid = os.getpid()
+        self._pending = threading.Event()
+        t = threading.Thread(target=self._run_flusher,
+                             name="wallaroo-output-flusher")
+        t.daemon = True
+        t.start()
+
+    def _run_flusher(self):
+        try:
+            while True:
+                self._pending.wait()
+                self._pending.clear()
+                oldest = self._oldest
+                if oldest is None:
+                    continue
+                delay = oldest + self.max_latency - _monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                try:
+                    self.flush_due()
+                except Exception:
+                    # The stream is gone; there is nowhere left to report it.
+                    pass
+        except Exception:
+            # Python 2 clears module globals at exit while daemon threads
+            # are still running.
+            pass
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+
+def buffer_output(max_latency=DEFAULT_OUTPUT_MAX_LATENCY,
+                  max_size=DEFAULT_OUTPUT_MAX_SIZE):
+    """
+    Buffer `sys.stdout` and `sys.stderr` with a `LogWriter` if they aren't
+    terminals, or change the limits of the ones already installed. This is
+    done with the default limits when wallaroo is imported.
+    """
+    for name in ('stdout', 'stderr'):
+        stream = getattr(sys, name)
+        if isinstance(stream, LogWriter):
+            stream.flush()
+            stream.max_latency = max_latency
+            stream.max_size = max_size
+        elif not stream.isatty():
+            setattr(sys, name, LogWriter(stream, max_latency, max_size))
+
+
+def _flush_output():
+    for stream in (sys.stdout, sys.stderr):
+        if isinstance(stream, LogWriter):
+            stream.flush()
+
+
+# If python is running with PIPE stdout/stderr, replace them with ones
+# that write out in batches instead of on every print.
+buffer_output()
+atexit.register(_flush_output)
+
+
+# The default inter-worker serialization. Types registered with
+# wallaroo.serialization use their codec, everything else is pickled.
 def serialize(o):
-    return pickle.dumps(o)
+    return wallaroo.serialization.serialize(o)
 
 
 def deserialize(bs):
-    return pickle.loads(bs)
+    return wallaroo.serialization.deserialize(bs)
 
 class WallarooParameterError(Exception):
     pass
 
+# The largest number of messages handed to a batch computation in one call
+# unless the decorator is given an explicit `batch_size`.
+DEFAULT_BATCH_SIZE = 64
+
 def source(name, source_config):
     return Pipeline.from_source(name, source_config)
 
-def build_application(app_name, pipeline):
+def build_application(app_name, pipeline, fuse=False):
+    """
+    With `fuse=True`, each run of adjacent stateless computations is run as
+    one step named after them all, joined with " -> ".
+    """
     if not pipeline.__is_closed__():
         print("\nAPI_Error: An application must end with to_sink/s.")
         raise WallarooParameterError()
-    return pipeline.__to_tuple__(app_name)
+    return pipeline.__to_tuple__(app_name, fuse)
 
 class Pipeline(object):
     def __init__(self, pipeline_tree):
@@ -79,8 +216,8 @@ class Pipeline(object):
         # else:
         #     self._actions.append(("source", name, source_config.to_tuple()))
 
-    def __to_tuple__(self, app_name):
-        return self._pipeline_tree.to_tuple(app_name)
+    def __to_tuple__(self, app_name, fuse=False):
+        return self._pipeline_tree.to_tuple(app_name, fuse)
 
     def __is_closed__(self):
         return self._pipeline_tree.is_closed
@@ -90,9 +227,11 @@ class Pipeline(object):
 
     def __to__(self, computation):
         if computation.is_stateful:
-            self._pipeline_tree.add_stage(("to_state", computation))
+            self._pipeline_tree = self._pipeline_tree.add_stage(
+                ("to_state", computation))
         else:
-            self._pipeline_tree.add_stage(("to", computation))
+            self._pipeline_tree = self._pipeline_tree.add_stage(
+                ("to", computation))
         return self
 
     def to_sink(self, sink_config):
@@ -102,9 +241,11 @@ class Pipeline(object):
         if isinstance(sink_config, str):
             (port, encoder) = self._connectors[sink_config]
             connector = wallaroo.experimental.SinkConnectorConfig(host='localhost', port=port, encoder=encoder)
-            self._pipeline_tree.add_stage(("to_sink", connector.to_tuple()))
+            self._pipeline_tree = self._pipeline_tree.add_stage(
+                ("to_sink", connector.to_tuple()))
         else:
-            self._pipeline_tree.add_stage(("to_sink", sink_config.to_tuple()))
+            self._pipeline_tree = self._pipeline_tree.add_stage(
+                ("to_sink", sink_config.to_tuple()))
         return self
 
     def to_sinks(self, sink_configs):
@@ -119,25 +260,38 @@ class Pipeline(object):
                 sinks.append(connector.to_tuple())
             else:
                 sinks.append(sc.to_tuple())
-        self._pipeline_tree.add_stage(("to_sinks", sinks))
+        self._pipeline_tree = self._pipeline_tree.add_stage(
+            ("to_sinks", sinks))
         return self
 
     def key_by(self, key_extractor):
         return self.clone().__key_by__(key_extractor)
 
     def __key_by__(self, key_extractor):
-        self._pipeline_tree.add_stage(("key_by", key_extractor))
+        self._pipeline_tree = self._pipeline_tree.add_stage(
+            ("key_by", key_extractor))
         return self
 
     def merge(self, pipeline):
-        return self.clone().__merge__(pipeline.clone())
+        return self.clone().__merge__(pipeline)
 
     def __merge__(self, pipeline):
-        self._pipeline_tree.merge(pipeline._pipeline_tree)
+        self._pipeline_tree = self._pipeline_tree.merge(
+            pipeline._pipeline_tree)
         return self
 
     def clone(self):
-        return Pipeline(self._pipeline_tree.clone())
+        # Pipeline trees are immutable, so clones can share them.
+        return Pipeline(self._pipeline_tree)
+
+# CO_VARARGS from the inspect module, which is slow to import.
+_CO_VARARGS = 0x04
+
+# (lower, upper) bounds on the number of positional arguments, keyed by
+# code object, number of defaults and number of bound arguments. Generated
+# topologies decorate many closures that share one code object.
+_arity_bounds_cache = {}
+
 
 def _validate_arity_compatability(name, obj, arity):
     """
@@ -148,69 +302,138 @@ def _validate_arity_compatability(name, obj, arity):
     if not callable(obj):
         print("\nAPI_Error: Expected a callable object but got a {0} for {1}".format(obj, name))
         raise WallarooParameterError()
-    spec = inspect.getargspec(obj)
-    upper_bound = len(spec.args)
-    lower_bound = upper_bound - (len(spec.defaults) if spec.defaults else 0)
-    if arity > upper_bound or arity < lower_bound:
+    lower_bound, upper_bound = _arity_bounds(obj)
+    if arity < lower_bound or (upper_bound is not None and
+                               arity > upper_bound):
         if arity == 1:
             param_term = 'parameter'
         else:
             param_term = 'parameters'
         print("\nAPI_Error: Incompatible function arity, your function {0} must have {1} {2}."
-            ).format(name, arity, param_term)
+              .format(name, arity, param_term))
         raise WallarooParameterError()
 
-def attach_to_module(cls, cls_name, func):
-    # Do some scope mangling to create a uniquely named class based on
-    # the decorated function's name and place it in the wallaroo module's
-    # namespace so that pickle can find it.
+def _arity_bounds(obj):
+    bound = 0
+    if isinstance(obj, type):
+        # A class is called through __init__, which is given the instance.
+        obj = obj.__init__
+        bound = 1
+    elif not hasattr(obj, '__code__') and not hasattr(obj, '__func__'):
+        # An object with a __call__ method.
+        obj = getattr(type(obj), '__call__', None)
+        bound = 1
+    if getattr(obj, '__self__', None) is not None:
+        bound += 1
+    func = getattr(obj, '__func__', obj)
+    code = getattr(func, '__code__', None)
+    if code is None:
+        # Built-in and C callables don't describe their arguments. Accept
+        # them and let a bad call fail when it is made.
+        return (0, None)
+    defaults = len(func.__defaults__) if func.__defaults__ else 0
+    key = (code, defaults, bound)
+    bounds = _arity_bounds_cache.get(key)
+    if bounds is None:
+        upper_bound = code.co_argcount - bound
+        lower_bound = max(upper_bound - defaults, 0)
+        if code.co_flags & _CO_VARARGS:
+            upper_bound = None
+        bounds = _arity_bounds_cache[key] = (lower_bound, upper_bound)
+    return bounds
+
+
+# Wrapper classes are generated once per base class, and the decorated
+# function and its options are stored on each instance. Wrappers are
+# registered by a name built from their base class, the function's module
+# and qualified name, and the name given to the decorator, and pickled as a
+# reference to that name, so unpickling them in another worker finds the
+# wrapper created when the application module was imported there. Names
+# that are still taken, such as those of lambdas decorated with the same
+# name, get a count appended; workers import the application in the same
+# order, so they count the same way.
+_wrapper_classes = {}
+_wrappers = {}
+_wrapper_name_counts = {}
 
-    name = cls_name + '__' + func.__name__
 
-    # Python2: use __name__
-    if sys.version_info.major == 2:
-        cls.__name__ = name
-    # Python3: use __qualname__
-    else:
-        cls.__qualname__ = name
+def _wallaroo_wrap(name, func, base_cls, **kwargs):
+    """
+    Returns an instance of the generated wrapper class for `base_cls` that
+    calls `func`. `kwargs` are stored on the instance with a leading
+    underscore, for the class's methods to use.
+    """
+    C = _wrapper_classes.get(base_cls)
+    if C is None:
+        C = _wrapper_classes[base_cls] = _wrapper_class(base_cls)
+    registered_name = _registered_name(name, func, base_cls)
+    wrapped = C.__new__(C)
+    wrapped._func = func
+    wrapped._name = name
+    wrapped._registered_name = registered_name
+    wrapped.__doc__ = func.__doc__
+    for option, value in kwargs.items():
+        setattr(wrapped, '_' + option, value)
+    _wrappers[registered_name] = wrapped
+    # Keep the per-function class names used by earlier versions working
+    # for isinstance checks.
+    globals()['{}__{}'.format(
+        base_cls.__name__, getattr(func, '__name__', name))] = C
+    return wrapped
 
-    globals()[name] = cls
-    return globals()[name]
 
+def _registered_name(name, func, base_cls):
+    func_name = getattr(func, '__qualname__', None)
+    if func_name is None:
+        func_name = getattr(func, '__name__', type(func).__name__)
+    registered_name = '{}__{}.{}__{}'.format(
+        base_cls.__name__, getattr(func, '__module__', None), func_name,
+        name)
+    count = _wrapper_name_counts.get(registered_name, 0) + 1
+    _wrapper_name_counts[registered_name] = count
+    if count > 1:
+        registered_name = '{}__{}'.format(registered_name, count)
+    return registered_name
 
-def _wallaroo_wrap(name, func, base_cls, **kwargs):
+
+def _wrapper_by_name(registered_name):
+    try:
+        return _wrappers[registered_name]
+    except KeyError:
+        raise AttributeError(
+            "No wallaroo wrapper named {!r}; the module that defines it must "
+            "be imported first".format(registered_name))
+
+
+def _wrapper_class(base_cls):
     # Case 1: Computations
     if issubclass(base_cls, Computation):
         # Create the appropriate computation signature
         if base_cls._is_state:
             def comp(self, data, state):
-            # def comp(data, state):
-                return func(data, state)
+                return self._func(data, state)
         else:
             def comp(self, data):
-            # def comp(data):
-                return func(data)
+                return self._func(data)
 
-        # Create a custom class type for the computation
         class C(base_cls):
-            __doc__ = func.__doc__
-            __module__ = __module__
             def name(self):
-                return name
+                return self._name
 
         # Attach the computation to the class
         # TODO: maybe move this to machida, using PyObject_IsInstance
         # instead of PyObject_HasAttrString
-        if base_cls._is_multi:
+        if base_cls._is_batch:
+            C.compute_batch = comp
+        elif base_cls._is_multi:
             C.compute_multi = comp
         else:
             C.compute = comp
 
         if base_cls._is_state:
-            initial_state = kwargs['state']
             def build_initial_state(self):
                 try:
-                    state = initial_state()
+                    state = self._state()
                     return state
                 except Exception as err:
                     print(err)
@@ -226,46 +449,37 @@ def _wallaroo_wrap(name, func, base_cls, **kwargs):
     elif base_cls is KeyExtractor:
         class C(base_cls):
             def extract_key(self, data):
-                res = func(data)
-                if isinstance(res, int):
-                    return chr(res)
-                return res
+                if self._memo is None:
+                    return _key_bytes(self._func(data))
+                return self._memo.routing_key(self._func(data))
 
     # Case 3: Encoder
     elif base_cls is OctetEncoder:
         class C(base_cls):
             def encode(self, data):
-                return func(data)
+                return self._func(data)
 
     elif base_cls is ConnectorEncoder:
         class C(base_cls):
             def encode(self, data, partition=None, sequence=None):
-                encoded = func(data)
-                if partition:
-                    part = str(partition).encode('utf-8')
-                else:
-                    part = b''
-                if sequence:
-                    seq = int(sequence)
-                else:
-                    seq = -1
-                # struct.calcsize('<q') = 8
-                meta = struct.pack('<H{}sq'.format(len(part)), len(part) + 8, part, seq)
-                return struct.pack(
-                    '<I{}s{}s'.format(len(meta), len(encoded)),
-                    len(meta) + len(encoded), meta, encoded)
+                return _connector_codec.encode(
+                    self._func(data), partition, sequence)
+            def encode_many(self, data, partition=None, sequences=None):
+                func = self._func
+                return _connector_codec.encode_many(
+                    [func(d) for d in data], partition, sequences)
 
     # Case 4: Decoder
     elif base_cls is OctetDecoder:
-        header_length = kwargs['header_length']
-        length_fmt = kwargs['length_fmt']
         class C(base_cls):
             def header_length(self):
-                return header_length
+                return self._header_length
             def payload_length(self, bs):
-                return struct.unpack(length_fmt, bs)[0]
+                return struct.unpack_from(self._length_fmt, bs)[0]
             def decode(self, bs):
-                return func(bs)
+                return self._func(bs)
+            def zero_copy(self):
+                return self._zero_copy
 
     elif base_cls is ConnectorDecoder:
         class C(base_cls):
@@ -273,19 +487,26 @@ def _wallaroo_wrap(name, func, base_cls, **kwargs):
                 # struct.calcsize('<I')
                 return 4
             def payload_length(self, bs):
-                return struct.unpack("<I", bs)[0]
+                return _CONNECTOR_SIZE.unpack_from(bs)[0]
             def decode(self, bs):
-                meta_len = struct.unpack_from('<H', bs)[0]
-                # We dropping the metadata on the floor for now, slice out the
-                # remaining data for message decoding.
+                # The partition and sequence number in the metadata are
+                # tracked by the connector source itself, slice out the
+                # remaining data for message decoding. This runs for every
+                # message, so it doesn't go through ConnectorCodec.message.
                 # struct.calcsize('<H') = 2
-                message_data = bs[2 + meta_len :]
-                return func(message_data)
+                meta_len = struct.unpack_from('<H', bs)[0]
+                return self._func(bs[2 + meta_len:])
             def decoder(self):
-                return func
+                return self._func
 
-    # Attach the new class to the module's global namespace and return it
-    return attach_to_module(C, base_cls.__name__, func)
+    def reduce_wrapper(self):
+        return (_wrapper_by_name, (self._registered_name,))
+
+    C.__reduce__ = reduce_wrapper
+    C.__name__ = base_cls.__name__ + 'Wrapper'
+    if sys.version_info.major > 2:
+        C.__qualname__ = C.__name__
+    return C
 
 
 class BaseWrapped(object):
@@ -296,12 +517,146 @@ class BaseWrapped(object):
 class Computation(BaseWrapped):
     _is_multi = False
     _is_state = False
+    _is_vectorized = False
+    _is_batch = False
 
 
 class ComputationMulti(Computation):
     _is_multi = True
 
 
+class ComputationVectorized(Computation):
+    _is_vectorized = True
+
+
+class _VectorizedSplit(ComputationMulti):
+    """
+    Runs a vectorized computation and sends each record of the array it
+    returns on as a separate message. Used in place of a vectorized
+    computation whose output goes to anything but another vectorized
+    computation.
+    """
+    is_stateful = False
+
+    def __init__(self, computation):
+        self._computation = computation
+
+    def name(self):
+        return self._computation.name()
+
+    def compute_multi(self, data):
+        return _split_records(self._computation.compute(data))
+
+
+def _split_records(result):
+    if result is None:
+        return []
+    dtype = getattr(result, 'dtype', None)
+    if dtype is None or not hasattr(result, 'ndim'):
+        return [result]
+    if result.ndim == 0:
+        return [result.item()]
+    if dtype.names is not None:
+        # Records of structured arrays keep their field names, and can be
+        # read with either record.field or record['field'].
+        import numpy
+        return list(result.view(numpy.recarray))
+    return result.tolist()
+
+
+class _FusedComputation(Computation):
+    """
+    Runs a chain of adjacent stateless computations as a single pipeline
+    stage, so each message crosses into Python once for the whole chain.
+    A `None` result from any of them filters the message out.
+    """
+    is_stateful = False
+
+    def __init__(self, computations):
+        self._computations = computations
+        self._fns = [c.compute for c in computations]
+
+    def __getstate__(self):
+        return {'_computations': self._computations}
+
+    def __setstate__(self, state):
+        self.__init__(state['_computations'])
+
+    def name(self):
+        return _fused_name(self._computations)
+
+    def compute(self, data):
+        for compute in self._fns:
+            data = compute(data)
+            if data is None:
+                return None
+        return data
+
+
+class _FusedComputationMulti(ComputationMulti):
+    """
+    Like _FusedComputation, for chains that include a multi computation.
+    Every computation is applied to each of the messages produced by the
+    one before it. Outputs of multi computations are flattened and `None`s
+    are dropped, as they would be between separate stages.
+    """
+    is_stateful = False
+
+    def __init__(self, computations):
+        self._computations = computations
+        self._steps = [_fused_step(c) for c in computations]
+
+    def __getstate__(self):
+        return {'_computations': self._computations}
+
+    def __setstate__(self, state):
+        self.__init__(state['_computations'])
+
+    def name(self):
+        return _fused_name(self._computations)
+
+    def compute_multi(self, data):
+        values = [data]
+        for step in self._steps:
+            values = step(values)
+            if not values:
+                break
+        return values
+
+
+def _fused_name(computations):
+    return " -> ".join([c.name() for c in computations])
+
+
+def _fused_step(computation):
+    if hasattr(computation, 'compute_multi'):
+        compute_multi = computation.compute_multi
+        def step(values):
+            out = []
+            for v in values:
+                results = compute_multi(v)
+                if results:
+                    out.extend([r for r in results if r is not None])
+            return out
+    else:
+        compute = computation.compute
+        def step(values):
+            out = []
+            for v in values:
+                r = compute(v)
+                if r is not None:
+                    out.append(r)
+            return out
+    return step
+
+
+def _fuse(computations):
+    for c in computations:
+        if hasattr(c, 'compute_multi'):
+            return _FusedComputationMulti(computations)
+    return _FusedComputation(computations)
+
+
 class StateComputation(Computation):
     _is_state = True
 
@@ -311,11 +666,236 @@ class StateComputationMulti(StateComputation):
 
 
 class KeyExtractor(BaseWrapped):
-    pass
+    _memo = None
+
+    def memo_stats(self):
+        """
+        Returns `(hits, misses)` for the key memo, or `None` if the key
+        extractor has no memo.
+        """
+        if self._memo is None:
+            return None
+        return (self._memo.hits, self._memo.misses)
+
+
+class _KeyMemo(object):
+    """
+    Remembers the routing keys built for recently returned keys, so keys
+    that keep coming back are only converted once. The memo is kept in two
+    generations of up to `size` keys each. When the current generation is
+    full it replaces the previous one, whose keys are dropped, and a key
+    found in the previous generation is moved back into the current one.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._current = {}
+        self._previous = {}
+
+    def routing_key(self, key):
+        routing_key = self._current.get(key)
+        if routing_key is not None:
+            self.hits += 1
+            return routing_key
+        routing_key = self._previous.pop(key, None)
+        if routing_key is None:
+            self.misses += 1
+            routing_key = _key_bytes(key)
+        else:
+            self.hits += 1
+        if len(self._current) >= self.size:
+            self._previous = self._current
+            self._current = {}
+        self._current[key] = routing_key
+        return routing_key
+
+
+class ComputationBatch(Computation):
+    _is_batch = True
+
+
+class StateComputationBatch(StateComputation):
+    _is_batch = True
+
+
+class _BatchComputation(ComputationMulti):
+    """
+    Runs a batch computation on a batch of messages, at most `batch_size`
+    of them per call. The outputs are sent on as one batch when
+    `keep_batch` is set, and as separate messages otherwise.
+    """
+    is_stateful = False
+
+    def __init__(self, computation, keep_batch):
+        self._computation = computation
+        self._keep_batch = keep_batch
+
+    def name(self):
+        return self._computation.name()
+
+    def compute_multi(self, data):
+        compute_batch = self._computation.compute_batch
+        out = []
+        for batch in _batches(data, self._computation._batch_size):
+            _extend_outputs(out, compute_batch(batch))
+        if self._keep_batch:
+            return [out] if out else []
+        return out
+
+
+class _StateBatchComputation(StateComputationMulti):
+    """
+    Like _BatchComputation, for state batch computations. The state is
+    saved if any of the calls asked for it to be.
+    """
+    is_stateful = True
+
+    def __init__(self, computation, keep_batch):
+        self._computation = computation
+        self._keep_batch = keep_batch
+
+    def name(self):
+        return self._computation.name()
+
+    def initial_state(self):
+        return self._computation.initial_state()
+
+    def compute_multi(self, data, state):
+        compute_batch = self._computation.compute_batch
+        out = []
+        save_state = False
+        for batch in _batches(data, self._computation._batch_size):
+            outputs, save = compute_batch(batch, state)
+            _extend_outputs(out, outputs)
+            save_state = save_state or bool(save)
+        if self._keep_batch:
+            return ([out] if out else [], save_state)
+        return (out, save_state)
+
+
+class _BatchGroup(ComputationMulti):
+    """
+    Splits a batch into one batch per key, in the order each key first
+    appears, so that a key_by can send each of them to its state as a
+    single message.
+    """
+    is_stateful = False
+
+    def __init__(self, key_extractor):
+        self._key_extractor = key_extractor
+
+    def name(self):
+        return "Group Batch"
+
+    def compute_multi(self, data):
+        if not isinstance(data, list):
+            return [[data]]
+        extract_key = self._key_extractor.extract_key
+        groups = {}
+        out = []
+        for d in data:
+            key = extract_key(d)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = []
+                out.append(group)
+            group.append(d)
+        return out
+
+
+class _BatchKeyExtractor(KeyExtractor):
+    """
+    Keys a batch made by _BatchGroup by the key of its first message.
+    """
+    def __init__(self, key_extractor):
+        self._key_extractor = key_extractor
+
+    def extract_key(self, data):
+        return self._key_extractor.extract_key(data[0])
+
+
+def _batches(data, batch_size):
+    # Anything that isn't a list is a batch of one message.
+    if not isinstance(data, list):
+        return [[data]]
+    if len(data) <= batch_size:
+        return [data] if data else []
+    return [data[i:i + batch_size] for i in range(0, len(data), batch_size)]
+
+
+def _extend_outputs(out, outputs):
+    if outputs:
+        out.extend([o for o in outputs if o is not None])
+
+
+# Keys are routed as byte strings, hashed the same way on every worker.
+# Strings and bytes are used as they are. Integers and tuples get a leading
+# tag byte that never starts a UTF-8 string, so they can't collide with
+# string keys. Bytes keys that happen to start with a tag byte get one more
+# tag in front, so they can't collide with integer or tuple keys either.
+# A `str` and a `bytes` key with the same bytes are the same key, as they
+# are on Python 2.
+_INT_KEY_TAG = b'\xff'
+_BIG_INT_KEY_TAG = b'\xfd'
+_TUPLE_KEY_TAG = b'\xfe'
+_ESCAPED_KEY_TAG = b'\xfc'
+_INT_KEY = struct.Struct('<q')
+_INT_KEY_MIN = -2 ** 63
+_INT_KEY_MAX = 2 ** 63 - 1
+
+# Encoded integer keys are kept for reuse, so integer-keyed pipelines with
+# a bounded key space don't build a new key per message. Entries are never
+# evicted; once the cache is full, further keys are encoded on every call.
+_INT_KEY_CACHE_SIZE = 65536
+_int_keys = {}
+
+if sys.version_info.major == 2:
+    _text_type = unicode
+    _int_types = (int, long)
+else:
+    _text_type = str
+    _int_types = (int,)
+
+
+def _key_bytes(key):
+    if isinstance(key, bytes):
+        if key[:1] >= _ESCAPED_KEY_TAG:
+            return _ESCAPED_KEY_TAG + key
+        return key
+    if isinstance(key, str):
+        return key
+    if isinstance(key, _int_types):
+        encoded = _int_keys.get(key)
+        if encoded is None:
+            encoded = _int_key_bytes(key)
+            if len(_int_keys) < _INT_KEY_CACHE_SIZE:
+                _int_keys[key] = encoded
+        return encoded
+    if isinstance(key, tuple):
+        parts = [_TUPLE_KEY_TAG]
+        for item in key:
+            item = _key_bytes(item)
+            if isinstance(item, _text_type):
+                item = item.encode('utf-8')
+            parts.append(wallaroo.serialization._encode_varint(len(item)))
+            parts.append(item)
+        return b''.join(parts)
+    if isinstance(key, _text_type):
+        return key.encode('utf-8')
+    raise TypeError("Keys must be strings, bytes, integers or tuples of "
+                    "them, not {}".format(type(key).__name__))
+
+
+def _int_key_bytes(n):
+    if _INT_KEY_MIN <= n <= _INT_KEY_MAX:
+        return _INT_KEY_TAG + _INT_KEY.pack(n)
+    return _BIG_INT_KEY_TAG + str(n).encode('ascii')
 
 
 class OctetDecoder(BaseWrapped):
-    pass
+    def zero_copy(self):
+        return False
 
 
 class OctetEncoder(BaseWrapped):
@@ -323,43 +903,192 @@ class OctetEncoder(BaseWrapped):
 
 
 class ConnectorDecoder(BaseWrapped):
-    pass
+    def zero_copy(self):
+        return False
 
 
 class ConnectorEncoder(BaseWrapped):
     pass
 
 
-def computation(name):
+_CONNECTOR_SIZE = struct.Struct('<I')
+_CONNECTOR_META_SIZE = struct.Struct('<H')
+_CONNECTOR_HEADER = struct.Struct('<IH')
+_CONNECTOR_SEQUENCE = struct.Struct('<q')
+# The header of a message without a partition: size, metadata size and
+# sequence.
+_CONNECTOR_UNPARTITIONED = struct.Struct('<IHq')
+_unpack_connector_meta_size = _CONNECTOR_META_SIZE.unpack_from
+
+
+class ConnectorCodec(object):
+    """
+    Frames messages for connectors as
+
+        <I size><H metadata size><partition><q sequence><message>
+
+    little-endian, where `size` counts the bytes after it and the metadata
+    is the partition and the sequence number. A message without a
+    partition has an empty one, and a message without a sequence number
+    has -1.
+
+    The headers are packed with precompiled structs and joined to the
+    message in one copy. (Packing into a preallocated `bytearray` with
+    `pack_into` is slower from Python, and a reused buffer can't be handed
+    to the send buffer, which keeps what it is given until it is sent.)
+    """
+    def encode(self, message, partition=None, sequence=None):
+        if sequence is None:
+            sequence = -1
+        if partition is None:
+            return _CONNECTOR_UNPARTITIONED.pack(
+                len(message) + 10, 8, sequence) + message
+        part = _partition_bytes(partition)
+        return b''.join((
+            _CONNECTOR_HEADER.pack(len(message) + len(part) + 10,
+                                   len(part) + 8),
+            part, _CONNECTOR_SEQUENCE.pack(sequence), message))
+
+    def encode_many(self, messages, partition=None, sequences=None):
+        """
+        Frame every message in the list `messages` into one `bytes`
+        object. `sequences` has one sequence number per message, or is None
+        to send them without sequence numbers.
+        """
+        if sequences is None:
+            sequences = [-1] * len(messages)
+        pieces = []
+        append = pieces.append
+        if partition is None:
+            pack = _CONNECTOR_UNPARTITIONED.pack
+            for message, sequence in zip(messages, sequences):
+                append(pack(len(message) + 10, 8, sequence))
+                append(message)
+        else:
+            part = _partition_bytes(partition)
+            header = _CONNECTOR_HEADER.pack
+            pack_sequence = _CONNECTOR_SEQUENCE.pack
+            size = len(part) + 10
+            meta_size = len(part) + 8
+            for message, sequence in zip(messages, sequences):
+                append(header(len(message) + size, meta_size))
+                append(part)
+                append(pack_sequence(sequence))
+                append(message)
+        return b''.join(pieces)
+
+    def metadata(self, frame):
+        """
+        Return the partition (as bytes) and the sequence number of a
+        message, without its leading size.
+        """
+        meta_size = _CONNECTOR_META_SIZE.unpack_from(frame)[0]
+        partition = _to_bytes(frame[2:meta_size - 6])
+        return (partition,
+                _CONNECTOR_SEQUENCE.unpack_from(frame, meta_size - 6)[0])
+
+    def message(self, frame):
+        """
+        Return the message in a frame without its leading size, as bytes.
+        """
+        data = frame[2 + _unpack_connector_meta_size(frame)[0]:]
+        if data.__class__ is not bytes:
+            data = _to_bytes(data)
+        return data
+
+
+def _to_bytes(data):
+    if isinstance(data, bytes):
+        return data
+    if isinstance(data, memoryview):
+        # bytes(memoryview) is its repr on Python 2.
+        return data.tobytes()
+    return bytes(data)
+
+
+def _partition_bytes(partition):
+    if isinstance(partition, bytes):
+        return partition
+    return u'{}'.format(partition).encode('utf-8')
+
+
+_connector_codec = ConnectorCodec()
+
+
+def computation(name, vectorized=False):
+    """
+    With `vectorized=True` the computation is expected to take and return
+    NumPy arrays of many records. Consecutive vectorized computations pass
+    arrays between each other, and the array returned by the last one is
+    split into one message per record before it reaches a key_by, a sink,
+    a merge or a computation that isn't vectorized.
+    """
     def wrapped(func):
         _validate_arity_compatability(name, func, 1)
-        C = _wallaroo_wrap(name, func, Computation)
-        return C()
+        if vectorized:
+            return _wallaroo_wrap(name, func, ComputationVectorized)
+        else:
+            return _wallaroo_wrap(name, func, Computation)
     return wrapped
 
 
 def state_computation(name, state):
     def wrapped(func):
         _validate_arity_compatability(name, func, 2)
-        C = _wallaroo_wrap(name, func, StateComputation, state=state)
-        # C = _wallaroo_wrap(name, func, StateComputation, state=StateBuilder(state))
-        return C()
+        return _wallaroo_wrap(name, func, StateComputation, state=state)
+        # return _wallaroo_wrap(name, func, StateComputation, state=StateBuilder(state))
     return wrapped
 
 def computation_multi(name):
     def wrapped(func):
         _validate_arity_compatability(name, func, 1)
-        C = _wallaroo_wrap(name, func, ComputationMulti)
-        return C()
+        return _wallaroo_wrap(name, func, ComputationMulti)
     return wrapped
 
 def state_computation_multi(name, state):
     def wrapped(func):
         _validate_arity_compatability(name, func, 2)
-        C = _wallaroo_wrap(name, func, StateComputationMulti, state=StateBuilder(state))
-        return C()
+        return _wallaroo_wrap(name, func, StateComputationMulti, state=StateBuilder(state))
     return wrapped
 
+def computation_batch(name, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    The decorated function takes a list of messages and returns a list of
+    outputs, from which `None`s are dropped. A batch is a list sent as one
+    message, by a decoder or by another batch computation; anything else
+    is passed as a list of one message. Batches longer than `batch_size`
+    are passed in several calls. Consecutive batch computations pass their
+    outputs to each other as a batch, and the outputs of the last one are
+    sent on as separate messages.
+    """
+    def wrapped(func):
+        _validate_arity_compatability(name, func, 1)
+        _validate_batch_size(name, batch_size)
+        return _wallaroo_wrap(name, func, ComputationBatch,
+                              batch_size=batch_size)
+    return wrapped
+
+def state_computation_batch(name, state, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Like `computation_batch`, for a function that takes a list of messages
+    for the same state and the state, and returns a tuple of
+    `(outputs, save_state)`. A batch sent through a key_by is split into
+    one batch per key first.
+    """
+    def wrapped(func):
+        _validate_arity_compatability(name, func, 2)
+        _validate_batch_size(name, batch_size)
+        return _wallaroo_wrap(name, func, StateComputationBatch, state=state,
+                              batch_size=batch_size)
+    return wrapped
+
+def _validate_batch_size(name, batch_size):
+    if (not isinstance(batch_size, _int_types) or
+            isinstance(batch_size, bool) or batch_size < 1):
+        print("\nAPI_Error: batch_size for {0} must be a positive integer "
+              "but got {1!r}".format(name, batch_size))
+        raise WallarooParameterError()
+
 class StateBuilder(object):
     def __init__(self, state_cls):
         self.state_cls = state_cls
@@ -367,24 +1096,51 @@ class StateBuilder(object):
     def initial_state(self):
         return self.state_cls()
 
-def key_extractor(func):
-    _validate_arity_compatability(func.__name__, func, 1)
-    C = _wallaroo_wrap(func.__name__, func, KeyExtractor)
-    return C()
+def key_extractor(func=None, memo_size=0):
+    """
+    Can be used bare, as `@wallaroo.key_extractor`, or with arguments, as
+    `@wallaroo.key_extractor(memo_size=1024)`.
 
-def decoder(header_length, length_fmt):
+    With a `memo_size`, the routing keys of at least the last `memo_size`
+    distinct keys returned by the function are remembered, so a key that
+    keeps coming back is only converted once. Keys must then be hashable,
+    and keys that compare equal get the same routing key.
+    """
     def wrapped(func):
         _validate_arity_compatability(func.__name__, func, 1)
-        C = _wallaroo_wrap(func.__name__, func, OctetDecoder,
-                           header_length = header_length,
-                           length_fmt = length_fmt)
-        return C()
+        _validate_memo_size(func.__name__, memo_size)
+        memo = _KeyMemo(memo_size) if memo_size else None
+        return _wallaroo_wrap(func.__name__, func, KeyExtractor, memo=memo)
+    if func is None:
+        return wrapped
+    return wrapped(func)
+
+def _validate_memo_size(name, memo_size):
+    if (not isinstance(memo_size, _int_types) or
+            isinstance(memo_size, bool) or memo_size < 0):
+        print("\nAPI_Error: memo_size for {0} must be a non-negative "
+              "integer but got {1!r}".format(name, memo_size))
+        raise WallarooParameterError()
+
+def decoder(header_length, length_fmt, zero_copy=False):
+    """
+    With `zero_copy=True` the decoder function is passed a read-only
+    `memoryview` over the received frame instead of a `bytes` copy. The view
+    is only valid until the function returns, so anything kept from it must
+    be copied out (for example with `bytes(view[a:b])` or `view.tobytes()`).
+    Python 2 can't release a view, so there the view is over a copy.
+    """
+    def wrapped(func):
+        _validate_arity_compatability(func.__name__, func, 1)
+        return _wallaroo_wrap(func.__name__, func, OctetDecoder,
+                              header_length = header_length,
+                              length_fmt = length_fmt,
+                              zero_copy = bool(zero_copy))
     return wrapped
 
 def encoder(func):
     _validate_arity_compatability(func.__name__, func, 1)
-    C = _wallaroo_wrap(func.__name__, func, OctetEncoder)
-    return C()
+    return _wallaroo_wrap(func.__name__, func, OctetEncoder)
 
 class TCPSourceConfig(object):
     def __init__(self, host, port, decoder):
@@ -457,6 +1213,7 @@ class DefaultKafkaSinkCLIParser(object):
         return ("kafka-internal", self.name, self.encoder)
 
 def tcp_parse_input_addrs(args):
+    import argparse
     parser = argparse.ArgumentParser(prog="wallaroo")
     parser.add_argument('-i', '--in', dest="input_addrs")
     input_addrs = parser.parse_known_args(args)[0].input_addrs
@@ -464,13 +1221,40 @@ def tcp_parse_input_addrs(args):
     return [tuple(x.split(':')) for x in input_addrs.split(',')]
 
 def tcp_parse_output_addrs(args):
+    import argparse
     parser = argparse.ArgumentParser(prog="wallaroo")
     parser.add_argument('-o', '--out', dest="output_addrs")
     output_addrs = parser.parse_known_args(args)[0].output_addrs
     # split H1:P1,H2:P2... into [(H1, P1), (H2, P2), ...]
     return [tuple(x.split(':')) for x in output_addrs.split(',')]
 
+def log_parse_options(args):
+    """
+    Returns `(level, sample, stage_samples)` for `wallaroo.log.configure`
+    from `--log-level` and `--log-sample`. `--log-sample` is either a
+    sampling rate for every logger, such as `100`, or per-stage rates such
+    as `TraceID=10,TraceWindow=1000`, or both, such as `100,TraceID=10`.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="wallaroo")
+    parser.add_argument('--log-level', dest="log_level", default=None,
+                        choices=sorted(wallaroo.log.LEVELS))
+    parser.add_argument('--log-sample', dest="log_sample", default="")
+    known_args = parser.parse_known_args(args)[0]
+    sample = None
+    stage_samples = {}
+    for part in known_args.log_sample.split(','):
+        if not part:
+            continue
+        if '=' in part:
+            name, rate = part.rsplit('=', 1)
+            stage_samples[name] = int(rate)
+        else:
+            sample = int(part)
+    return (known_args.log_level, sample, stage_samples or None)
+
 def kafka_parse_source_options(args):
+    import argparse
     parser = argparse.ArgumentParser(prog="wallaroo")
     parser.add_argument('--kafka_source_topic', dest="topic",
                         default="")
@@ -487,6 +1271,7 @@ def kafka_parse_source_options(args):
     return (known_args.topic, brokers, known_args.log_level)
 
 def kafka_parse_sink_options(args):
+    import argparse
     parser = argparse.ArgumentParser(prog="wallaroo")
     parser.add_argument('--kafka_sink_topic', dest="topic",
                         default="")
@@ -527,64 +1312,186 @@ def _kafka_parse_broker(broker):
 
 # Each node is a list of stages. Each of these lists will either begin with a "source" stage
 # (if it is a leaf of the tree) or a "merge" stage (if it is not a leaf).
-class _PipelineTree(object):
-    def __init__(self, source_stage):
-        self.root_idx = 0
-        self.vs = [[source_stage]]
-        self.es = [[]]
-        self.is_closed = False
+def _is_stateless_stage(stage):
+    return (stage is not None and stage[0] == "to" and
+            not stage[1].is_stateful)
+
+
+def _is_batch_stage(stage):
+    return (stage is not None and stage[0] in ("to", "to_state") and
+            getattr(stage[1], '_is_batch', False))
+
+
+def _is_vectorized_stage(stage):
+    return (stage is not None and stage[0] == "to" and
+            getattr(stage[1], '_is_vectorized', False))
 
-    def is_empty(self):
-        return len(self.vs == 0)
+
+class _StageNode(object):
+    # One stage, added after `prev` in the same branch. A source stage has
+    # no `prev`.
+    __slots__ = ('stage', 'prev')
+
+    def __init__(self, stage, prev):
+        self.stage = stage
+        self.prev = prev
+
+
+class _MergeNode(object):
+    # The start of a new branch fed by two existing ones.
+    __slots__ = ('left', 'right')
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+
+# Work items for _PipelineTree._materialize.
+_BUILD = 0
+_MERGED = 1
+_LINK = 2
+
+
+class _PipelineTree(object):
+    """
+    An immutable pipeline tree. Its nodes are never changed once created, so
+    adding a stage or merging shares everything built so far instead of
+    copying it, and the vertex and edge lists are only built by `to_tuple`.
+    """
+    def __init__(self, source_stage, head=None, is_closed=False):
+        if head is None:
+            head = _StageNode(source_stage, None)
+        self.head = head
+        self.is_closed = is_closed
 
     def add_stage(self, stage):
         if self.is_closed:
             print("\nAPI_Error: You can't add stages after to_sink/s.")
             raise WallarooParameterError()
-        self.vs[self.root_idx].append(stage)
-        if (stage[0] == 'to_sink') or (stage[0] == 'to_sinks'):
-            self.is_closed = True
-        return self
+        return _PipelineTree(None, _StageNode(stage, self.head),
+                             stage[0] == 'to_sink' or stage[0] == 'to_sinks')
 
     def merge(self, p_graph):
-        idx = len(self.vs)
-        self.vs.append([])
-        self.es.append([self.root_idx])
-        self.root_idx = idx
-        diff = len(self.vs)
-        for v in p_graph.vs:
-            stages_clone = []
-            for stage in v:
-                stages_clone.append(stage)
-            self.vs.append(stages_clone)
-        for es in p_graph.es:
-            new_es = []
-            for e_idx in es:
-                new_es.append(e_idx + diff)
-            self.es.append(new_es)
-        self.es[self.root_idx].append(p_graph.root_idx + diff)
-        return self
-
-    def to_tuple(self, app_name):
-        p_tree = self.clone()
-        return (app_name, p_tree.root_idx, p_tree.vs, p_tree.es)
-
-    def clone(self):
-        new_vs = []
-        new_es = []
-        for v in self.vs:
-            new_stages = []
-            for stage in v:
-                new_stages.append(stage)
-            new_vs.append(new_stages)
-        for es in self.es:
-            new_outs = []
-            for out in es:
-                new_outs.append(out)
-            new_es.append(new_outs)
-        pt = _PipelineTree(None)
-        pt.root_idx = self.root_idx
-        pt.vs = new_vs
-        pt.es = new_es
-        pt.is_closed = self.is_closed
-        return pt
+        return _PipelineTree(None, _MergeNode(self.head, p_graph.head),
+                             self.is_closed)
+
+    def _materialize(self):
+        # Lays the tree out as vertex (stage list) and edge lists, in the
+        # order that merging copied lists used to produce: a merge's left
+        # input first, then its own vertex, then its right input. Uses an
+        # explicit stack so that deep pipelines don't hit the recursion
+        # limit.
+        vs = []
+        es = []
+        roots = []
+        work = [(_BUILD, self.head)]
+        while work:
+            op, arg = work.pop()
+            if op == _BUILD:
+                stages = []
+                node = arg
+                while isinstance(node, _StageNode) and node.prev is not None:
+                    stages.append(node.stage)
+                    node = node.prev
+                stages.reverse()
+                if isinstance(node, _StageNode):
+                    roots.append(len(vs))
+                    vs.append([node.stage] + stages)
+                    es.append([])
+                else:
+                    work.append((_MERGED, (stages, node.right)))
+                    work.append((_BUILD, node.left))
+            elif op == _MERGED:
+                stages, right = arg
+                work.append((_LINK, len(vs)))
+                work.append((_BUILD, right))
+                vs.append(stages)
+                es.append([roots.pop()])
+            else:
+                es[arg].append(roots.pop())
+                roots.append(arg)
+        return roots.pop(), vs, es
+
+    def to_tuple(self, app_name, fuse=False):
+        root_idx, vs, es = self._materialize()
+        _split_vectorized(vs)
+        _batch_stages(vs)
+        if fuse:
+            _fuse_stateless(vs)
+        return (app_name, root_idx, vs, es)
+
+
+def _split_vectorized(vs):
+    # A vectorized computation only hands its array on as a single
+    # message when the next stage in the same branch is vectorized too.
+    for stages in vs:
+        for i, stage in enumerate(stages):
+            if not _is_vectorized_stage(stage):
+                continue
+            if i + 1 < len(stages) and _is_vectorized_stage(stages[i + 1]):
+                continue
+            stages[i] = ("to", _VectorizedSplit(stage[1]))
+
+
+def _batch_stages(vs):
+    # A batch computation sends its outputs on as a batch when the next
+    # stage in the same branch takes batches. A key_by in front of a state
+    # batch computation is given batches grouped by key.
+    for idx, stages in enumerate(vs):
+        out = []
+        for i, stage in enumerate(stages):
+            following = stages[i + 1:i + 3]
+            if _is_batch_stage(stage):
+                keep_batch = _takes_batches(following)
+                if stage[0] == "to_state":
+                    out.append(("to_state",
+                                _StateBatchComputation(stage[1], keep_batch)))
+                else:
+                    out.append(("to", _BatchComputation(stage[1], keep_batch)))
+            elif (stage[0] == "key_by" and following and
+                    _is_batch_stage(following[0]) and
+                    following[0][0] == "to_state"):
+                out.append(("to", _BatchGroup(stage[1])))
+                out.append(("key_by", _BatchKeyExtractor(stage[1])))
+            else:
+                out.append(stage)
+        vs[idx] = out
+
+
+def _takes_batches(stages):
+    if not stages:
+        return False
+    if _is_batch_stage(stages[0]):
+        return True
+    return (stages[0][0] == "key_by" and len(stages) > 1 and
+            _is_batch_stage(stages[1]) and stages[1][0] == "to_state")
+
+
+def _fuse_stateless(vs):
+    # Runs of stateless computations with nothing in between them are
+    # replaced by one computation that calls each of them in turn.
+    for idx, stages in enumerate(vs):
+        fused = []
+        run = []
+        for stage in stages + [None]:
+            if _is_stateless_stage(stage):
+                run.append(stage[1])
+                continue
+            if len(run) == 1:
+                fused.append(("to", run[0]))
+            elif run:
+                fused.append(("to", _fuse(run)))
+            run = []
+            if stage is not None:
+                fused.append(stage)
+        vs[idx] = fused
+
+
+# Without module __getattr__ (PEP 562) submodules can't be imported on
+# first access. Only the ones wallaroo has always imported are imported up
+# front (experimental, which imports log), along with serialization, which
+# the default serialize and deserialize need; schema has to be imported
+# explicitly.
+if sys.version_info < (3, 7):
+    import wallaroo.experimental
+    import wallaroo.serialization
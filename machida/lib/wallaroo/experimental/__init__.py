@@ -12,29 +12,37 @@
 #  implied. See the License for the specific language governing
 #  permissions and limitations under the License.
 
-import argparse
-import inspect
+import atexit
+import collections
+import errno
+import select
 import socket
 import struct
 import sys
+import tempfile
+import threading
 import time
 
-from functools import wraps
-from select import select
+try:
+    import selectors
+except ImportError:
+    # Python 2
+    selectors = None
 
 import wallaroo
+import wallaroo.log
+
+_log = wallaroo.log.logger("wallaroo.experimental")
 
 
 def stream_message_decoder(func):
-    wallaroo._validate_arity_compatability(func, 1)
-    C = wallaroo._wallaroo_wrap(func.__name__, func, wallaroo.ConnectorDecoder)
-    return C()
+    wallaroo._validate_arity_compatability(func.__name__, func, 1)
+    return wallaroo._wallaroo_wrap(func.__name__, func, wallaroo.ConnectorDecoder)
 
 
 def stream_message_encoder(func):
-    wallaroo._validate_arity_compatability(func, 1)
-    C = wallaroo._wallaroo_wrap(func.__name__, func, wallaroo.ConnectorEncoder)
-    return C()
+    wallaroo._validate_arity_compatability(func.__name__, func, 1)
+    return wallaroo._wallaroo_wrap(func.__name__, func, wallaroo.ConnectorEncoder)
 
 
 class StreamDecoderError(Exception):
@@ -61,133 +69,941 @@ class SinkConnectorConfig(object):
         return ("connector", self._host, str(self._port), self._encoder)
 
 
+# Encoded messages are sent in batches of up to DEFAULT_SEND_BATCH_SIZE
+# bytes, waiting up to DEFAULT_SEND_LINGER seconds for a batch to fill.
+# Writers block once DEFAULT_SEND_BUFFER_SIZE bytes are waiting to be sent.
+DEFAULT_SEND_BATCH_SIZE = 64 * 1024
+DEFAULT_SEND_LINGER = 0.005
+DEFAULT_SEND_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Messages Wallaroo hasn't acknowledged yet are kept in memory up to
+# DEFAULT_REPLAY_MEMORY bytes, then in a temporary file up to
+# DEFAULT_REPLAY_SPILL bytes. A resilient Wallaroo tells a connector where to
+# resume as soon as it connects. A connector only waits for that, up to
+# `ack_timeout` seconds, when it is given one; by default it doesn't wait and
+# nothing is kept for replay.
+DEFAULT_REPLAY_MEMORY = 64 * 1024 * 1024
+DEFAULT_REPLAY_SPILL = 1024 * 1024 * 1024
+DEFAULT_ACK_TIMEOUT = 0
+
+# Kinds of the frames Wallaroo sends to a source connector.
+_ACK = 0
+_RESUME = 1
+
+
 class SourceConnector(object):
-    def __init__(self, args=None, required_params=[], optional_params=[]):
-        params = parse_connector_args(args or sys.argv, required_params, optional_params)
-        wallaroo_app = __import__(params.application)
-        actions = wallaroo_app.application_setup(args or sys.argv)
-        try:
-            (_command, _name, port, encoder, _decoder) = next(
-                action for action in actions
-                if action[0] == "source_connector" and action[1] == params.connector_name)
-        except:
-            raise RuntimeError("Unable to find a source connector with the name " + params.connector_name)
+    """
+    Sends messages to a Wallaroo connector source. Every message carries
+    a partition and a sequence number; unless they are given, messages
+    are numbered one after the other within their partition.
+
+    When Wallaroo is built with resilience, it acknowledges the sequence
+    numbers of each partition once a checkpoint including them has been
+    written, and the connector keeps the messages that haven't been
+    acknowledged yet. When the connector connects, and after a worker
+    rolls back, Wallaroo tells it the sequence numbers of each partition
+    as of its last checkpoint, and the messages after those are sent
+    again.
+    """
+    def __init__(self, args=None, required_params=[], optional_params=[],
+                 batch_size=DEFAULT_SEND_BATCH_SIZE,
+                 linger=DEFAULT_SEND_LINGER,
+                 buffer_size=DEFAULT_SEND_BUFFER_SIZE,
+                 replay_memory=DEFAULT_REPLAY_MEMORY,
+                 replay_spill=DEFAULT_REPLAY_SPILL,
+                 ack_timeout=DEFAULT_ACK_TIMEOUT):
+        (params, port, encoder, _decoder) = _find_connector(
+            "source", args, required_params, optional_params)
         self.params = params
+        self._init_writer(encoder, port, batch_size, linger, buffer_size,
+                          replay_memory, replay_spill, ack_timeout)
+
+    def _init_writer(self, encoder, port,
+                     batch_size=DEFAULT_SEND_BATCH_SIZE,
+                     linger=DEFAULT_SEND_LINGER,
+                     buffer_size=DEFAULT_SEND_BUFFER_SIZE,
+                     replay_memory=DEFAULT_REPLAY_MEMORY,
+                     replay_spill=DEFAULT_REPLAY_SPILL,
+                     ack_timeout=DEFAULT_ACK_TIMEOUT):
         self._encoder = encoder
         self._host = '127.0.0.1'
         self._port = port
+        self._address = None
         self._conn = None
-
-    def connect(self, host=None, port=None):
+        self._sender = None
+        self._batch_size = batch_size
+        self._linger = linger
+        self._buffer_size = buffer_size
+        self._replay_memory = replay_memory
+        self._replay_spill = replay_spill
+        self._ack_timeout = ack_timeout
+        self._replay = None
+        # The last sequence number written, and the last acknowledged by
+        # Wallaroo, for each partition.
+        self._sequences = {}
+        self._acked = {}
+        # Held while writing, so messages are numbered, kept for replay
+        # and sent in the same order, and while replaying.
+        self._write_lock = threading.Lock()
+
+    def connect(self, host=None, port=None, ack_timeout=None):
+        """
+        Connect to Wallaroo. `ack_timeout`, if given, replaces the one the
+        connector was created with.
+        """
+        with self._write_lock:
+            if ack_timeout is not None:
+                self._ack_timeout = ack_timeout
+            self._address = (host or self._host, int(port or self._port))
+            self._connect()
+
+    def _connect(self):
         while True:
             try:
                 conn = socket.socket()
-                conn.connect( (host or self._host, int(port or self._port)) )
-                self._conn = conn
-                return
+                conn.connect(self._address)
+                break
             except socket.error as err:
-                if err.errno == socket.errno.ECONNREFUSED:
+                conn.close()
+                if err.errno == errno.ECONNREFUSED:
                     time.sleep(1)
                 else:
                     raise
-
-    def write(self, message):
-        # Future parameters
-        partition = None
-        sequence = None
+        # A resilient Wallaroo starts by telling us where to resume.
+        frame = None
+        if self._ack_timeout > 0:
+            conn.settimeout(self._ack_timeout)
+            try:
+                frame = _read_sequences(conn)
+            except socket.timeout:
+                pass
+            conn.settimeout(None)
+        self._conn = conn
+        self._sender = _SendBuffer(conn, self._batch_size,
+                                   self._linger, self._buffer_size)
+        if frame is None:
+            return
+        if self._replay is None:
+            self._replay = _ReplayBuffer(self._replay_memory,
+                                         self._replay_spill)
+        self._received_sequences(*frame)
+        reader = threading.Thread(target=self._read_acks, args=(conn,),
+                                  name="wallaroo-source-acks")
+        reader.daemon = True
+        reader.start()
+
+    def write(self, message, partition=None, sequence=None):
+        """
+        Encode `message` and queue it to be sent to Wallaroo. Blocks while
+        the send buffer is full, which happens when Wallaroo isn't reading
+        as fast as messages are written.
+
+        `sequence` numbers must increase within a `partition`, for example
+        the offsets of the messages in a Kafka partition; by default they
+        count up from the last one written.
+        """
         if self._conn == None:
             raise RuntimeError("Please call connect before writing")
-        payload = self._encoder.encode(message)
-        self._conn.sendall(payload)
-
+        key = _partition_key(partition)
+        with self._write_lock:
+            if sequence is None:
+                sequence = self._sequences.get(key, -1) + 1
+            self._sequences[key] = sequence
+            data = self._encoder.encode(message, partition, sequence)
+            if self._replay is not None:
+                self._replay.append(key, sequence, data)
+            self._send(data)
+
+    def write_many(self, messages, partition=None, sequences=None):
+        """
+        Encode and queue every message in `messages` at once, which is
+        cheaper than calling `write` for each of them. `sequences`, if
+        given, has one sequence number per message.
+        """
+        if self._conn == None:
+            raise RuntimeError("Please call connect before writing")
+        key = _partition_key(partition)
+        messages = list(messages)
+        if not messages:
+            return
+        with self._write_lock:
+            if sequences is None:
+                first = self._sequences.get(key, -1) + 1
+                sequences = list(range(first, first + len(messages)))
+            else:
+                sequences = list(sequences)
+            data = self._encoder.encode_many(messages, partition, sequences)
+            sequence = sequences[-1]
+            self._sequences[key] = sequence
+            if self._replay is not None:
+                # Replayed whole, until its last message is acknowledged.
+                self._replay.append(key, sequence, data)
+            self._send(data)
+
+    def flush(self):
+        """
+        Block until every message written so far has been sent.
+        """
+        if self._sender is None:
+            return
+        with self._write_lock:
+            while True:
+                try:
+                    self._sender.flush()
+                    return
+                except socket.error:
+                    if self._replay is None:
+                        raise
+                    self._reconnect()
+
+    def acked(self):
+        """
+        Return the last sequence number Wallaroo has acknowledged for each
+        partition, keyed by the partition as a string. Only a resilient
+        Wallaroo acknowledges messages.
+        """
+        with self._write_lock:
+            return dict(self._acked)
+
+    def close(self):
+        if self._sender is not None:
+            self._sender.close()
+            self._sender = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self._replay is not None:
+            self._replay.close()
+            self._replay = None
+
+    def _send(self, data):
+        # Called with the write lock held.
+        try:
+            self._sender.write(data)
+        except socket.error:
+            if self._replay is None:
+                raise
+            # The data was kept for replay, and will be sent once we're
+            # connected again.
+            self._reconnect()
+
+    def _reconnect(self):
+        # Called with the write lock held.
+        sender, conn = self._sender, self._conn
+        self._sender = self._conn = None
+        try:
+            sender.close()
+        except Exception:
+            pass
+        conn.close()
+        self._connect()
 
-class SinkConnector(object):
+    def _read_acks(self, conn):
+        try:
+            while True:
+                frame = _read_sequences(conn)
+                if frame is None:
+                    return
+                with self._write_lock:
+                    if conn is not self._conn:
+                        return
+                    self._received_sequences(*frame)
+        except Exception:
+            # The connection is gone; the next write reconnects.
+            pass
+
+    def _received_sequences(self, kind, sequences):
+        # Called with the write lock held. Only acknowledgements let go of
+        # data; a resume frame just says where to start sending it again.
+        if kind == _ACK:
+            self._acked.update(sequences)
+            self._replay.ack(sequences)
+        for key, sequence in sequences.items():
+            # Keep counting from where Wallaroo is if we restarted.
+            if self._sequences.get(key, -1) < sequence:
+                self._sequences[key] = sequence
+        if kind == _RESUME:
+            for data in self._replay.unacked(after=sequences):
+                self._sender.write(data)
+
+
+def _partition_key(partition):
+    # The partition as Wallaroo sees it, in the metadata written by
+    # ConnectorEncoder.
+    if partition is None:
+        return u''
+    if isinstance(partition, bytes):
+        return partition.decode('utf-8')
+    return u'{}'.format(partition)
+
+
+def _read_sequences(conn):
+    """
+    Read a frame of sequence numbers sent by Wallaroo and return its kind
+    and the sequence number of each partition, or None if the connection
+    has been closed. A frame is <I size><B kind> followed by
+    <H partition size><partition><q sequence> for each partition.
+    """
+    header = _recv_exactly(conn, 5)
+    if header is None:
+        return None
+    size, kind = struct.unpack('<IB', header)
+    data = _recv_exactly(conn, size - 1)
+    if data is None:
+        return None
+    return (kind, _parse_sequences(data))
+
+
+def _parse_sequences(data):
+    sequences = {}
+    offset = 0
+    while offset < len(data):
+        part_size = struct.unpack_from('<H', data, offset)[0]
+        offset += 2
+        partition = data[offset:offset + part_size].decode('utf-8')
+        offset += part_size
+        sequences[partition] = struct.unpack_from('<q', data, offset)[0]
+        offset += 8
+    return sequences
+
+
+def _recv_exactly(conn, size):
+    chunks = []
+    while size > 0:
+        chunk = conn.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+class _ReplayBuffer(object):
+    """
+    The data sent to Wallaroo that it hasn't acknowledged yet, oldest first,
+    with the partition and last sequence number of each write. Up to
+    `max_memory` bytes are kept in memory and older data is moved to a
+    temporary file, which holds up to `max_spill` bytes; past that the
+    oldest data is dropped, with a warning, and can't be replayed.
+
+    Data is forgotten in order, once it and everything before it has been
+    acknowledged.
+    """
+    def __init__(self, max_memory=DEFAULT_REPLAY_MEMORY,
+                 max_spill=DEFAULT_REPLAY_SPILL):
+        self._max_memory = max_memory
+        self._max_spill = max_spill
+        self._acked = {}
+        # (partition, sequence, data)
+        self._memory = collections.deque()
+        self._memory_size = 0
+        # (partition, sequence, offset, size), offsets into _file.
+        self._spilled = collections.deque()
+        self._spill_end = 0
+        self._file = None
+
+    def __len__(self):
+        return len(self._spilled) + len(self._memory)
+
+    def append(self, partition, sequence, data):
+        self._memory.append((partition, sequence, data))
+        self._memory_size += len(data)
+        while self._memory_size > self._max_memory and self._memory:
+            entry = self._memory.popleft()
+            self._memory_size -= len(entry[2])
+            self._spill(entry)
+
+    def ack(self, sequences):
+        self._acked.update(sequences)
+        spilled = self._spilled
+        while spilled and self._is_acked(spilled[0]):
+            spilled.popleft()
+        if not spilled:
+            self._spill_end = 0
+        memory = self._memory
+        while memory and self._is_acked(memory[0]):
+            self._memory_size -= len(memory.popleft()[2])
+
+    def unacked(self, after=None):
+        """
+        Yield the data that hasn't been acknowledged, oldest first. With
+        `after`, a dict of partition to sequence number, data up to that
+        sequence number in its partition is skipped too.
+        """
+        after = after or {}
+        for entry in list(self._spilled):
+            if not self._is_acked(entry, after):
+                self._file.seek(entry[2])
+                yield self._file.read(entry[3])
+        for entry in list(self._memory):
+            if not self._is_acked(entry, after):
+                yield entry[2]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _is_acked(self, entry, after=None):
+        acked = self._acked.get(entry[0])
+        if acked is not None and entry[1] <= acked:
+            return True
+        if after:
+            resumed = after.get(entry[0])
+            return resumed is not None and entry[1] <= resumed
+        return False
+
+    def _spill(self, entry):
+        partition, sequence, data = entry
+        spilled = self._spilled
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix="wallaroo-replay-")
+        if spilled and self._spill_end - spilled[0][2] + len(data) > self._max_spill:
+            dropped = 0
+            while (spilled and
+                   self._spill_end - spilled[0][2] + len(data) > self._max_spill):
+                spilled.popleft()
+                dropped += 1
+            _log.warning("Replay buffer full, dropped the {} oldest "
+                         "unacknowledged writes", dropped)
+            self._compact()
+        if len(data) > self._max_spill:
+            _log.warning("Replay buffer full, dropped a write of {} bytes",
+                         len(data))
+            return
+        self._file.seek(self._spill_end)
+        self._file.write(data)
+        self._spilled.append((partition, sequence, self._spill_end, len(data)))
+        self._spill_end += len(data)
+
+    def _compact(self):
+        # Move the spilled data that is left to the start of the file, so
+        # the file doesn't grow past max_spill.
+        spilled = self._spilled
+        if not spilled:
+            self._spill_end = 0
+            return
+        start = spilled[0][2]
+        self._file.seek(start)
+        data = self._file.read(self._spill_end - start)
+        self._file.seek(0)
+        self._file.write(data)
+        self._file.truncate(len(data))
+        self._spilled = collections.deque(
+            (p, s, offset - start, size) for (p, s, offset, size) in spilled)
+        self._spill_end = len(data)
+
+
+class _SendBuffer(object):
+    """
+    Sends the data written to it over `conn` from a background thread, in
+    batches of up to `batch_size` bytes. A batch is sent as soon as it is
+    full or `linger` seconds after its first write, whichever comes first.
+    `write` blocks while `buffer_size` bytes are waiting to be sent.
+
+    The socket calls release the GIL, so the writer keeps encoding while a
+    batch is being sent.
+    """
+    def __init__(self, conn, batch_size=DEFAULT_SEND_BATCH_SIZE,
+                 linger=DEFAULT_SEND_LINGER,
+                 buffer_size=DEFAULT_SEND_BUFFER_SIZE):
+        self._conn = conn
+        self._batch_size = batch_size
+        self._linger = linger
+        self._buffer_size = max(buffer_size, batch_size)
+        self._cond = threading.Condition(threading.Lock())
+        self._pending = []
+        self._pending_size = 0
+        self._first_write = 0
+        self._sending = False
+        self._flushing = 0
+        self._closed = False
+        self._error = None
+        self._thread = threading.Thread(target=self._run,
+                                        name="wallaroo-source-sender")
+        self._thread.daemon = True
+        self._thread.start()
+        # The sender is a daemon thread, so whatever it hasn't sent yet
+        # would be lost when the connector script exits.
+        atexit.register(self._close_at_exit)
+
+    def write(self, data):
+        with self._cond:
+            while self._pending_size >= self._buffer_size:
+                self._check()
+                self._cond.wait()
+            self._check()
+            if not self._pending:
+                self._first_write = time.time()
+                self._cond.notify_all()
+            self._pending.append(data)
+            size = self._pending_size + len(data)
+            self._pending_size = size
+            if size >= self._batch_size > size - len(data):
+                self._cond.notify_all()
+
+    def flush(self):
+        with self._cond:
+            self._flushing += 1
+            try:
+                self._cond.notify_all()
+                while self._pending or self._sending:
+                    self._check()
+                    self._cond.wait()
+                self._check()
+            finally:
+                self._flushing -= 1
+
+    def close(self):
+        if self._closed:
+            return
+        try:
+            self.flush()
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
 
-    def __init__(self, args=None, required_params=[], optional_params=[]):
-        params = parse_connector_args(args or sys.argv, required_params, optional_params)
-        wallaroo_app = __import__(params.application)
-        actions = wallaroo_app.application_setup(args or sys.argv)
+    def _close_at_exit(self):
         try:
-            (_command, _name, port, _encoder, decoder) = next(
-                action for action in actions
-                if action[0] == "sink_connector" and action[1] == params.connector_name)
-        except:
-            raise RuntimeError("Unable to find a sink connector with the name " + params.connector_name)
+            self.close()
+        except Exception:
+            # The connection is gone; there is nowhere left to send to.
+            pass
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+        if self._closed:
+            raise RuntimeError("The connector has been closed")
+
+    def _run(self):
+        cond = self._cond
+        with cond:
+            while not self._closed:
+                if not self._pending:
+                    cond.wait()
+                    continue
+                deadline = self._first_write + self._linger
+                while (self._pending_size < self._batch_size and
+                       not self._flushing and not self._closed):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    cond.wait(remaining)
+                batch = self._pending
+                self._pending = []
+                self._pending_size = 0
+                self._sending = True
+                cond.notify_all()
+                cond.release()
+                try:
+                    self._conn.sendall(b''.join(batch))
+                except Exception as err:
+                    self._error = err
+                finally:
+                    cond.acquire()
+                    self._sending = False
+                    cond.notify_all()
+                if self._error is not None:
+                    return
+
+
+# Each recv on a sink connection asks for up to DEFAULT_RECV_SIZE bytes.
+DEFAULT_RECV_SIZE = 256 * 1024
+
+# BatchingSinkConnector hands on batches of up to DEFAULT_BATCH_MAX_ITEMS
+# messages, waiting up to DEFAULT_BATCH_MAX_WAIT seconds for one to fill.
+DEFAULT_BATCH_MAX_ITEMS = 500
+DEFAULT_BATCH_MAX_WAIT = 0.1
+
+
+class SinkConnector(object):
+    """
+    Reads the messages Wallaroo workers send to a sink connector. Any
+    number of workers can connect: their sockets are watched with
+    `selectors.DefaultSelector` (epoll on Linux), and connections with
+    data waiting are kept in a queue, so the cost of reading a message
+    doesn't depend on the number of connections.
+
+    On Python 3 the connector is also an asynchronous iterator, to read
+    messages from asyncio code:
+
+        async for message in connector:
+            ...
+    """
+
+    def __init__(self, args=None, required_params=[], optional_params=[],
+                 recv_size=DEFAULT_RECV_SIZE):
+        (params, port, _encoder, decoder) = _find_connector(
+            "sink", args, required_params, optional_params)
         self.params = params
+        self._init_reader(decoder, port, recv_size)
+
+    def _init_reader(self, decoder, port, recv_size):
         self._decoder = decoder
+        self._decode_view = _view_decoder(decoder)
         self._host = '127.0.0.1'
         self._port = port
+        self._recv_size = recv_size
         self._acceptor = None
-        self._connections = []
+        self._poller = _Poller()
         self._buffers = {}
-        self._pending = []
+        # Buffers that may hold a complete message, each queued once.
+        self._ready = collections.deque()
 
-    def listen(self, host=None, port=None, backlog=0):
+    def listen(self, host=None, port=None, backlog=socket.SOMAXCONN):
         acceptor = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         acceptor.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         acceptor.bind((host or self._host, int(port or self._port)))
         acceptor.listen(backlog)
+        acceptor.setblocking(0)
         self._acceptor = acceptor
-        self._connections.append(acceptor)
+        self._poller.register(acceptor)
 
     def read(self, timeout=None):
         while True:
-            for socket in self._pending:
-                ok, message = self._read_one(socket)
-                if ok: return message
-            self._select_any(timeout)
-
-    def _select_any(self, timeout=None):
-        readable, _, exceptional = select(self._connections, [], self._connections, timeout)
-        for socket in exceptional:
-            if socket is self._acceptor:
-                socket.close()
-                raise UnexpectedSocketError()
+            ok, message = self._read_ready()
+            if ok: return message
+            self._poll(timeout)
+
+    def read_batch(self, max_items, max_wait=0):
+        """
+        Wait for a message, then keep reading until `max_items` messages
+        have been read or `max_wait` seconds have passed, and return the
+        list of messages read. With the default `max_wait` of 0 the batch
+        is whatever had already been received along with the first
+        message. A `max_items` of 0 or less returns an empty list straight
+        away.
+        """
+        if max_items <= 0:
+            return []
+        batch = [self.read()]
+        deadline = time.time() + max_wait
+        last_poll = False
+        while len(batch) < max_items:
+            ok, message = self._read_ready()
+            if ok:
+                batch.append(message)
+            elif last_poll:
+                break
             else:
-                self._teardown_connection(socket)
-        for socket in readable:
-            if socket is self._acceptor:
-                conn, _addr = socket.accept()
-                self._setup_connection(conn)
+                remaining = deadline - time.time()
+                last_poll = remaining <= 0
+                self._poll(max(remaining, 0))
+        return batch
+
+    def close(self):
+        for conn in list(self._buffers):
+            self._close_connection(conn)
+        if self._acceptor is not None:
+            self._poller.unregister(self._acceptor)
+            self._acceptor.close()
+            self._acceptor = None
+        self._poller.close()
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        import asyncio
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        ok, message = self._read_ready()
+        if ok:
+            future.set_result(message)
+        else:
+            fd = self._poller.fileno()
+            loop.add_reader(fd, self._read_when_ready, loop, fd, future)
+        return future
+
+    def _read_when_ready(self, loop, fd, future):
+        if future.cancelled():
+            loop.remove_reader(fd)
+            return
+        try:
+            self._poll(0)
+            ok, message = self._read_ready()
+        except Exception as err:
+            loop.remove_reader(fd)
+            future.set_exception(err)
+            return
+        if ok:
+            loop.remove_reader(fd)
+            future.set_result(message)
+
+    def _read_ready(self):
+        ready = self._ready
+        while ready:
+            ok, message = self._read_one(ready[0])
+            if ok: return (True, message)
+        return (False, None)
+
+    def _poll(self, timeout=None):
+        for sock in self._poller.poll(timeout):
+            if sock is self._acceptor:
+                self._accept()
             else:
-                buffered = self._buffers[socket] + socket.recv(4096)
-                self._buffers[socket] = buffered
-                self._pending.append(socket)
+                self._receive(sock)
 
-    def _read_one(self, socket):
-        buffered = self._buffers[socket]
+    def _accept(self):
+        try:
+            conn, _addr = self._acceptor.accept()
+        except socket.error as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR,
+                             errno.ECONNABORTED):
+                return
+            self._poller.unregister(self._acceptor)
+            self._acceptor.close()
+            self._acceptor = None
+            raise UnexpectedSocketError()
+        self._setup_connection(conn)
+
+    def _receive(self, conn):
+        buffered = self._buffers[conn]
+        try:
+            received = buffered.recv_from(conn, self._recv_size)
+        except socket.error as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            # Reset by the worker: treat it like a close.
+            received = 0
+        if received == 0:
+            # Whatever was received before the close can still be read.
+            self._poller.unregister(conn)
+            conn.close()
+            buffered.closed = True
+        if not buffered.queued:
+            buffered.queued = True
+            self._ready.append(buffered)
+
+    def _read_one(self, buffered):
+        # `buffered` is the first buffer in the ready queue.
         header_len = self._decoder.header_length()
-        if len(buffered) < header_len:
-            self._buffers[socket] = buffered
-            return (False, None)
-        expected = self._decoder.payload_length(buffered[:header_len])
-        if len(buffered) < header_len + expected:
-            self._buffers[socket] = buffered
-            return (False, None)
-        data = buffered[header_len:header_len+expected]
-        buffered = buffered[header_len + expected:]
-        self._buffers[socket] = buffered
-        if len(buffered) < header_len:
-            self._pending.remove(socket)
-        return (True, self._decoder.decode(data))
+        if len(buffered) >= header_len:
+            expected = self._decoder.payload_length(buffered.peek(header_len))
+            if len(buffered) >= header_len + expected:
+                buffered.skip(header_len)
+                return (True, self._decode_view(buffered.view(expected)))
+        self._ready.popleft()
+        buffered.queued = False
+        if buffered.closed:
+            del self._buffers[buffered.conn]
+        return (False, None)
 
     def _setup_connection(self, conn):
         conn.setblocking(0)
-        self._connections.append(conn)
-        self._buffers[conn] = b""
-
-    def _teardown_connection(self, conn):
-        self._connections.remove(conn)
-        del self._buffers[conn]
-        conn.close()
+        self._poller.register(conn)
+        self._buffers[conn] = _ReadBuffer(self._recv_size, conn)
+
+    def _close_connection(self, conn):
+        buffered = self._buffers.pop(conn)
+        if buffered.queued:
+            self._ready.remove(buffered)
+        if not buffered.closed:
+            self._poller.unregister(conn)
+            conn.close()
+
+
+class BatchingSinkConnector(SinkConnector):
+    """
+    A sink connector that hands messages on in batches, for sinks where a
+    round trip per message would limit throughput:
+
+        connector = BatchingSinkConnector(max_items=500, max_wait=0.1)
+        connector.listen()
+        connector.run(lambda batch: client.put_records(...))
+
+    A batch is handed on once it has `max_items` messages or `max_wait`
+    seconds after its first message arrived, whichever comes first.
+    """
+    def __init__(self, args=None, required_params=[], optional_params=[],
+                 recv_size=DEFAULT_RECV_SIZE,
+                 max_items=DEFAULT_BATCH_MAX_ITEMS,
+                 max_wait=DEFAULT_BATCH_MAX_WAIT):
+        if max_items < 1:
+            raise ValueError(
+                "max_items must be at least 1, got {!r}".format(max_items))
+        super(BatchingSinkConnector, self).__init__(
+            args, required_params, optional_params, recv_size)
+        self._max_items = max_items
+        self._max_wait = max_wait
+
+    def read_batch(self, max_items=None, max_wait=None):
+        return super(BatchingSinkConnector, self).read_batch(
+            self._max_items if max_items is None else max_items,
+            self._max_wait if max_wait is None else max_wait)
+
+    def run(self, flush_batch):
+        """
+        Call `flush_batch` with every batch read, forever.
+        """
+        while True:
+            flush_batch(self.read_batch())
+
+
+def _view_decoder(decoder):
+    # Returns a function decoding a memoryview of a message in a receive
+    # buffer. A connector decoder's message is sliced out of the view with
+    # one copy; other decoders are given a copy of the whole message.
+    if isinstance(decoder, wallaroo.ConnectorDecoder):
+        func = decoder.decoder()
+        message = wallaroo.ConnectorCodec().message
+        return lambda view: func(message(view))
+    return lambda view: decoder.decode(view.tobytes())
+
+
+class _Poller(object):
+    """
+    Waits for any of a set of sockets to become readable, with
+    `selectors.DefaultSelector` or, on Python 2, `select.epoll` or
+    `select.poll`.
+    """
+    def __init__(self):
+        self._sockets = {}
+        self._selector = None
+        self._poll = None
+        if selectors is not None:
+            self._selector = selectors.DefaultSelector()
+        elif hasattr(select, 'epoll'):
+            # Timeouts in seconds, -1 to wait forever.
+            self._poll = select.epoll()
+            self._forever = -1
+            self._timeout_scale = 1
+        else:
+            # Timeouts in milliseconds, None to wait forever.
+            self._poll = select.poll()
+            self._forever = None
+            self._timeout_scale = 1000
+
+    def register(self, sock):
+        if self._selector is not None:
+            self._selector.register(sock, selectors.EVENT_READ)
+        else:
+            self._sockets[sock.fileno()] = sock
+            self._poll.register(sock.fileno(), select.POLLIN)
+
+    def unregister(self, sock):
+        if self._selector is not None:
+            self._selector.unregister(sock)
+        else:
+            del self._sockets[sock.fileno()]
+            self._poll.unregister(sock.fileno())
+
+    def poll(self, timeout=None):
+        if self._selector is not None:
+            return [key.fileobj for key, _ in self._selector.select(timeout)]
+        if timeout is None:
+            timeout = self._forever
+        else:
+            timeout *= self._timeout_scale
+        try:
+            events = self._poll.poll(timeout)
+        except (IOError, select.error) as err:
+            if err.args[0] == errno.EINTR:
+                return []
+            raise
+        sockets = self._sockets
+        return [sockets[fd] for fd, _ in events]
+
+    def fileno(self):
+        if self._selector is not None:
+            return self._selector.fileno()
+        return self._poll.fileno()
+
+    def close(self):
+        if self._selector is not None:
+            self._selector.close()
+        elif hasattr(self._poll, 'close'):
+            self._poll.close()
+
+
+class _ReadBuffer(object):
+    """
+    The bytes received on one connection that haven't been read yet. They
+    are received straight into a bytearray and read from a cursor, so
+    reading a message copies only that message, and the unread bytes are
+    only moved when more room is needed.
+    """
+    def __init__(self, size, conn=None):
+        self.conn = conn
+        self.data = bytearray(size)
+        self.start = 0
+        self.end = 0
+        self.closed = False
+        self.queued = False
+
+    def __len__(self):
+        return self.end - self.start
+
+    def recv_from(self, conn, size):
+        if len(self.data) - self.end < size:
+            self._make_room(size)
+        received = conn.recv_into(memoryview(self.data)[self.end:], size)
+        self.end += received
+        return received
+
+    def peek(self, n):
+        return memoryview(self.data)[self.start:self.start + n].tobytes()
+
+    def skip(self, n):
+        self.start += n
+
+    def take(self, n):
+        start = self.start
+        data = memoryview(self.data)[start:start + n].tobytes()
+        self.start = start + n
+        if self.start == self.end:
+            self.start = self.end = 0
+        return data
+
+    def view(self, n):
+        """
+        Like `take`, but return a memoryview of the bytes instead of a
+        copy. It is only valid until the next `recv_from`.
+        """
+        start = self.start
+        view = memoryview(self.data)[start:start + n]
+        self.start = start + n
+        if self.start == self.end:
+            self.start = self.end = 0
+        return view
+
+    def _make_room(self, size):
+        used = self.end - self.start
+        if used + size <= len(self.data):
+            self.data[:used] = self.data[self.start:self.end]
+        else:
+            data = bytearray(max(2 * len(self.data), used + size))
+            data[:used] = self.data[self.start:self.end]
+            self.data = data
+        self.start = 0
+        self.end = used
 
 
 class UnexpectedSocketError(Exception):
     pass
 
 
+def _find_connector(kind, args, required_params, optional_params):
+    # Returns the parsed parameters and the port, encoder and decoder of
+    # the "source" or "sink" connector named on the command line.
+    params = parse_connector_args(args or sys.argv, required_params, optional_params)
+    wallaroo_app = __import__(params.application)
+    actions = wallaroo_app.application_setup(args or sys.argv)
+    try:
+        (_command, _name, port, encoder, decoder) = next(
+            action for action in actions
+            if action[0] == kind + "_connector" and action[1] == params.connector_name)
+    except:
+        raise RuntimeError("Unable to find a {} connector with the name {}".format(
+            kind, params.connector_name))
+    return (params, port, encoder, decoder)
+
+
 def parse_connector_args(args, required_params=[], optional_params=[]):
     connector_prefix = _parse_connector_prefix(args) or 'CONNECTOR_NAME'
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--application-module', dest='application', required=True)
     parser.add_argument('--connector', dest='connector_name', required=True)
@@ -200,6 +1016,7 @@ def parse_connector_args(args, required_params=[], optional_params=[]):
 
 
 def _parse_connector_prefix(args):
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--connector', dest='connector_name')
     params = parser.parse_known_args(args)[0]
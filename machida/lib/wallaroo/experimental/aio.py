@@ -0,0 +1,217 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Source and sink connectors for asyncio, built on asyncio streams, so one
+connector process can serve several upstream or downstream connections
+from a single thread. Requires Python 3.5 or later.
+
+    async def main():
+        connector = AsyncSourceConnector(required_params=['topics'])
+        await connector.connect()
+        async for record in subscription:
+            await connector.write(record)
+
+`write` waits with `StreamWriter.drain()` whenever the connection's send
+buffer is full, so a producer is slowed down to the rate Wallaroo reads
+at. A sink connector stops reading from its connections while
+`queue_size` decoded messages are waiting to be read, so Wallaroo is
+slowed down to the rate the sink is read at.
+
+`AsyncSourceConnector` numbers messages and reads the sequence numbers
+a resilient Wallaroo acknowledges, like `SourceConnector`, but it doesn't
+keep messages to send again after a worker restarts or rolls back. Use
+`SourceConnector` where messages must be replayed.
+"""
+
+import asyncio
+import struct
+
+from wallaroo.experimental import (
+    _ACK, _find_connector, _parse_sequences, _partition_key)
+
+
+DEFAULT_QUEUE_SIZE = 1000
+
+
+class AsyncSourceConnector(object):
+    def __init__(self, args=None, required_params=[], optional_params=[]):
+        (params, port, encoder, _decoder) = _find_connector(
+            "source", args, required_params, optional_params)
+        self.params = params
+        self._init_writer(encoder, port)
+
+    def _init_writer(self, encoder, port):
+        self._encoder = encoder
+        self._host = '127.0.0.1'
+        self._port = port
+        self._writer = None
+        self._reading = None
+        # The last sequence number written, and the last acknowledged by
+        # Wallaroo, for each partition.
+        self._sequences = {}
+        self._acked = {}
+
+    async def connect(self, host=None, port=None):
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_connection(
+                    host or self._host, int(port or self._port))
+                break
+            except ConnectionRefusedError:
+                await asyncio.sleep(1)
+        # Read what Wallaroo sends, so it never waits for us to.
+        self._reading = asyncio.ensure_future(self._read_sequences(reader))
+
+    async def write(self, message, partition=None, sequence=None):
+        """
+        Encode and send `message`, waiting if the send buffer is full.
+        Partitions and sequence numbers work as they do for
+        `SourceConnector.write`.
+        """
+        self.write_nowait(message, partition, sequence)
+        await self._writer.drain()
+
+    async def write_many(self, messages, partition=None, sequences=None):
+        self._check()
+        messages = list(messages)
+        if not messages:
+            return
+        key = _partition_key(partition)
+        if sequences is None:
+            first = self._sequences.get(key, -1) + 1
+            sequences = list(range(first, first + len(messages)))
+        else:
+            sequences = list(sequences)
+        self._sequences[key] = sequences[-1]
+        self._writer.write(
+            self._encoder.encode_many(messages, partition, sequences))
+        await self._writer.drain()
+
+    def write_nowait(self, message, partition=None, sequence=None):
+        """
+        Encode and buffer `message` without waiting, for callbacks that
+        can't wait. Call `drain` from a coroutine to wait for the send
+        buffer to empty.
+        """
+        self._check()
+        key = _partition_key(partition)
+        if sequence is None:
+            sequence = self._sequences.get(key, -1) + 1
+        self._sequences[key] = sequence
+        self._writer.write(self._encoder.encode(message, partition, sequence))
+
+    def acked(self):
+        """
+        Return the last sequence number Wallaroo has acknowledged for each
+        partition, keyed by the partition as a string.
+        """
+        return dict(self._acked)
+
+    async def drain(self):
+        self._check()
+        await self._writer.drain()
+
+    async def close(self):
+        if self._reading is not None:
+            self._reading.cancel()
+            self._reading = None
+        if self._writer is not None:
+            writer = self._writer
+            self._writer = None
+            await writer.drain()
+            writer.close()
+            if hasattr(writer, 'wait_closed'):
+                await writer.wait_closed()
+
+    def _check(self):
+        if self._writer is None:
+            raise RuntimeError("Please call connect before writing")
+
+    async def _read_sequences(self, reader):
+        # Frames of sequence numbers, as read by
+        # wallaroo.experimental._read_sequences.
+        try:
+            while True:
+                header = await reader.readexactly(5)
+                size, kind = struct.unpack('<IB', header)
+                sequences = _parse_sequences(
+                    await reader.readexactly(size - 1))
+                if kind == _ACK:
+                    self._acked.update(sequences)
+                for key, sequence in sequences.items():
+                    # Keep counting from where Wallaroo is if we restarted.
+                    if self._sequences.get(key, -1) < sequence:
+                        self._sequences[key] = sequence
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # Closed by Wallaroo; the next write fails.
+            pass
+
+
+class AsyncSinkConnector(object):
+    def __init__(self, args=None, required_params=[], optional_params=[],
+                 queue_size=DEFAULT_QUEUE_SIZE):
+        (params, port, _encoder, decoder) = _find_connector(
+            "sink", args, required_params, optional_params)
+        self.params = params
+        self._init_reader(decoder, port, queue_size)
+
+    def _init_reader(self, decoder, port, queue_size):
+        self._decoder = decoder
+        self._host = '127.0.0.1'
+        self._port = port
+        self._queue_size = queue_size
+        self._queue = None
+        self._server = None
+        self._connections = set()
+
+    async def listen(self, host=None, port=None):
+        self._queue = asyncio.Queue(self._queue_size)
+        self._server = await asyncio.start_server(
+            self._read_connection, host or self._host, int(port or self._port))
+
+    async def read(self):
+        return await self._queue.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._queue.get()
+
+    async def close(self):
+        for writer in list(self._connections):
+            writer.close()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _read_connection(self, reader, writer):
+        header_length = self._decoder.header_length()
+        payload_length = self._decoder.payload_length
+        decode = self._decoder.decode
+        put = self._queue.put
+        self._connections.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(header_length)
+                data = await reader.readexactly(payload_length(header))
+                await put(decode(data))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # Closed by Wallaroo.
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
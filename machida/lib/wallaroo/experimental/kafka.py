@@ -0,0 +1,262 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Reads a kafka-python `KafkaConsumer` into a source connector in batches,
+used by `connectors/kafka_source`:
+
+    consumer = KafkaConsumer(group_id=group, enable_auto_commit=False)
+    source = KafkaSource(consumer, connector)
+    source.subscribe([topic])
+    source.run()
+
+Each `poll` returns up to `max_records` records, which are written with
+one `write_many` per partition, with the partition as `topic:partition`
+and the offsets as sequence numbers. Records without a value (deletion
+markers in compacted topics) are skipped. Offsets are committed to Kafka
+without auto-commit:
+
+- with `commit='flush'`, once the batch has been sent to Wallaroo;
+- with `commit='ack'`, once Wallaroo has acknowledged them, which a
+  resilient Wallaroo does when a checkpoint including them is committed;
+- and for the partitions this consumer loses in a rebalance, before they
+  are handed to another consumer, when subscribed with `subscribe`.
+
+Every `report_interval` seconds the throughput and consumer lag of each
+partition are logged at info, and `metrics()` returns them.
+"""
+
+# So `kafka` is kafka-python rather than this module on Python 2.
+from __future__ import absolute_import
+
+import time
+
+import wallaroo.log
+
+
+DEFAULT_MAX_RECORDS = 5000
+DEFAULT_POLL_TIMEOUT = 0.1
+DEFAULT_REPORT_INTERVAL = 10.0
+
+_log = wallaroo.log.logger("wallaroo.experimental.kafka")
+
+
+class KafkaSource(object):
+    def __init__(self, consumer, connector, max_records=DEFAULT_MAX_RECORDS,
+                 poll_timeout=DEFAULT_POLL_TIMEOUT, commit='flush',
+                 report_interval=DEFAULT_REPORT_INTERVAL, stats=None,
+                 offset_type=None):
+        if commit not in ('flush', 'ack'):
+            raise ValueError(
+                "commit must be 'flush' or 'ack', got {!r}".format(commit))
+        if offset_type is None:
+            from kafka.structs import OffsetAndMetadata as offset_type
+        self._consumer = consumer
+        self._connector = connector
+        self._max_records = max_records
+        self._poll_timeout_ms = int(poll_timeout * 1000)
+        self._commit = commit
+        self._report_interval = report_interval
+        self._stats = stats
+        self._offset_type = offset_type
+        # Per TopicPartition: the next offset to read, the first offset
+        # read since it was assigned, the offset last committed, and the
+        # messages and bytes read so far.
+        self._positions = {}
+        self._first_offsets = {}
+        self._committed = {}
+        self._counts = {}
+        self._partitions = {}
+        self._lag = {}
+        self._stopping = False
+
+    def run(self):
+        """
+        Read until `stop` is called, then commit what has been sent or
+        acknowledged.
+        """
+        next_report = time.time() + self._report_interval
+        last_counts = {}
+        try:
+            while not self._stopping:
+                self.poll()
+                now = time.time()
+                if now >= next_report:
+                    counts = dict(self._counts)
+                    self._update_lag()
+                    self._report(last_counts, counts,
+                                 now - next_report + self._report_interval)
+                    last_counts = counts
+                    next_report = now + self._report_interval
+        finally:
+            self._connector.flush()
+            self._commit_offsets(sync=True)
+
+    def stop(self):
+        self._stopping = True
+
+    def subscribe(self, topics, listener_type=None):
+        """
+        Subscribe the consumer to `topics`, with a rebalance listener that
+        calls `on_partitions_revoked`.
+        """
+        if listener_type is None:
+            from kafka import ConsumerRebalanceListener as listener_type
+        self._consumer.subscribe(
+            topics, listener=_rebalance_listener(self, listener_type))
+
+    def on_partitions_revoked(self, revoked):
+        """
+        Commit what can be committed for the partitions in `revoked`, and
+        forget them.
+        """
+        revoked = [tp for tp in revoked if tp in self._positions]
+        if not revoked:
+            return
+        try:
+            if self._commit == 'flush':
+                self._connector.flush()
+            self._commit_offsets(sync=True, partitions=revoked)
+        except Exception as err:
+            # The new owner reads from the last committed offsets.
+            _log.warning("Committing revoked partitions failed: {!r}", err)
+        for tp in revoked:
+            for partitions in (self._positions, self._first_offsets,
+                               self._committed, self._counts, self._lag):
+                partitions.pop(tp, None)
+
+    def poll(self):
+        """
+        Poll for a batch of records, write them, and commit the offsets
+        that can be committed.
+        """
+        batch = self._consumer.poll(timeout_ms=self._poll_timeout_ms,
+                                    max_records=self._max_records)
+        for tp, records in batch.items():
+            if not records:
+                continue
+            if tp not in self._first_offsets:
+                self._first_offsets[tp] = records[0].offset
+            next_offset = records[-1].offset + 1
+            # Deletion markers have no value to send.
+            records = [record for record in records
+                       if record.value is not None]
+            values = [record.value for record in records]
+            if values:
+                self._connector.write_many(
+                    values, partition=self._partition_name(tp),
+                    sequences=[record.offset for record in records])
+            self._positions[tp] = next_offset
+            size = sum(len(v) for v in values)
+            messages, total = self._counts.get(tp, (0, 0))
+            self._counts[tp] = (messages + len(values), total + size)
+            if self._stats is not None:
+                self._stats.add(len(values), size)
+        if batch and self._commit == 'flush':
+            self._connector.flush()
+            self._commit_offsets()
+        elif self._commit == 'ack':
+            self._commit_offsets()
+
+    def metrics(self):
+        """
+        Return the messages and bytes read from each partition, and its
+        lag as of the last report, keyed by `topic:partition`.
+        """
+        return dict(
+            (self._partition_name(tp),
+             {'messages': messages, 'bytes': size,
+              'lag': self._lag.get(tp)})
+            for tp, (messages, size) in self._counts.items())
+
+    def _partition_name(self, tp):
+        name = self._partitions.get(tp)
+        if name is None:
+            name = u'{}:{}'.format(tp.topic, tp.partition)
+            self._partitions[tp] = name
+        return name
+
+    def _offsets_to_commit(self, partitions):
+        if self._commit == 'flush':
+            positions = dict((tp, self._positions[tp]) for tp in partitions)
+        else:
+            acked = self._connector.acked()
+            positions = {}
+            for tp in partitions:
+                sequence = acked.get(self._partition_name(tp))
+                # An acknowledgement from before the partition was last
+                # assigned to us would take the group's offset back.
+                if (sequence is not None and
+                        sequence >= self._first_offsets[tp]):
+                    positions[tp] = sequence + 1
+        return dict((tp, offset) for tp, offset in positions.items()
+                    if self._committed.get(tp) != offset)
+
+    def _commit_offsets(self, sync=False, partitions=None):
+        if partitions is None:
+            partitions = list(self._positions)
+        offsets = self._offsets_to_commit(partitions)
+        if not offsets:
+            return
+        commit = dict((tp, self._offset(offset))
+                      for tp, offset in offsets.items())
+        # Recorded first, so a failure reported straight away is kept.
+        self._committed.update(offsets)
+        if sync:
+            self._consumer.commit(commit)
+        else:
+            self._consumer.commit_async(commit, callback=self._committed_async)
+
+    def _committed_async(self, offsets, response):
+        if isinstance(response, Exception):
+            # A later commit covers these offsets.
+            _log.warning("Committing offsets failed: {!r}", response)
+            for tp in offsets:
+                self._committed.pop(tp, None)
+
+    def _offset(self, offset):
+        # Newer kafka-python versions add a leader epoch field.
+        extra = len(self._offset_type._fields) - 2
+        return self._offset_type(offset, '', *([-1] * extra))
+
+    def _update_lag(self):
+        partitions = list(self._positions)
+        if not partitions:
+            return
+        try:
+            ends = self._consumer.end_offsets(partitions)
+        except Exception as err:
+            _log.warning("Reading end offsets failed: {!r}", err)
+            return
+        for tp in partitions:
+            if tp in ends:
+                self._lag[tp] = max(0, ends[tp] - self._positions[tp])
+
+    def _report(self, before, after, elapsed):
+        for tp in sorted(after, key=self._partition_name):
+            messages = after[tp][0] - before.get(tp, (0, 0))[0]
+            _log.info("{}: {:.0f} msg/s, lag {}", self._partition_name(tp),
+                      messages / elapsed, self._lag.get(tp))
+
+
+def _rebalance_listener(source, listener_type):
+    # kafka-python only takes subclasses of its ConsumerRebalanceListener.
+    class RebalanceListener(listener_type):
+        def on_partitions_revoked(self, revoked):
+            source.on_partitions_revoked(revoked)
+
+        def on_partitions_assigned(self, assigned):
+            pass
+
+    return RebalanceListener()
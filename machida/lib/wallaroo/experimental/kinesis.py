@@ -0,0 +1,338 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Reads every shard of a Kinesis stream into a source connector, used by
+`connectors/kinesis_source`:
+
+    source = KinesisSource(boto3.client('kinesis'), stream, connector,
+                           checkpoint_path='kinesis.json')
+    source.run()
+
+Shards are discovered with `ListShards` and each one is read by its own
+thread, in batches of up to `limit` records. A shard is polled as often as
+Kinesis allows (5 times a second) while it has records or is behind the
+tip of the stream, and less and less often, down to `max_poll_interval`,
+while it is idle.
+
+When a shard is split or merged, the new shards are only read once the
+shards they came from have been read to the end, so records with the same
+partition key stay in order. The last sequence number read from each
+shard, and the shards that have been read to the end, are saved to
+`checkpoint_path` so a restarted connector carries on where it left off.
+
+With `workers` > 1, each of that many processes reads the shards whose id
+hashes to its `worker` index, and saves its checkpoints to
+`checkpoint_path.<worker>`.
+"""
+
+import json
+import os
+import threading
+import time
+import zlib
+
+import wallaroo.log
+
+
+DEFAULT_LIMIT = 10000
+DEFAULT_MAX_POLL_INTERVAL = 1.0
+DEFAULT_DISCOVERY_INTERVAL = 10.0
+DEFAULT_CHECKPOINT_INTERVAL = 1.0
+# Kinesis allows 5 GetRecords calls a second on each shard.
+MIN_POLL_INTERVAL = 0.2
+# How long to wait before restarting a shard reader that failed.
+READER_RETRY_DELAY = 5.0
+
+_THROTTLED = ('ProvisionedThroughputExceededException',
+              'LimitExceededException', 'ThrottlingException')
+_EXPIRED = 'ExpiredIteratorException'
+
+_log = wallaroo.log.logger("wallaroo.experimental.kinesis")
+
+
+class ShardCheckpoints(object):
+    """
+    The last sequence number read from each shard and the shards that have
+    been read to the end, saved as JSON to `path` (if not None) by `save`.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        # Held while writing the file.
+        self._save_lock = threading.Lock()
+        self._sequences = {}
+        self._finished = set()
+        # Counts the changes, and the changes that have been saved.
+        self._version = 0
+        self._saved_version = 0
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            self._sequences = saved.get('sequences', {})
+            self._finished = set(saved.get('finished', []))
+
+    def get(self, shard_id):
+        with self._lock:
+            return self._sequences.get(shard_id)
+
+    def is_finished(self, shard_id):
+        with self._lock:
+            return shard_id in self._finished
+
+    def update(self, shard_id, sequence):
+        with self._lock:
+            self._sequences[shard_id] = sequence
+            self._version += 1
+
+    def finish(self, shard_id):
+        with self._lock:
+            self._finished.add(shard_id)
+            self._sequences.pop(shard_id, None)
+            self._version += 1
+
+    def snapshot(self):
+        """
+        Return a copy of the checkpoints as they are now, for `save`.
+        """
+        with self._lock:
+            return (self._version,
+                    {'sequences': dict(self._sequences),
+                     'finished': sorted(self._finished)})
+
+    def save(self, snapshot=None):
+        """
+        Save `snapshot`, or the checkpoints as they are now, unless
+        something as recent has been saved already.
+        """
+        if snapshot is None:
+            snapshot = self.snapshot()
+        (version, saved) = snapshot
+        with self._save_lock:
+            if version <= self._saved_version or self.path is None:
+                return
+            # Replace the file in one step, so it is never half written.
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(saved, f)
+            os.rename(tmp, self.path)
+            self._saved_version = version
+
+
+class KinesisSource(object):
+    def __init__(self, client, stream, connector, checkpoint_path=None,
+                 starting_position='LATEST', limit=DEFAULT_LIMIT,
+                 max_poll_interval=DEFAULT_MAX_POLL_INTERVAL,
+                 discovery_interval=DEFAULT_DISCOVERY_INTERVAL,
+                 checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL,
+                 worker=0, workers=1, stats=None):
+        self._client = client
+        self._stream = stream
+        self._connector = connector
+        self._checkpoint_path = checkpoint_path
+        self._starting_position = starting_position
+        self._limit = limit
+        self._max_poll_interval = max(max_poll_interval, MIN_POLL_INTERVAL)
+        self._discovery_interval = discovery_interval
+        self._checkpoint_interval = checkpoint_interval
+        self._worker = worker
+        self._workers = workers
+        self._stats = stats
+        self.checkpoints = ShardCheckpoints(self._worker_path(worker))
+        self._readers = {}
+        self._retry_at = {}
+        self._discovered = False
+        self._stopping = False
+        # Set by readers when a shard has been read to the end or a reader
+        # failed, to discover shards again straight away.
+        self._wake = threading.Event()
+
+    def run(self):
+        """
+        Read until `stop` is called, discovering shards every
+        `discovery_interval` seconds and saving checkpoints every
+        `checkpoint_interval` seconds.
+        """
+        next_discovery = 0
+        next_checkpoint = time.time() + self._checkpoint_interval
+        try:
+            while not self._stopping:
+                now = time.time()
+                if now >= next_discovery or self._wake.is_set():
+                    self._wake.clear()
+                    try:
+                        self.discover()
+                    except Exception as err:
+                        _log.error("Discovering shards failed: {!r}, "
+                                   "retrying in {}s", err,
+                                   self._discovery_interval)
+                    next_discovery = now + self._discovery_interval
+                if now >= next_checkpoint:
+                    self.checkpoint()
+                    next_checkpoint = now + self._checkpoint_interval
+                self._wake.wait(max(0, min(next_discovery, next_checkpoint) -
+                                       time.time()))
+        finally:
+            self._stopping = True
+            for reader in list(self._readers.values()):
+                reader.join()
+            self.checkpoint()
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+
+    def checkpoint(self):
+        # Only save sequence numbers once what was read up to them has
+        # been sent. Readers carry on while we flush, so what is saved is
+        # taken before flushing.
+        snapshot = self.checkpoints.snapshot()
+        self._connector.flush()
+        self.checkpoints.save(snapshot)
+
+    def discover(self):
+        """
+        Start a reader for each shard this worker owns that isn't being
+        read, hasn't been read to the end, and whose parents have been read
+        to the end.
+        """
+        shards = self._list_shards()
+        listed = set(shard['ShardId'] for shard in shards)
+        now = time.time()
+        for shard in shards:
+            shard_id = shard['ShardId']
+            if (shard_id in self._readers or not self._owns(shard_id) or
+                    self.checkpoints.is_finished(shard_id) or
+                    self._retry_at.get(shard_id, 0) > now):
+                continue
+            parents = [p for p in (shard.get('ParentShardId'),
+                                   shard.get('AdjacentParentShardId'))
+                       if p in listed]
+            if not all(self._parent_finished(p) for p in parents):
+                continue
+            # New shards are read from the start, so nothing written to
+            # them before they were discovered is missed.
+            if parents or self._discovered:
+                position = 'TRIM_HORIZON'
+            else:
+                position = self._starting_position
+            reader = threading.Thread(
+                target=self._run_reader, args=(shard_id, position),
+                name="kinesis-{}".format(shard_id))
+            reader.daemon = True
+            self._readers[shard_id] = reader
+            reader.start()
+        self._discovered = True
+
+    def _list_shards(self):
+        shards = []
+        kwargs = {'StreamName': self._stream}
+        while True:
+            response = self._client.list_shards(**kwargs)
+            shards.extend(response['Shards'])
+            token = response.get('NextToken')
+            if not token:
+                return shards
+            # The stream name can't be given along with a token.
+            kwargs = {'NextToken': token}
+
+    def _owns(self, shard_id):
+        return self._owner(shard_id) == self._worker
+
+    def _owner(self, shard_id):
+        if self._workers == 1:
+            return 0
+        return (zlib.crc32(shard_id.encode('utf-8')) & 0xffffffff) % self._workers
+
+    def _worker_path(self, worker):
+        if self._checkpoint_path is None or self._workers == 1:
+            return self._checkpoint_path
+        return "{}.{}".format(self._checkpoint_path, worker)
+
+    def _parent_finished(self, shard_id):
+        owner = self._owner(shard_id)
+        if owner == self._worker:
+            return self.checkpoints.is_finished(shard_id)
+        path = self._worker_path(owner)
+        if path is None:
+            # We can't know how far another worker has got.
+            return True
+        return ShardCheckpoints(path).is_finished(shard_id)
+
+    def _run_reader(self, shard_id, position):
+        try:
+            self._read_shard(shard_id, position)
+        except Exception as err:
+            _log.error("Reading shard {} failed: {!r}, retrying in {}s",
+                       shard_id, err, READER_RETRY_DELAY)
+            self._retry_at[shard_id] = time.time() + READER_RETRY_DELAY
+        finally:
+            del self._readers[shard_id]
+            self._wake.set()
+
+    def _read_shard(self, shard_id, position):
+        client = self._client
+        iterator = self._shard_iterator(shard_id, position)
+        interval = MIN_POLL_INTERVAL
+        while not self._stopping:
+            started = time.time()
+            try:
+                response = client.get_records(ShardIterator=iterator,
+                                              Limit=self._limit)
+            except Exception as err:
+                code = _error_code(err)
+                if code == _EXPIRED:
+                    iterator = self._shard_iterator(shard_id, position)
+                    continue
+                if code not in _THROTTLED:
+                    raise
+                interval = min(2 * interval, self._max_poll_interval)
+                time.sleep(interval)
+                continue
+            records = response['Records']
+            if records:
+                data = [record['Data'] for record in records]
+                self._connector.write_many(data, partition=shard_id)
+                self.checkpoints.update(shard_id,
+                                        records[-1]['SequenceNumber'])
+                if self._stats is not None:
+                    self._stats.add(len(data), sum(len(d) for d in data))
+            iterator = response.get('NextShardIterator')
+            if iterator is None:
+                # The shard was split or merged and has been read to the
+                # end; its children can be read now.
+                self.checkpoints.finish(shard_id)
+                self.checkpoint()
+                return
+            if records or response.get('MillisBehindLatest', 0) > 0:
+                interval = MIN_POLL_INTERVAL
+            else:
+                interval = min(2 * interval, self._max_poll_interval)
+            time.sleep(max(0, interval - (time.time() - started)))
+
+    def _shard_iterator(self, shard_id, position):
+        kwargs = {'StreamName': self._stream, 'ShardId': shard_id}
+        sequence = self.checkpoints.get(shard_id)
+        if sequence is not None:
+            kwargs['ShardIteratorType'] = 'AFTER_SEQUENCE_NUMBER'
+            kwargs['StartingSequenceNumber'] = sequence
+        else:
+            kwargs['ShardIteratorType'] = position
+        return self._client.get_shard_iterator(**kwargs)['ShardIterator']
+
+
+def _error_code(err):
+    # botocore's ClientError keeps the error code in its response.
+    response = getattr(err, 'response', None) or {}
+    return response.get('Error', {}).get('Code')
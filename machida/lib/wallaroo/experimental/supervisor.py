@@ -0,0 +1,217 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Runs a source connector in several worker processes, so decoding and
+encoding aren't limited to one core by the GIL. Each worker owns a share
+of the partitions or shards being read and connects to Wallaroo on its
+own:
+
+    def read_shards(shards, stats):
+        connector = wallaroo.experimental.SourceConnector(...)
+        connector.connect()
+        while True:
+            records = ...
+            connector.write_many(records)
+            stats.add(len(records))
+
+    supervisor = ConnectorSupervisor(read_shards, shards, processes=4)
+    supervisor.run()
+
+Workers that exit are started again after a delay that doubles while they
+keep failing, and the supervisor logs the throughput of the workers every
+`report_interval` seconds.
+
+Workers are forked, so they inherit the command line and everything the
+script set up before calling `run`. A Wallaroo connector source accepts
+up to 10 connections by default.
+"""
+
+import ctypes
+import multiprocessing
+import signal
+import time
+
+import wallaroo.log
+
+
+DEFAULT_RESTART_DELAY = 1.0
+DEFAULT_MAX_RESTART_DELAY = 30.0
+DEFAULT_REPORT_INTERVAL = 10.0
+
+_log = wallaroo.log.logger("wallaroo.experimental.supervisor")
+
+
+def split(items, processes):
+    """
+    Split `items` into `processes` lists of about the same size, without
+    empty lists.
+    """
+    items = list(items)
+    processes = max(1, min(processes, len(items)))
+    return [items[i::processes] for i in range(processes)]
+
+
+class WorkerStats(object):
+    """
+    Message and byte counts for one worker, kept in memory shared with the
+    supervisor. Each worker only writes its own counts, so no lock is
+    needed.
+    """
+    def __init__(self, counters, index):
+        self._counters = counters
+        self._index = 2 * index
+
+    def add(self, messages, size=0):
+        self._counters[self._index] += messages
+        self._counters[self._index + 1] += size
+
+    @property
+    def messages(self):
+        return self._counters[self._index]
+
+    @property
+    def bytes(self):
+        return self._counters[self._index + 1]
+
+
+class ConnectorSupervisor(object):
+    """
+    Calls `target(items, stats)` in each of `processes` worker processes,
+    where `items` is that worker's share of `items` and `stats` is a
+    `WorkerStats` to count what it sends. With no `items` the workers are
+    called with None, for sources that share out partitions themselves,
+    like Kafka consumer groups.
+    """
+    def __init__(self, target, items=None, processes=None,
+                 restart_delay=DEFAULT_RESTART_DELAY,
+                 max_restart_delay=DEFAULT_MAX_RESTART_DELAY,
+                 report_interval=DEFAULT_REPORT_INTERVAL):
+        if items is not None:
+            self._assignments = split(items, processes or len(items))
+        else:
+            self._assignments = [None] * (processes or
+                                          multiprocessing.cpu_count())
+        if hasattr(multiprocessing, 'get_context'):
+            self._context = multiprocessing.get_context('fork')
+        else:
+            # Python 2 always forks.
+            self._context = multiprocessing
+        self._target = target
+        self._restart_delay = restart_delay
+        self._max_restart_delay = max_restart_delay
+        self._report_interval = report_interval
+        count = len(self._assignments)
+        self._counters = self._context.Array(ctypes.c_ulonglong, 2 * count,
+                                             lock=False)
+        self._workers = [None] * count
+        self._started = [0] * count
+        self._delays = [restart_delay] * count
+        self._restart_at = [0] * count
+        self._stopping = False
+
+    def __len__(self):
+        return len(self._assignments)
+
+    def run(self, poll_interval=0.1):
+        """
+        Start the workers and keep them running until `stop` is called or
+        the supervisor gets SIGTERM or SIGINT, then stop them.
+        """
+        previous = signal.signal(signal.SIGTERM, self._stop_on_signal)
+        try:
+            for index in range(len(self)):
+                self._start(index)
+            last_report = time.time()
+            last_stats = self.stats()
+            while not self._stopping:
+                time.sleep(poll_interval)
+                self._check_workers()
+                now = time.time()
+                if now - last_report >= self._report_interval:
+                    stats = self.stats()
+                    self._report(last_stats, stats, now - last_report)
+                    last_report, last_stats = now, stats
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            self._stop_workers()
+
+    def stop(self):
+        self._stopping = True
+
+    def stats(self):
+        """
+        Return the (messages, bytes) sent so far by each worker, including
+        by the processes it replaced.
+        """
+        counters = self._counters[:]
+        return [(counters[2 * i], counters[2 * i + 1])
+                for i in range(len(self))]
+
+    def _stop_on_signal(self, signum, frame):
+        self.stop()
+
+    def _start(self, index):
+        worker = self._context.Process(
+            target=_run_worker,
+            args=(self._target, self._assignments[index],
+                  WorkerStats(self._counters, index)),
+            name="wallaroo-connector-{}".format(index))
+        worker.daemon = True
+        worker.start()
+        self._workers[index] = worker
+        self._started[index] = time.time()
+        self._restart_at[index] = 0
+
+    def _check_workers(self):
+        now = time.time()
+        for index, worker in enumerate(self._workers):
+            if self._restart_at[index]:
+                if now >= self._restart_at[index]:
+                    self._start(index)
+            elif not worker.is_alive():
+                worker.join()
+                if now - self._started[index] > self._max_restart_delay:
+                    # It had been running fine; start over.
+                    self._delays[index] = self._restart_delay
+                delay = self._delays[index]
+                self._delays[index] = min(2 * delay, self._max_restart_delay)
+                self._restart_at[index] = now + delay
+                _log.warning("Worker {} exited with code {}, restarting "
+                             "in {:.1f}s", index, worker.exitcode, delay)
+
+    def _report(self, before, after, elapsed):
+        rates = [(a[0] - b[0]) / elapsed for a, b in zip(after, before)]
+        size = sum(a[1] - b[1] for a, b in zip(after, before)) / elapsed
+        _log.info("{} workers: {:.0f} msg/s, {:.0f} bytes/s "
+                  "(per worker: {})", len(rates), sum(rates), size,
+                  ", ".join("{:.0f}".format(r) for r in rates))
+
+    def _stop_workers(self):
+        workers = [w for w in self._workers if w is not None]
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in workers:
+            worker.join()
+
+
+def _run_worker(target, items, stats):
+    # The supervisor stops the workers; don't let Ctrl-C in the terminal
+    # interrupt them first.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    target(items, stats)
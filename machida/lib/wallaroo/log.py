@@ -0,0 +1,275 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Levelled, sampled logging that is cheap enough to leave in computations.
+
+    log = wallaroo.log.logger("TraceID")
+
+    @wallaroo.computation(name="TraceID")
+    def trace_id(msg):
+        log.debug("trace_id({})", msg)
+        ...
+
+A call below the configured level returns after one comparison. A call at
+or above it is sampled: a logger with `sample=N` keeps one in every `N`
+debug and info records, and always keeps warnings and errors. The message
+of a kept record is formatted with `str.format` straight away, so later
+changes to its arguments don't show up in the log, and appended to a
+bounded in-memory ring buffer. A background thread adds the timestamp and
+writes the records out to `sys.stderr`, so computations never wait on
+output; if the buffer fills up the oldest records are dropped and the
+number dropped is logged.
+
+The level and sampling rates are usually set from the command line:
+
+    wallaroo.log.configure(*wallaroo.log_parse_options(args))
+
+with `--log-level debug` and `--log-sample 100` (one in 100 records for
+every logger) or `--log-sample TraceID=10,TraceWindow=1000`.
+"""
+
+import atexit
+import collections
+import os
+import sys
+import threading
+import time
+
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+OFF = 100
+
+LEVELS = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR,
+    'off': OFF}
+
+_LEVEL_NAMES = {
+    DEBUG: 'DEBUG',
+    INFO: 'INFO',
+    WARNING: 'WARNING',
+    ERROR: 'ERROR'}
+
+DEFAULT_BUFFER_SIZE = 10000
+
+_level = WARNING
+_sample = 1
+_stage_samples = {}
+_loggers = {}
+
+# deque.append is atomic, so loggers and the drain thread share the buffer
+# without a lock. A full deque drops its oldest entry on append.
+_buffer = collections.deque(maxlen=DEFAULT_BUFFER_SIZE)
+_dropped = 0
+_drainer_pid = None
+_drain_lock = threading.Lock()
+# Set when there are records to write out. Loggers only take its lock when
+# it isn't set already, which is at most once per drain.
+_pending = threading.Event()
+# Threads can't be started while Python shuts down, so records logged then
+# are written out straight away.
+_is_finalizing = getattr(sys, 'is_finalizing', lambda: False)
+
+
+class Logger(object):
+    def __init__(self, name, sample=None):
+        self.name = name
+        self._own_sample = sample
+        self._sample = _sample_for(name, sample)
+        self._count = 0
+
+    def debug(self, msg, *args):
+        if _level <= DEBUG:
+            self._sampled(DEBUG, msg, args)
+
+    def info(self, msg, *args):
+        if _level <= INFO:
+            self._sampled(INFO, msg, args)
+
+    def warning(self, msg, *args):
+        if _level <= WARNING:
+            _record(WARNING, self.name, msg, args)
+
+    def error(self, msg, *args):
+        if _level <= ERROR:
+            _record(ERROR, self.name, msg, args)
+
+    def log(self, level, msg, *args):
+        if _level <= level:
+            if level < WARNING:
+                self._sampled(level, msg, args)
+            else:
+                _record(level, self.name, msg, args)
+
+    def is_enabled_for(self, level):
+        return _level <= level
+
+    def _sampled(self, level, msg, args):
+        self._count += 1
+        if self._count >= self._sample:
+            self._count = 0
+            _record(level, self.name, msg, args)
+
+
+def logger(name, sample=None):
+    """
+    Returns the logger for `name`, usually the name of the stage it is used
+    in. `sample` is the default sampling rate for this logger; a rate given
+    for `name` to `configure` takes precedence over it.
+    """
+    log = _loggers.get(name)
+    if log is None:
+        log = _loggers[name] = Logger(name, sample)
+    elif sample is not None and sample != log._own_sample:
+        log._own_sample = sample
+        log._sample = _sample_for(name, sample)
+    return log
+
+
+def configure(level=None, sample=None, stage_samples=None,
+              buffer_size=None):
+    """
+    Change the level, the default sampling rate, the sampling rates of
+    individual loggers (a dict of name to rate) or the number of records
+    that can wait to be written out. Arguments left as `None` are
+    unchanged. Can be called at any time.
+    """
+    global _level, _sample, _stage_samples, _buffer
+    if level is not None:
+        if not isinstance(level, int):
+            level = LEVELS[level.lower()]
+        _level = level
+    if sample is not None:
+        _sample = _validate_sample(sample)
+    if stage_samples is not None:
+        _stage_samples = dict((name, _validate_sample(rate))
+                              for name, rate in stage_samples.items())
+    if buffer_size is not None and buffer_size != _buffer.maxlen:
+        drain()
+        _buffer = collections.deque(maxlen=buffer_size)
+    for log in _loggers.values():
+        log._sample = _sample_for(log.name, log._own_sample)
+
+
+def drain():
+    """
+    Write out every buffered record. This is done by a background thread
+    and from machida's output timer, so it only needs to be called to make
+    records visible immediately.
+    """
+    global _dropped
+    with _drain_lock:
+        lines = []
+        popleft = _buffer.popleft
+        try:
+            while True:
+                lines.append(_format_line(*popleft()))
+        except IndexError:
+            pass
+        if _dropped:
+            lines.append(_format_line(
+                time.time(), WARNING, __name__,
+                "dropped {} records".format(_dropped)))
+            _dropped = 0
+        if lines:
+            sys.stderr.write(''.join(lines))
+
+
+def _record(level, name, msg, args):
+    global _dropped
+    if len(_buffer) == _buffer.maxlen:
+        _dropped += 1
+    if args:
+        msg = _format_message(msg, args)
+    _buffer.append((time.time(), level, name, msg))
+    if _drainer_pid != os.getpid():
+        if _is_finalizing():
+            drain()
+            return
+        _start_drainer()
+    if not _pending.is_set():
+        _pending.set()
+
+
+def _format_message(msg, args):
+    try:
+        return msg.format(*args)
+    except Exception as err:
+        return "{!r} {!r} (format failed: {})".format(msg, args, err)
+
+
+def _format_line(ts, level, name, msg):
+    return "{}.{:03d} {} {}: {}\n".format(
+        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts)),
+        int(ts * 1000) % 1000, _LEVEL_NAMES.get(level, level), name, msg)
+
+
+def _sample_for(name, sample):
+    rate = _stage_samples.get(name)
+    if rate is not None:
+        return rate
+    if sample is not None:
+        return _validate_sample(sample)
+    return _sample
+
+
+def _validate_sample(sample):
+    if not isinstance(sample, int) or sample < 1:
+        raise ValueError(
+            "Sampling rates must be positive integers, got {!r}".format(
+                sample))
+    return sample
+
+
+def _start_drainer():
+    # Threads don't survive a fork, so each process starts its own, with an
+    # event whose lock no thread of the parent can be holding.
+    global _drainer_pid, _pending
+    _drainer_pid = os.getpid()
+    _pending = threading.Event()
+    t = threading.Thread(target=_run_drainer, name="wallaroo-log-drainer")
+    t.daemon = True
+    t.start()
+
+
+def _run_drainer():
+    try:
+        while True:
+            _pending.wait()
+            # Cleared before draining, so records added while draining
+            # set it again.
+            _pending.clear()
+            try:
+                drain()
+            except Exception:
+                # stderr is gone; there is nowhere left to report it.
+                pass
+    except Exception:
+        # Python 2 clears module globals at exit while daemon threads are
+        # still running.
+        pass
+
+
+def _drain_at_exit():
+    drain()
+    sys.stderr.flush()
+
+
+atexit.register(_drain_at_exit)
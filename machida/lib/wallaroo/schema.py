@@ -0,0 +1,252 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Fixed-layout message schemas for framed TCP sources and sinks.
+
+A schema is declared once from a list of `(name, struct_code)` or
+`(name, struct_code, offset)` fields:
+
+    MarketData = wallaroo.schema.Schema("MarketData", [
+        ("fix_type", "B"),
+        ("symbol", "4s"),
+        ("transact_time", "21s"),
+        ("bid", "d"),
+        ("offer", "d")])
+
+The fields are compiled into a single `struct.Struct`, so a message is
+parsed with one `unpack_from` call instead of one `unpack` per field on
+sliced bytes. `Schema.decoder` and `Schema.encoder` work like
+`@wallaroo.decoder` and `@wallaroo.encoder`, except the decorated decoder
+function is given a record instead of bytes and the decorated encoder
+function returns one:
+
+    @MarketData.decoder()
+    def market_data_decoder(record):
+        return record
+
+Records are namedtuples by default. Assign `Schema.record` to a module-level
+name with the same name as the schema so that records can be pickled.
+"""
+
+import collections
+import functools
+import struct
+import sys
+
+import wallaroo
+
+
+_BYTE_ORDERS = ('<', '>', '!', '=')
+
+# NumPy kind for each struct type character. Standard sizes are used, so
+# the item size comes from struct.calcsize.
+_NUMPY_KINDS = {
+    'b': 'i', 'h': 'i', 'i': 'i', 'l': 'i', 'q': 'i',
+    'B': 'u', 'H': 'u', 'I': 'u', 'L': 'u', 'Q': 'u',
+    'e': 'f', 'f': 'f', 'd': 'f',
+    '?': 'b', 'c': 'S', 's': 'S'}
+
+
+class SchemaError(Exception):
+    pass
+
+
+class Schema(object):
+    def __init__(self, name, fields, byte_order='>', record=None):
+        """
+        `fields` is a sequence of `(name, struct_code)` or
+        `(name, struct_code, offset)` tuples. Bytes skipped by an explicit
+        offset are ignored when decoding and zeroed when encoding.
+
+        `record` is a class (or any callable) that takes the field values
+        as positional arguments. By default a namedtuple named `name` is
+        generated.
+        """
+        if byte_order not in _BYTE_ORDERS:
+            raise SchemaError(
+                "byte_order must be one of {!r}, got {!r}".format(
+                    _BYTE_ORDERS, byte_order))
+        self.name = name
+        self.byte_order = byte_order
+        self.fields = []
+        self._layout = []
+        fmt = [byte_order]
+        position = 0
+        for field in fields:
+            if len(field) == 2:
+                field_name, code = field
+                offset = None
+            elif len(field) == 3:
+                field_name, code, offset = field
+            else:
+                raise SchemaError(
+                    "Expected (name, code) or (name, code, offset) but got "
+                    "{!r}".format(field))
+            try:
+                size = struct.calcsize(byte_order + code)
+                count = len(struct.unpack(byte_order + code, b'\x00' * size))
+            except struct.error as err:
+                raise SchemaError(
+                    "Invalid struct code {!r} for field {!r}: {}".format(
+                        code, field_name, err))
+            if count != 1:
+                raise SchemaError(
+                    "Struct code {!r} for field {!r} must describe exactly "
+                    "one value".format(code, field_name))
+            if offset is not None:
+                if offset < position:
+                    raise SchemaError(
+                        "Field {!r} at offset {} overlaps the previous "
+                        "field, which ends at {}".format(
+                            field_name, offset, position))
+                if offset > position:
+                    fmt.append('{}x'.format(offset - position))
+                    position = offset
+            fmt.append(code)
+            self._layout.append((code, position, size))
+            position += size
+            self.fields.append(field_name)
+        self.fields = tuple(self.fields)
+        self.format = ''.join(fmt)
+        self._struct = struct.Struct(self.format)
+        self.size = self._struct.size
+
+        if record is None:
+            record = collections.namedtuple(name, self.fields)
+            # Like namedtuple itself, make the record class look as if it
+            # was defined in the module that declared the schema, so
+            # pickle can find it there.
+            try:
+                record.__module__ = sys._getframe(1).f_globals.get(
+                    '__name__', '__main__')
+            except (AttributeError, ValueError):
+                pass
+            self._make = self._make_tuple(record)
+        else:
+            self._make = self._make_args(record)
+        self.record = record
+
+    @staticmethod
+    def _make_tuple(record):
+        return functools.partial(tuple.__new__, record)
+
+    @staticmethod
+    def _make_args(record):
+        def make(values):
+            return record(*values)
+        return make
+
+    def unpack_from(self, bs, offset=0):
+        """
+        Build a record from the `size` bytes starting at `offset` in any
+        bytes-like object.
+        """
+        return self._make(self._struct.unpack_from(bs, offset))
+
+    def values(self, obj):
+        """
+        Return the field values of `obj` in schema order. Tuples (including
+        records) are used as they are, other objects are read by attribute.
+        """
+        if isinstance(obj, tuple):
+            return obj
+        return tuple([getattr(obj, f) for f in self.fields])
+
+    def pack(self, obj):
+        return self._struct.pack(*self.values(obj))
+
+    def pack_into(self, buffer, offset, obj):
+        self._struct.pack_into(buffer, offset, *self.values(obj))
+
+    def decoder(self, length_fmt='>I'):
+        """
+        Returns a decorator that defines a zero-copy Wallaroo decoder. The
+        decorated function takes a record and returns the decoded message,
+        or `None` to discard it.
+        """
+        header_length = struct.calcsize(length_fmt)
+        make = self._make
+        unpack_from = self._struct.unpack_from
+
+        def wrapped(func):
+            def decode(bs):
+                return func(make(unpack_from(bs)))
+            decode.__name__ = func.__name__
+            decode.__module__ = func.__module__
+            decode.__doc__ = func.__doc__
+            return wallaroo.decoder(header_length=header_length,
+                                    length_fmt=length_fmt,
+                                    zero_copy=True)(decode)
+        return wrapped
+
+    def encoder(self, length_fmt='>I'):
+        """
+        Returns a decorator that defines a Wallaroo encoder. The decorated
+        function takes the outgoing message and returns a record, a tuple
+        of field values in schema order, or an object with an attribute
+        per field. The encoded message is framed with its length packed
+        with `length_fmt`, or is left unframed if `length_fmt` is `None`.
+        """
+        if length_fmt is None:
+            framed = self._struct
+            prefix = ()
+        else:
+            # The body has a fixed size, so the frame header is a constant
+            # that is packed in the same call as the fields.
+            header = struct.pack(length_fmt, self.size)
+            framed = struct.Struct('{}{}s{}'.format(
+                self.format[0], len(header), self.format[1:]))
+            prefix = (header,)
+        pack = framed.pack
+        values = self.values
+
+        def wrapped(func):
+            def encode(data):
+                return pack(*(prefix + values(func(data))))
+            encode.__name__ = func.__name__
+            encode.__module__ = func.__module__
+            encode.__doc__ = func.__doc__
+            return wallaroo.encoder(encode)
+        return wrapped
+
+    def dtype(self):
+        """
+        Returns a NumPy structured dtype with the same layout, for reading a
+        buffer of back-to-back messages as an array with
+        `numpy.frombuffer(bs, schema.dtype())`.
+        """
+        import numpy
+        byte_order = '<' if self.byte_order == '<' else (
+            '=' if self.byte_order == '=' else '>')
+        formats = []
+        for code, _, size in self._layout:
+            kind = _NUMPY_KINDS.get(code[-1])
+            if kind is None:
+                raise SchemaError(
+                    "Struct code {!r} has no NumPy equivalent".format(code))
+            formats.append('{}{}{}'.format(byte_order, kind, size))
+        return numpy.dtype({
+            'names': list(self.fields),
+            'formats': formats,
+            'offsets': [offset for _, offset, _ in self._layout],
+            'itemsize': self.size})
+
+    def codec(self):
+        """
+        Returns a `wallaroo.serialization.StructCodec` for records of this
+        schema, for use with `wallaroo.serialization.register`.
+        """
+        return wallaroo.serialization.StructCodec(
+            self.format, self.fields, factory=self.record)
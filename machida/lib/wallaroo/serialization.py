@@ -0,0 +1,233 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Per-type serializers for messages and state that Wallaroo sends between
+workers and writes to its recovery logs.
+
+By default every object is pickled with the highest available protocol.
+Applications can register a faster codec for the classes that make up most
+of their traffic:
+
+    wallaroo.serialization.register(Order, wallaroo.serialization.StructCodec(
+        ">BI6s4sdd21s",
+        ["side", "account", "order_id", "symbol", "qty", "price",
+         "transact_time"]))
+
+A registered object is written as a marker byte, a compact varint type tag,
+and the codec's payload. Anything else is written as a plain pickle, so data
+written before any codec was registered can still be read.
+
+A codec is any object with an `encode(obj)` method that returns a
+bytes-like object, and a `decode(bs, offset, cls)` method that rebuilds an
+instance of `cls` from the payload starting at `offset` in `bs`.
+
+Tags are assigned in registration order unless given explicitly, so every
+worker must register the same classes in the same order. Registering at
+module import time in the application module does this.
+"""
+
+import marshal
+import pickle
+import struct
+
+
+# No pickle stream starts with a byte below 0x20, so this marker can't be
+# confused with the plain pickles written for unregistered types.
+_CODEC_MARKER = b'\x01'
+
+_U32 = struct.Struct('<I')
+_U64 = struct.Struct('<Q')
+_OOB_HEADER = struct.Struct('<IQ')
+
+
+class SerializationError(Exception):
+    pass
+
+
+def _build(cls, factory, fields, values):
+    if factory is not None:
+        return factory(*values)
+    obj = cls.__new__(cls)
+    for name, value in zip(fields, values):
+        setattr(obj, name, value)
+    return obj
+
+
+class StructCodec(object):
+    """
+    Encode a fixed set of attributes with a `struct` format. Instances are
+    rebuilt by setting the attributes on a new object without calling
+    `__init__`, or by calling `factory(*values)` if one is given.
+    """
+    def __init__(self, fmt, fields, factory=None):
+        self._struct = struct.Struct(fmt)
+        self._fields = tuple(fields)
+        self._factory = factory
+        if len(self._fields) != len(self._struct.unpack(
+                b'\x00' * self._struct.size)):
+            raise SerializationError(
+                "Format {!r} does not match fields {!r}".format(
+                    fmt, self._fields))
+
+    def encode(self, obj):
+        return self._struct.pack(*[getattr(obj, f) for f in self._fields])
+
+    def decode(self, bs, offset, cls):
+        return _build(cls, self._factory, self._fields,
+                      self._struct.unpack_from(bs, offset))
+
+
+class MarshalCodec(object):
+    """
+    A compact codec for objects whose attributes are built-in types (numbers,
+    strings, bytes, tuples, lists, dicts, None and booleans). Only the
+    attribute values are written, not their names or the class path.
+    """
+    def __init__(self, fields, factory=None):
+        self._fields = tuple(fields)
+        self._factory = factory
+
+    def encode(self, obj):
+        return marshal.dumps(tuple([getattr(obj, f) for f in self._fields]))
+
+    def decode(self, bs, offset, cls):
+        return _build(cls, self._factory, self._fields,
+                      marshal.loads(bytes(bs[offset:])))
+
+
+class PickleCodec(object):
+    """
+    Pickle with a specific protocol. With protocol 5 (Python 3.8 and later)
+    and `out_of_band=True`, large buffers such as `bytearray`s and NumPy
+    arrays are written after the pickle stream instead of being copied into
+    it, and are handed back to `pickle.loads` as views when decoding.
+    """
+    def __init__(self, protocol=None, out_of_band=True):
+        if protocol is None:
+            protocol = pickle.HIGHEST_PROTOCOL
+        self._protocol = protocol
+        self._out_of_band = out_of_band and protocol >= 5
+
+    def encode(self, obj):
+        if not self._out_of_band:
+            return pickle.dumps(obj, self._protocol)
+        buffers = []
+        data = pickle.dumps(obj, self._protocol,
+                            buffer_callback=buffers.append)
+        raws = [b.raw() for b in buffers]
+        parts = [_OOB_HEADER.pack(len(raws), len(data))]
+        parts.extend(_U64.pack(r.nbytes) for r in raws)
+        parts.append(data)
+        parts.extend(raws)
+        return b''.join(parts)
+
+    def decode(self, bs, offset, cls):
+        if not self._out_of_band:
+            return pickle.loads(bytes(bs[offset:]))
+        view = memoryview(bs)
+        count, data_len = _OOB_HEADER.unpack_from(view, offset)
+        offset += _OOB_HEADER.size
+        sizes = []
+        for _ in range(count):
+            sizes.append(_U64.unpack_from(view, offset)[0])
+            offset += _U64.size
+        data = view[offset:offset + data_len]
+        offset += data_len
+        buffers = []
+        for size in sizes:
+            buffers.append(view[offset:offset + size])
+            offset += size
+        return pickle.loads(data, buffers=buffers)
+
+
+def _encode_varint(n):
+    out = bytearray()
+    while True:
+        b = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def _decode_varint(bs, offset):
+    n = 0
+    shift = 0
+    while True:
+        b = struct.unpack_from('B', bs, offset)[0]
+        offset += 1
+        n |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return n, offset
+        shift += 7
+
+
+class Registry(object):
+    def __init__(self, fallback_protocol=pickle.HIGHEST_PROTOCOL):
+        self._fallback_protocol = fallback_protocol
+        self._by_class = {}
+        self._by_tag = {}
+        self._next_tag = 0
+
+    def register(self, cls, codec, tag=None):
+        """
+        Use `codec` for instances of exactly `cls` (not its subclasses).
+        Returns the type tag that was assigned.
+        """
+        if cls in self._by_class:
+            raise SerializationError(
+                "{!r} is already registered".format(cls))
+        if tag is None:
+            while self._next_tag in self._by_tag:
+                self._next_tag += 1
+            tag = self._next_tag
+        if not isinstance(tag, int) or tag < 0:
+            raise SerializationError(
+                "Type tag must be a non-negative integer, got {!r}".format(
+                    tag))
+        if tag in self._by_tag:
+            raise SerializationError(
+                "Type tag {} is already used by {!r}".format(
+                    tag, self._by_tag[tag][0]))
+        self._by_class[cls] = (_CODEC_MARKER + _encode_varint(tag), codec)
+        self._by_tag[tag] = (cls, codec)
+        return tag
+
+    def serialize(self, obj):
+        entry = self._by_class.get(obj.__class__)
+        if entry is None:
+            return pickle.dumps(obj, self._fallback_protocol)
+        prefix, codec = entry
+        return b''.join((prefix, codec.encode(obj)))
+
+    def deserialize(self, bs):
+        if bs[:1] != _CODEC_MARKER:
+            return pickle.loads(bs)
+        tag, offset = _decode_varint(bs, 1)
+        try:
+            cls, codec = self._by_tag[tag]
+        except KeyError:
+            raise SerializationError(
+                "No codec registered for type tag {}".format(tag))
+        return codec.decode(bs, offset, cls)
+
+
+_registry = Registry()
+
+register = _registry.register
+serialize = _registry.serialize
+deserialize = _registry.deserialize
@@ -0,0 +1,318 @@
+import os
+import socket
+import struct
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+if sys.version_info < (3, 5):
+    pytest.skip("requires asyncio", allow_module_level=True)
+
+import asyncio
+
+import wallaroo.experimental
+from wallaroo.experimental.aio import AsyncSinkConnector, AsyncSourceConnector
+
+
+@wallaroo.experimental.stream_message_encoder
+def frame_encoder(data):
+    return data
+
+
+@wallaroo.experimental.stream_message_decoder
+def frame_decoder(data):
+    return data
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _source_connector(port):
+    connector = AsyncSourceConnector.__new__(AsyncSourceConnector)
+    connector._init_writer(frame_encoder, port)
+    return connector
+
+
+def _sink_connector(port, queue_size=10):
+    connector = AsyncSinkConnector.__new__(AsyncSinkConnector)
+    connector._init_reader(frame_decoder, port, queue_size)
+    return connector
+
+
+class EventLoop(object):
+    # Runs the connectors' coroutines one at a time, on a loop that keeps
+    # serving connections in between. The tests also run on Python 2,
+    # where `async def` is a syntax error.
+    def __enter__(self):
+        self.loop = asyncio.new_event_loop()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.loop.close()
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(asyncio.wait_for(coroutine, 10))
+
+    def run_together(self, *coroutines):
+        tasks = [self.loop.create_task(c) for c in coroutines]
+        return self.run(asyncio.gather(*tasks))
+
+
+def test_source_to_sink():
+    port = _free_port()
+    sink = _sink_connector(port)
+    source = _source_connector(port)
+    messages = [str(i).encode() for i in range(100)]
+    with EventLoop() as loop:
+        loop.run(sink.listen())
+        loop.run(source.connect())
+        loop.run(source.write(messages[0]))
+        loop.run(source.write_many(messages[1:50]))
+        for m in messages[50:]:
+            source.write_nowait(m)
+        loop.run(source.drain())
+        received = [loop.run(sink.read()) for _ in messages]
+        loop.run(source.close())
+        loop.run(sink.close())
+    assert(received == messages)
+
+
+def test_sink_queue_applies_backpressure():
+    port = _free_port()
+    sink = _sink_connector(port, queue_size=2)
+    source = _source_connector(port)
+    with EventLoop() as loop:
+        loop.run(sink.listen())
+        loop.run(source.connect())
+        loop.run(source.write_many([b"a", b"b", b"c", b"d"]))
+        loop.run(asyncio.sleep(0.05))
+        assert(sink._queue.qsize() == 2)
+        received = [loop.run(sink.__aiter__().__anext__()) for _ in range(4)]
+        loop.run(source.close())
+        loop.run(sink.close())
+    assert(received == [b"a", b"b", b"c", b"d"])
+
+
+def test_sink_stops_reading_while_its_queue_is_full():
+    port = _free_port()
+    sink = _sink_connector(port, queue_size=1)
+    source = _source_connector(port)
+    # More than the socket buffers between them can hold.
+    messages = [str(i).encode() * 65536 for i in range(10, 500)]
+    with EventLoop() as loop:
+        loop.run(sink.listen())
+        loop.run(source.connect())
+        for m in messages:
+            source.write_nowait(m)
+        with pytest.raises(asyncio.TimeoutError):
+            loop.run(asyncio.wait_for(source.drain(), 0.5))
+        assert(sink._queue.full())
+        received = loop.run_together(
+            source.drain(), *[sink.read() for _ in messages])[1:]
+        loop.run(source.close())
+        loop.run(sink.close())
+    assert(received == messages)
+
+
+def _sequences_frame(kind, sequences):
+    entries = b"".join(
+        struct.pack("<H", len(p)) + p + struct.pack("<q", s)
+        for p, s in sorted(sequences.items()))
+    return struct.pack("<IB", len(entries) + 1, kind) + entries
+
+
+def test_source_reads_sequence_frames():
+    port = _free_port()
+    readers = []
+
+    def accept(reader, writer):
+        # A resume frame, then an ack frame.
+        writer.write(_sequences_frame(1, {b"p": 4}) +
+                     _sequences_frame(0, {b"p": 2, b"q": 7}))
+        readers.append(reader)
+
+    source = _source_connector(port)
+    with EventLoop() as loop:
+        server = loop.run(asyncio.start_server(accept, '127.0.0.1', port))
+        loop.run(source.connect())
+        loop.run(asyncio.sleep(0.05))
+        # Resuming isn't an acknowledgement.
+        assert(source.acked() == {u"p": 2, u"q": 7})
+        loop.run(source.write(b"x", partition=u"p"))
+        loop.run(source.write_many([b"y", b"z"], partition=u"q",
+                                   sequences=[10, 11]))
+        source.write_nowait(b"w")
+        loop.run(source.drain())
+        expected = (frame_encoder.encode(b"x", u"p", 5) +
+                    frame_encoder.encode_many([b"y", b"z"], u"q", [10, 11]) +
+                    frame_encoder.encode(b"w", None, 0))
+        received = loop.run(readers[0].readexactly(len(expected)))
+        loop.run(source.close())
+        server.close()
+        loop.run(server.wait_closed())
+    assert(received == expected)
+
+
+def test_write_before_connect():
+    source = _source_connector(0)
+    with pytest.raises(RuntimeError):
+        source.write_nowait(b"a")
+
+
+#
+# Connector scripts, run against fake client libraries
+#
+
+CONNECTORS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "..", "..", "connectors", "aio")
+
+APPLICATION = """
+import wallaroo.experimental
+
+@wallaroo.experimental.stream_message_encoder
+def encoder(data):
+    return data
+
+@wallaroo.experimental.stream_message_decoder
+def decoder(data):
+    return data
+
+def application_setup(args):
+    return [("source_connector", "input", {port}, encoder, decoder)]
+"""
+
+FAKE_REDIS = """
+class PubSub(object):
+    def __init__(self, options):
+        self._options = options
+        self._channels = []
+
+    async def subscribe(self, *channels):
+        self._channels.extend(channels)
+
+    async def listen(self):
+        for channel in self._channels:
+            yield {'type': 'subscribe', 'channel': channel, 'data': 1}
+        for i in range(3):
+            for channel in self._channels:
+                data = '{}:{}@{}'.format(channel, i, self._options['port'])
+                yield {'type': 'message', 'channel': channel,
+                       'data': data.encode()}
+
+
+class Redis(object):
+    def __init__(self, **options):
+        self._options = options
+
+    def pubsub(self):
+        return PubSub(self._options)
+"""
+
+FAKE_PIKA = """
+class URLParameters(object):
+    def __init__(self, url):
+        self.url = url
+"""
+
+FAKE_PIKA_ASYNCIO_CONNECTION = """
+import sys
+
+
+class Channel(object):
+    def __init__(self, loop, messages):
+        self.is_open = True
+        self._loop = loop
+        self._messages = messages
+
+    def basic_qos(self, prefetch_count, callback):
+        self._loop.call_soon(callback, None)
+
+    def queue_declare(self, queue, callback):
+        self._loop.call_soon(callback, None)
+
+    def basic_consume(self, queue, on_message_callback):
+        for (tag, body) in enumerate(self._messages, 1):
+            deliver = type('Deliver', (), {'delivery_tag': tag})
+            self._loop.call_soon(on_message_callback, self, deliver, None, body)
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        print('ack {} {}'.format(delivery_tag, multiple))
+        sys.stdout.flush()
+        if delivery_tag == len(self._messages):
+            self._loop.stop()
+
+
+class AsyncioConnection(object):
+    def __init__(self, parameters, on_open_callback, on_open_error_callback,
+                 on_close_callback, custom_ioloop):
+        self._loop = custom_ioloop
+        self._messages = [parameters.url.encode() + b'-' + str(i).encode()
+                          for i in range(5)]
+        self._loop.call_soon(on_open_callback, self)
+
+    def channel(self, on_open_callback):
+        self._loop.call_soon(on_open_callback,
+                             Channel(self._loop, self._messages))
+"""
+
+
+def _write_modules(directory, modules):
+    for (name, source) in modules.items():
+        path = directory.join(*name.split("."))
+        if name in ("redis", "pika", "pika.adapters"):
+            path = path.join("__init__.py")
+        else:
+            path = directory.join(*name.split(".")[:-1]).join(
+                name.split(".")[-1] + ".py")
+        path.write(textwrap.dedent(source), ensure=True)
+
+
+def _run_source_script(tmpdir, script, args, modules, count):
+    port = _free_port()
+    modules = dict(modules, connector_app=APPLICATION.format(port=port))
+    _write_modules(tmpdir, modules)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [str(tmpdir), os.path.dirname(os.path.dirname(wallaroo.__file__))])
+    sink = _sink_connector(port)
+    with EventLoop() as loop:
+        loop.run(sink.listen())
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(CONNECTORS, script),
+             "--application-module", "connector_app",
+             "--connector", "input"] + args,
+            env=env, stdout=subprocess.PIPE)
+        try:
+            received = [loop.run(sink.read()) for _ in range(count)]
+        finally:
+            (output, _) = process.communicate(timeout=10)
+            loop.run(sink.close())
+    assert(process.returncode == 0)
+    return (received, output.decode())
+
+
+def test_redis_subscriber_source(tmpdir):
+    (received, _) = _run_source_script(
+        tmpdir, "redis_subscriber_source",
+        ["--input-topic", "a,b", "--input-port", "6380"],
+        {"redis": "", "redis.asyncio": FAKE_REDIS}, 6)
+    assert(received == [b"a:0@6380", b"b:0@6380", b"a:1@6380",
+                        b"b:1@6380", b"a:2@6380", b"b:2@6380"])
+
+
+def test_rabbitmq_source_acknowledges_after_sending(tmpdir):
+    (received, output) = _run_source_script(
+        tmpdir, "rabbitmq_source",
+        ["--input-amqpurl", "amqp://q", "--input-queue", "q"],
+        {"pika": FAKE_PIKA, "pika.adapters": "",
+         "pika.adapters.asyncio_connection": FAKE_PIKA_ASYNCIO_CONNECTION}, 5)
+    assert(received == [b"amqp://q-" + str(i).encode() for i in range(5)])
+    # All five were written before the first drain finished.
+    assert(output.split("\n")[-2] == "ack 5 True")
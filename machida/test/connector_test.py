@@ -0,0 +1,493 @@
+import socket
+import struct
+import sys
+import threading
+import time
+
+import pytest
+
+import wallaroo.experimental
+from wallaroo.experimental import _ReplayBuffer, _SendBuffer
+
+
+class RecordingConn(object):
+    def __init__(self, blocked=False, error=None):
+        self.sent = []
+        self.error = error
+        self.unblocked = threading.Event()
+        if not blocked:
+            self.unblocked.set()
+
+    def sendall(self, data):
+        self.unblocked.wait()
+        if self.error is not None:
+            raise self.error
+        self.sent.append(data)
+
+
+def test_writes_are_batched():
+    conn = RecordingConn()
+    sender = _SendBuffer(conn, batch_size=10, linger=60)
+    for i in range(4):
+        sender.write(b"abc")
+    sender.flush()
+    assert(b"".join(conn.sent) == b"abc" * 4)
+    assert(conn.sent[0] == b"abc" * 4)
+    sender.close()
+
+
+def test_full_batches_are_sent_without_waiting():
+    conn = RecordingConn()
+    sender = _SendBuffer(conn, batch_size=6, linger=60)
+    sender.write(b"abc")
+    sender.write(b"def")
+    deadline = time.time() + 5
+    while not conn.sent and time.time() < deadline:
+        time.sleep(0.001)
+    assert(conn.sent == [b"abcdef"])
+    sender.close()
+
+
+def test_linger():
+    conn = RecordingConn()
+    sender = _SendBuffer(conn, batch_size=1024, linger=0.01)
+    sender.write(b"abc")
+    deadline = time.time() + 5
+    while not conn.sent and time.time() < deadline:
+        time.sleep(0.001)
+    assert(conn.sent == [b"abc"])
+    sender.close()
+
+
+def test_writes_block_when_buffer_is_full():
+    conn = RecordingConn(blocked=True)
+    sender = _SendBuffer(conn, batch_size=4, linger=0, buffer_size=8)
+    written = []
+
+    def produce():
+        for i in range(10):
+            sender.write(b"abcd")
+            written.append(i)
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    time.sleep(0.1)
+    # One batch is stuck in sendall and two more fill the buffer.
+    assert(len(written) < 10)
+    conn.unblocked.set()
+    producer.join(5)
+    sender.flush()
+    assert(len(written) == 10)
+    assert(b"".join(conn.sent) == b"abcd" * 10)
+    sender.close()
+
+
+def test_send_errors_are_raised_to_the_writer():
+    conn = RecordingConn(error=socket.error("broken"))
+    sender = _SendBuffer(conn, batch_size=4, linger=0)
+    sender.write(b"abcd")
+    try:
+        sender.flush()
+    except socket.error:
+        pass
+    else:
+        assert(False)
+    try:
+        sender.write(b"abcd")
+    except socket.error:
+        pass
+    else:
+        assert(False)
+
+
+def test_socket():
+    a, b = socket.socketpair()
+    sender = _SendBuffer(a, batch_size=64, linger=0.001)
+    for i in range(100):
+        sender.write(b"message")
+    sender.close()
+    a.close()
+    received = []
+    while True:
+        data = b.recv(4096)
+        if not data:
+            break
+        received.append(data)
+    assert(b"".join(received) == b"message" * 100)
+
+
+@wallaroo.experimental.stream_message_encoder
+def frame_encoder(data):
+    return data
+
+
+@wallaroo.experimental.stream_message_decoder
+def frame_decoder(data):
+    return data
+
+
+def _sink_connector(recv_size):
+    connector = wallaroo.experimental.SinkConnector.__new__(
+        wallaroo.experimental.SinkConnector)
+    connector._init_reader(frame_decoder, 0, recv_size)
+    return connector
+
+
+def test_sink_reads_frames_split_across_receives():
+    a, b = socket.socketpair()
+    connector = _sink_connector(recv_size=7)
+    connector._setup_connection(b)
+    messages = [str(i).encode() * (i % 13) for i in range(200)]
+    a.sendall(b"".join(frame_encoder.encode(m) for m in messages))
+    received = [connector.read(timeout=5) for _ in messages]
+    assert(received == messages)
+    a.close()
+
+
+def test_sink_reads_buffered_frames_after_close():
+    a, b = socket.socketpair()
+    connector = _sink_connector(recv_size=4096)
+    connector._setup_connection(b)
+    a.sendall(frame_encoder.encode(b"one") + frame_encoder.encode(b"two"))
+    a.close()
+    assert(connector.read(timeout=5) == b"one")
+    assert(connector.read(timeout=5) == b"two")
+    connector._poll(0)
+    assert(connector._read_ready() == (False, None))
+    assert(connector._buffers == {})
+    assert(len(connector._ready) == 0)
+
+
+def test_sink_reads_from_many_connections():
+    connector = _sink_connector(recv_size=4096)
+    writers = []
+    for i in range(300):
+        a, b = socket.socketpair()
+        connector._setup_connection(b)
+        writers.append(a)
+    for i, a in enumerate(writers):
+        a.sendall(frame_encoder.encode(str(i).encode()) * 2)
+    received = sorted(int(connector.read(timeout=5)) for _ in range(600))
+    assert(received == sorted(list(range(300)) * 2))
+    for a in writers:
+        a.close()
+    connector.close()
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason="requires asyncio")
+def test_sink_async_iteration():
+    import asyncio
+    a, b = socket.socketpair()
+    connector = _sink_connector(recv_size=4096)
+    connector._setup_connection(b)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.call_later(0.01, a.sendall, frame_encoder.encode(b"later"))
+        message = loop.run_until_complete(asyncio.wait_for(
+            connector.__aiter__().__anext__(), 5))
+        assert(message == b"later")
+        a.sendall(frame_encoder.encode(b"now"))
+        time.sleep(0.01)
+        message = loop.run_until_complete(asyncio.wait_for(
+            connector.__anext__(), 5))
+        assert(message == b"now")
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+        a.close()
+        connector.close()
+
+
+def test_read_buffer_grows_and_compacts():
+    a, b = socket.socketpair()
+    buffered = wallaroo.experimental._ReadBuffer(4)
+    a.sendall(b"abcdefgh")
+    assert(buffered.recv_from(b, 8) == 8)
+    assert(buffered.take(6) == b"abcdef")
+    a.sendall(b"ijkl")
+    assert(buffered.recv_from(b, 4) == 4)
+    assert(len(buffered) == 6)
+    assert(buffered.take(6) == b"ghijkl")
+    assert(len(buffered.data) == 8)
+
+
+def test_sink_read_batch():
+    a, b = socket.socketpair()
+    connector = _sink_connector(recv_size=4096)
+    connector._setup_connection(b)
+    a.sendall(b"".join(frame_encoder.encode(str(i).encode())
+                       for i in range(5)))
+    assert(connector.read_batch(3) == [b"0", b"1", b"2"])
+    assert(connector.read_batch(3) == [b"3", b"4"])
+
+    def send_later():
+        time.sleep(0.02)
+        a.sendall(frame_encoder.encode(b"6"))
+
+    a.sendall(frame_encoder.encode(b"5"))
+    sender = threading.Thread(target=send_later)
+    sender.start()
+    assert(connector.read_batch(2, max_wait=5) == [b"5", b"6"])
+    sender.join()
+    a.close()
+
+
+class Done(Exception):
+    pass
+
+
+def test_batching_sink_connector():
+    a, b = socket.socketpair()
+    connector = wallaroo.experimental.BatchingSinkConnector.__new__(
+        wallaroo.experimental.BatchingSinkConnector)
+    connector._init_reader(frame_decoder, 0, 4096)
+    connector._max_items = 4
+    connector._max_wait = 0.01
+    connector._setup_connection(b)
+    a.sendall(b"".join(frame_encoder.encode(str(i).encode())
+                       for i in range(6)))
+    batches = []
+
+    def flush_batch(batch):
+        batches.append(batch)
+        if sum(len(batch) for batch in batches) == 6:
+            raise Done()
+
+    with pytest.raises(Done):
+        connector.run(flush_batch)
+    assert(batches == [[b"0", b"1", b"2", b"3"], [b"4", b"5"]])
+
+
+def test_batching_sink_connector_max_items_override():
+    a, b = socket.socketpair()
+    connector = wallaroo.experimental.BatchingSinkConnector.__new__(
+        wallaroo.experimental.BatchingSinkConnector)
+    connector._init_reader(frame_decoder, 0, 4096)
+    connector._max_items = 4
+    connector._max_wait = 0
+    connector._setup_connection(b)
+    a.sendall(b"".join(frame_encoder.encode(str(i).encode())
+                       for i in range(6)))
+    # 0 is not the default, and reads nothing without waiting
+    assert(connector.read_batch(max_items=0) == [])
+    assert(connector.read_batch(max_items=-1) == [])
+    assert(connector.read_batch(max_items=2) == [b"0", b"1"])
+    assert(connector.read_batch() == [b"2", b"3", b"4", b"5"])
+    with pytest.raises(ValueError):
+        wallaroo.experimental.BatchingSinkConnector(max_items=0)
+    a.close()
+    a.close()
+
+
+def test_encoder_keeps_partition_and_sequence_zero():
+    assert(parse_messages(frame_encoder.encode(b"x", 0, 0)) ==
+           [(b"0", 0, b"x")])
+    assert(parse_messages(frame_encoder.encode(b"x")) == [(b"", -1, b"x")])
+    assert(frame_decoder.decode(frame_encoder.encode(b"x", "p", 7)[4:]) ==
+           b"x")
+
+
+def test_connector_codec():
+    codec = wallaroo.ConnectorCodec()
+    frame = codec.encode(b"message", u"p\u00e9", 5)
+    size = struct.unpack_from("<I", frame)[0]
+    assert(size == len(frame) - 4)
+    assert(codec.metadata(frame[4:]) == (u"p\u00e9".encode("utf-8"), 5))
+    assert(codec.message(frame[4:]) == b"message")
+    assert(codec.message(memoryview(frame)[4:]) == b"message")
+    assert(codec.encode(b"m", b"p", 1) == codec.encode(b"m", u"p", 1))
+    assert(codec.metadata(codec.encode(b"m")[4:]) == (b"", -1))
+
+
+def test_connector_codec_encode_many():
+    codec = wallaroo.ConnectorCodec()
+    messages = [str(i).encode() * i for i in range(10)]
+    for partition in (None, 3, u"topic"):
+        assert(codec.encode_many(messages, partition, list(range(10))) ==
+               b"".join(codec.encode(m, partition, i)
+                        for i, m in enumerate(messages)))
+    assert(codec.encode_many(messages) ==
+           b"".join(codec.encode(m) for m in messages))
+    assert(frame_encoder.encode_many([b"a", b"b"], u"p", [1, 2]) ==
+           frame_encoder.encode(b"a", u"p", 1) +
+           frame_encoder.encode(b"b", u"p", 2))
+
+
+def test_replay_buffer_forgets_acknowledged_writes():
+    replay = _ReplayBuffer(max_memory=1024, max_spill=1024)
+    for i in range(4):
+        replay.append(u"a", i, b"a" + str(i).encode())
+        replay.append(u"b", i, b"b" + str(i).encode())
+    replay.ack({u"a": 1})
+    # b0 is still waiting, so a1 can't be forgotten yet.
+    assert(len(replay) == 7)
+    assert(list(replay.unacked()) == [b"b0", b"b1", b"a2", b"b2", b"a3",
+                                      b"b3"])
+    replay.ack({u"b": 2})
+    assert(len(replay) == 4)
+    assert(list(replay.unacked()) == [b"a2", b"a3", b"b3"])
+
+
+def test_replay_buffer_skips_resumed_writes_without_forgetting_them():
+    replay = _ReplayBuffer(max_memory=1024, max_spill=1024)
+    for i in range(3):
+        replay.append(u"a", i, b"a" + str(i).encode())
+    replay.append(u"b", 0, b"b0")
+    assert(list(replay.unacked(after={u"a": 1})) == [b"a2", b"b0"])
+    assert(len(replay) == 4)
+    assert(list(replay.unacked()) == [b"a0", b"a1", b"a2", b"b0"])
+
+
+def test_replay_buffer_spills_to_disk():
+    replay = _ReplayBuffer(max_memory=10, max_spill=1024)
+    for i in range(100):
+        replay.append(u"", i, b"%05d" % i)
+    assert(len(replay._memory) == 2)
+    assert(list(replay.unacked()) == [b"%05d" % i for i in range(100)])
+    replay.ack({u"": 49})
+    assert(list(replay.unacked()) == [b"%05d" % i for i in range(50, 100)])
+    replay.ack({u"": 99})
+    assert(len(replay) == 0)
+    assert(replay._spill_end == 0)
+    replay.close()
+
+
+def test_replay_buffer_drops_oldest_past_max_spill():
+    replay = _ReplayBuffer(max_memory=0, max_spill=20)
+    for i in range(10):
+        replay.append(u"", i, b"%05d" % i)
+    assert(list(replay.unacked()) == [b"%05d" % i for i in range(6, 10)])
+    assert(replay._spill_end == 20)
+    replay.close()
+
+
+def sequences_frame(kind, sequences):
+    entries = b"".join(
+        struct.pack("<H", len(p)) + p + struct.pack("<q", s)
+        for p, s in sorted(sequences.items()))
+    return struct.pack("<IB", len(entries) + 1, kind) + entries
+
+
+def parse_messages(data):
+    messages = []
+    offset = 0
+    while offset + 4 <= len(data):
+        size = struct.unpack_from("<I", data, offset)[0]
+        if offset + 4 + size > len(data):
+            break
+        meta_size = struct.unpack_from("<H", data, offset + 4)[0]
+        start = offset + 6
+        part = data[start:start + meta_size - 8]
+        seq = struct.unpack_from("<q", data, start + meta_size - 8)[0]
+        messages.append((part, seq, data[start + meta_size:offset + 4 + size]))
+        offset += 4 + size
+    return messages
+
+
+def recv_messages(conn, count):
+    conn.settimeout(5)
+    data = b""
+    while len(parse_messages(data)) < count:
+        data += conn.recv(4096)
+    assert(len(parse_messages(data)) == count)
+    return parse_messages(data)
+
+
+class FakeWallaroo(object):
+    def __init__(self):
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        self.connections = []
+
+    def accept(self, hello):
+        def run():
+            conn, _addr = self.server.accept()
+            if hello is not None:
+                conn.sendall(hello)
+            self.connections.append(conn)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+        self.server.close()
+
+
+def _source_connector(port, **kwargs):
+    connector = wallaroo.experimental.SourceConnector.__new__(
+        wallaroo.experimental.SourceConnector)
+    connector._init_writer(frame_encoder, port, linger=0, **kwargs)
+    return connector
+
+
+def test_source_connector_without_acknowledgements():
+    wallaroo_ = FakeWallaroo()
+    accepting = wallaroo_.accept(hello=None)
+    connector = _source_connector(wallaroo_.port)
+    start = time.time()
+    connector.connect()
+    # Not waiting for a resilient Wallaroo to say where to resume.
+    assert(time.time() - start < 0.5)
+    accepting.join(5)
+    connector.write(b"x", partition=u"p")
+    connector.write(b"y", partition=u"p")
+    connector.flush()
+    assert(connector._replay is None)
+    assert(recv_messages(wallaroo_.connections[0], 2) ==
+           [(b"p", 0, b"x"), (b"p", 1, b"y")])
+    connector.close()
+    wallaroo_.close()
+
+
+def test_source_connector_replays_after_reconnecting():
+    wallaroo_ = FakeWallaroo()
+    accepting = wallaroo_.accept(hello=sequences_frame(1, {}))
+    connector = _source_connector(wallaroo_.port)
+    connector.connect(ack_timeout=5)
+    accepting.join(5)
+    first = wallaroo_.connections[0]
+    for i in range(5):
+        connector.write(str(i).encode(), partition=0)
+    connector.write_many([b"a", b"b"], partition=u"p")
+    connector.flush()
+    assert(recv_messages(first, 7) ==
+           [(b"0", i, str(i).encode()) for i in range(5)] +
+           [(b"p", 0, b"a"), (b"p", 1, b"b")])
+
+    first.sendall(sequences_frame(0, {b"0": 2}))
+    deadline = time.time() + 5
+    while connector.acked() != {u"0": 2} and time.time() < deadline:
+        time.sleep(0.001)
+    assert(connector.acked() == {u"0": 2})
+
+    # The worker restarts from a checkpoint that has up to 0:3 and p:0.
+    accepting = wallaroo_.accept(
+        hello=sequences_frame(1, {b"0": 3, b"p": 0}))
+    first.close()
+    written = 0
+    while accepting.is_alive() and written < 1000:
+        connector.write(b"x")
+        connector.flush()
+        written += 1
+        time.sleep(0.001)
+    accepting.join(5)
+    second = wallaroo_.connections[1]
+    connector.write(b"5", partition=0)
+    connector.flush()
+    assert(recv_messages(second, 4 + written) ==
+           [(b"0", 4, b"4"), (b"p", 0, b"a"), (b"p", 1, b"b")] +
+           [(b"", i, b"x") for i in range(written)] +
+           [(b"0", 5, b"5")])
+    # Resuming isn't an acknowledgement: 0:3 is kept until it's acked.
+    assert(connector.acked() == {u"0": 2})
+    assert(list(connector._replay.unacked())[0] == frame_encoder.encode(
+        b"3", 0, 3))
+    connector.close()
+    wallaroo_.close()
@@ -0,0 +1,225 @@
+import collections
+import sys
+
+import wallaroo.log
+from wallaroo.experimental.kafka import KafkaSource
+
+
+TopicPartition = collections.namedtuple("TopicPartition",
+                                        ["topic", "partition"])
+ConsumerRecord = collections.namedtuple("ConsumerRecord",
+                                        ["topic", "partition", "offset",
+                                         "value"])
+OffsetAndMetadata = collections.namedtuple(
+    "OffsetAndMetadata", ["offset", "metadata", "leader_epoch"])
+
+
+class FakeConsumer(object):
+    def __init__(self, batches, ends=None):
+        self.batches = list(batches)
+        self.ends = ends or {}
+        self.polls = []
+        self.commits = []
+        self.subscriptions = []
+
+    def poll(self, timeout_ms, max_records):
+        self.polls.append(max_records)
+        if not self.batches:
+            return {}
+        batch = self.batches.pop(0)
+        return dict((tp, records[:max_records])
+                    for tp, records in batch.items())
+
+    def subscribe(self, topics, listener):
+        self.subscriptions.append((topics, listener))
+
+    def commit(self, offsets):
+        self.commits.append(("sync", offsets))
+
+    def commit_async(self, offsets, callback):
+        self.commits.append(("async", offsets))
+        callback(offsets, None)
+
+    def end_offsets(self, partitions):
+        return dict((tp, self.ends[tp]) for tp in partitions
+                    if tp in self.ends)
+
+
+class FakeConnector(object):
+    def __init__(self):
+        self.written = []
+        self.flushes = 0
+        self.acknowledged = {}
+
+    def write_many(self, messages, partition=None, sequences=None):
+        self.written.append((partition, list(messages), list(sequences)))
+
+    def flush(self):
+        self.flushes += 1
+
+    def acked(self):
+        return dict(self.acknowledged)
+
+
+def records(tp, offsets, deleted=()):
+    return [ConsumerRecord(tp.topic, tp.partition, offset,
+                           None if offset in deleted else
+                           b"%s-%d" % (tp.topic.encode(), offset))
+            for offset in offsets]
+
+
+def committed(consumer):
+    return [(kind, dict((tp, o.offset) for tp, o in offsets.items()))
+            for kind, offsets in consumer.commits]
+
+
+a0 = TopicPartition("a", 0)
+a1 = TopicPartition("a", 1)
+
+
+def test_batches_are_written_per_partition_and_committed_after_flush():
+    consumer = FakeConsumer([
+        {a0: records(a0, range(0, 3)), a1: records(a1, range(10, 12))},
+        {a0: records(a0, range(3, 4))},
+    ], ends={a0: 10, a1: 12})
+    connector = FakeConnector()
+    source = KafkaSource(consumer, connector, max_records=100,
+                         offset_type=OffsetAndMetadata)
+    source.poll()
+    assert(sorted(connector.written) == [
+        (u"a:0", [b"a-0", b"a-1", b"a-2"], [0, 1, 2]),
+        (u"a:1", [b"a-10", b"a-11"], [10, 11])])
+    assert(connector.flushes == 1)
+    source.poll()
+    # Nothing new to write, flush or commit.
+    source.poll()
+    assert(connector.flushes == 2)
+    assert(committed(consumer) == [("async", {a0: 3, a1: 12}),
+                                   ("async", {a0: 4})])
+    assert(consumer.polls == [100, 100, 100])
+    assert(consumer.commits[0][1][a0] == OffsetAndMetadata(3, "", -1))
+
+    source._update_lag()
+    assert(source.metrics() == {
+        u"a:0": {"messages": 4, "bytes": 12, "lag": 6},
+        u"a:1": {"messages": 2, "bytes": 8, "lag": 0}})
+
+
+def test_commit_acknowledged_offsets():
+    consumer = FakeConsumer([
+        {a0: records(a0, range(0, 5)), a1: records(a1, range(0, 5))},
+    ])
+    connector = FakeConnector()
+    source = KafkaSource(consumer, connector, commit="ack",
+                         offset_type=OffsetAndMetadata)
+    source.poll()
+    assert(consumer.commits == [])
+    connector.acknowledged = {u"a:0": 2}
+    source.poll()
+    source.poll()
+    connector.acknowledged = {u"a:0": 4, u"a:1": 0}
+    source.poll()
+    assert(committed(consumer) == [("async", {a0: 3}),
+                                   ("async", {a0: 5, a1: 1})])
+    assert(connector.flushes == 0)
+
+
+def test_failed_commits_are_retried():
+    consumer = FakeConsumer([{a0: records(a0, range(0, 2))}, {}])
+    consumer.commit_async = lambda offsets, callback: (
+        consumer.commits.append(("async", offsets)),
+        callback(offsets, Exception("rebalancing")))
+    connector = FakeConnector()
+    source = KafkaSource(consumer, connector, report_interval=0,
+                         offset_type=OffsetAndMetadata)
+    source.poll()
+    source.stop()
+    source.run()
+    assert(committed(consumer) == [("async", {a0: 2}), ("sync", {a0: 2})])
+
+
+def test_records_without_values_are_skipped():
+    consumer = FakeConsumer([
+        {a0: records(a0, range(0, 4), deleted=(1,))},
+        {a0: records(a0, range(4, 6), deleted=(4, 5))},
+    ])
+    connector = FakeConnector()
+    source = KafkaSource(consumer, connector, offset_type=OffsetAndMetadata)
+    source.poll()
+    source.poll()
+    assert(connector.written == [(u"a:0", [b"a-0", b"a-2", b"a-3"], [0, 2, 3])])
+    assert(committed(consumer) == [("async", {a0: 4}), ("async", {a0: 6})])
+    assert(source.metrics()[u"a:0"]["messages"] == 3)
+
+
+class RebalanceListener(object):
+    pass
+
+
+def test_revoked_partitions_are_committed_and_forgotten():
+    consumer = FakeConsumer([
+        {a0: records(a0, range(0, 3)), a1: records(a1, range(0, 2))},
+    ])
+    connector = FakeConnector()
+    source = KafkaSource(consumer, connector, commit="ack",
+                         offset_type=OffsetAndMetadata)
+    source.subscribe(["a"], listener_type=RebalanceListener)
+    [(topics, listener)] = consumer.subscriptions
+    assert(topics == ["a"])
+    assert(isinstance(listener, RebalanceListener))
+    source.poll()
+    connector.acknowledged = {u"a:0": 1}
+    listener.on_partitions_revoked([a0])
+    listener.on_partitions_assigned([a1])
+    assert(committed(consumer) == [("sync", {a0: 2})])
+    assert(list(source.metrics()) == [u"a:1"])
+    assert(list(source._positions) == [a1])
+
+
+def test_acknowledgements_from_before_an_assignment_are_not_committed():
+    consumer = FakeConsumer([
+        {a0: records(a0, range(0, 3))},
+        {a0: records(a0, range(10, 12))},
+    ])
+    connector = FakeConnector()
+    source = KafkaSource(consumer, connector, commit="ack",
+                         offset_type=OffsetAndMetadata)
+    source.poll()
+    source.on_partitions_revoked([a0])
+    # Assigned again after another consumer has read up to offset 10.
+    connector.acknowledged = {u"a:0": 2}
+    source.poll()
+    connector.acknowledged = {u"a:0": 10}
+    source.poll()
+    assert(committed(consumer) == [("async", {a0: 11})])
+
+
+def test_partition_reports_are_logged_at_info():
+    consumer = FakeConsumer([
+        {a0: records(a0, range(0, 4)), a1: records(a1, range(10, 12))},
+    ], ends={a0: 10, a1: 12})
+    source = KafkaSource(consumer, FakeConnector(),
+                         offset_type=OffsetAndMetadata)
+    source.poll()
+    source._update_lag()
+    lines = []
+
+    class Stderr(object):
+        def write(self, data):
+            lines.extend(data.splitlines())
+
+        def flush(self):
+            pass
+
+    wallaroo.log.drain()
+    stderr, sys.stderr = sys.stderr, Stderr()
+    try:
+        wallaroo.log.configure('info')
+        source._report({}, dict(source._counts), 2.0)
+        wallaroo.log.drain()
+    finally:
+        wallaroo.log.configure('warning')
+        sys.stderr = stderr
+    assert([line.split(" INFO ", 1)[1] for line in lines] == [
+        "wallaroo.experimental.kafka: a:0: 2 msg/s, lag 6",
+        "wallaroo.experimental.kafka: a:1: 1 msg/s, lag 0"])
@@ -0,0 +1,273 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import wallaroo.experimental.kinesis as kinesis
+from wallaroo.experimental.kinesis import KinesisSource, ShardCheckpoints
+
+
+class KinesisError(Exception):
+    def __init__(self, code):
+        super(KinesisError, self).__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+
+class FakeKinesis(object):
+    """
+    Just enough of the Kinesis API for KinesisSource, with the shards
+    listed two at a time.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.shards = []
+        self.records = {}
+        self.closed = set()
+        self.errors = []
+        self._sequence = 0
+
+    def add_shard(self, shard_id, parent=None, adjacent=None):
+        shard = {'ShardId': shard_id}
+        if parent:
+            shard['ParentShardId'] = parent
+        if adjacent:
+            shard['AdjacentParentShardId'] = adjacent
+        with self._lock:
+            self.shards.append(shard)
+            self.records[shard_id] = []
+
+    def put(self, shard_id, *data):
+        with self._lock:
+            for d in data:
+                self._sequence += 1
+                self.records[shard_id].append(
+                    {'SequenceNumber': '%030d' % self._sequence, 'Data': d})
+
+    def close(self, shard_id):
+        with self._lock:
+            self.closed.add(shard_id)
+
+    def list_shards(self, StreamName=None, NextToken=None):
+        start = int(NextToken or 0)
+        response = {'Shards': self.shards[start:start + 2]}
+        if start + 2 < len(self.shards):
+            response['NextToken'] = str(start + 2)
+        return response
+
+    def get_shard_iterator(self, StreamName, ShardId, ShardIteratorType,
+                           StartingSequenceNumber=None):
+        records = self.records[ShardId]
+        if ShardIteratorType == 'TRIM_HORIZON':
+            position = 0
+        elif ShardIteratorType == 'LATEST':
+            position = len(records)
+        else:
+            assert(ShardIteratorType == 'AFTER_SEQUENCE_NUMBER')
+            position = 1 + [r['SequenceNumber'] for r in records].index(
+                StartingSequenceNumber)
+        return {'ShardIterator': '{}:{}'.format(ShardId, position)}
+
+    def get_records(self, ShardIterator, Limit):
+        with self._lock:
+            if self.errors:
+                raise KinesisError(self.errors.pop(0))
+            shard_id, position = ShardIterator.rsplit(':', 1)
+            position = int(position)
+            records = self.records[shard_id]
+            batch = records[position:position + Limit]
+            position += len(batch)
+            response = {'Records': batch,
+                        'MillisBehindLatest': 1000 * (len(records) - position)}
+            if shard_id not in self.closed or position < len(records):
+                response['NextShardIterator'] = '{}:{}'.format(shard_id,
+                                                               position)
+            return response
+
+
+class FakeConnector(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.written = []
+        self.flushing = None
+
+    def write_many(self, messages, partition=None):
+        with self._lock:
+            self.written.extend((partition, m) for m in messages)
+
+    def flush(self):
+        if self.flushing is not None:
+            self.flushing()
+
+    def data(self, partition=None):
+        with self._lock:
+            return [m for p, m in self.written
+                    if partition is None or p == partition]
+
+
+class Running(object):
+    def __init__(self, source):
+        self.source = source
+        self.thread = threading.Thread(target=source.run)
+
+    def __enter__(self):
+        self.min_poll_interval = kinesis.MIN_POLL_INTERVAL
+        kinesis.MIN_POLL_INTERVAL = 0.001
+        self.thread.start()
+        return self.source
+
+    def __exit__(self, *exc_info):
+        self.source.stop()
+        self.thread.join(5)
+        kinesis.MIN_POLL_INTERVAL = self.min_poll_interval
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.001)
+    assert(condition())
+
+
+def source(client, connector, **kwargs):
+    kwargs.setdefault('starting_position', 'TRIM_HORIZON')
+    return KinesisSource(client, 'stream', connector, limit=3,
+                         max_poll_interval=0.01, discovery_interval=0.01,
+                         **kwargs)
+
+
+def test_reads_every_shard():
+    client = FakeKinesis()
+    for i in range(5):
+        client.add_shard('shard-{}'.format(i))
+        client.put('shard-{}'.format(i), *[b'%d-%d' % (i, j) for j in range(10)])
+    connector = FakeConnector()
+    with Running(source(client, connector)):
+        wait_for(lambda: len(connector.data()) == 50)
+        client.put('shard-3', b'late')
+        wait_for(lambda: len(connector.data()) == 51)
+    for i in range(5):
+        assert(connector.data('shard-{}'.format(i))[:10] ==
+               [b'%d-%d' % (i, j) for j in range(10)])
+
+
+def test_children_are_read_after_their_parents():
+    client = FakeKinesis()
+    client.add_shard('parent')
+    client.put('parent', *[b'p%d' % i for i in range(10)])
+    connector = FakeConnector()
+    with Running(source(client, connector)):
+        wait_for(lambda: len(connector.data()) == 10)
+        # Split the shard; the children get records before the parent
+        # has been read to the end.
+        client.add_shard('left', parent='parent')
+        client.add_shard('right', parent='parent')
+        client.put('left', b'l0')
+        client.put('right', b'r0')
+        client.put('parent', b'p10')
+        time.sleep(0.05)
+        assert(connector.data() == [b'p%d' % i for i in range(11)])
+        client.close('parent')
+        # Merge the children again.
+        client.add_shard('merged', parent='left', adjacent='right')
+        client.put('merged', b'm0')
+        client.close('left')
+        client.close('right')
+        wait_for(lambda: len(connector.data()) == 14)
+    data = connector.data()
+    assert(data[:11] == [b'p%d' % i for i in range(11)])
+    assert(sorted(data[11:13]) == [b'l0', b'r0'])
+    assert(data[13] == b'm0')
+
+
+def test_resumes_from_checkpoints():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'checkpoints.json')
+        client = FakeKinesis()
+        client.add_shard('a')
+        client.add_shard('b', parent='a')
+        client.put('a', b'a0', b'a1')
+        client.close('a')
+        client.put('b', b'b0')
+        connector = FakeConnector()
+        with Running(source(client, connector, checkpoint_path=path)):
+            wait_for(lambda: len(connector.data()) == 3)
+        checkpoints = ShardCheckpoints(path)
+        assert(checkpoints.is_finished('a'))
+        assert(checkpoints.get('b') == client.records['b'][0]['SequenceNumber'])
+
+        client.put('b', b'b1')
+        connector = FakeConnector()
+        with Running(source(client, connector, checkpoint_path=path)):
+            wait_for(lambda: len(connector.data()) == 1)
+            time.sleep(0.05)
+        assert(connector.data() == [b'b1'])
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_workers_share_the_shards():
+    client = FakeKinesis()
+    for i in range(20):
+        client.add_shard('shard-{}'.format(i))
+        client.put('shard-{}'.format(i), b'%d' % i)
+    connectors = [FakeConnector(), FakeConnector()]
+    sources = [source(client, c, worker=i, workers=2)
+               for i, c in enumerate(connectors)]
+    with Running(sources[0]), Running(sources[1]):
+        wait_for(lambda: sum(len(c.data()) for c in connectors) == 20)
+    assert(0 < len(connectors[0].data()) < 20)
+    assert(sorted(connectors[0].data() + connectors[1].data()) ==
+           sorted(b'%d' % i for i in range(20)))
+
+
+def test_throttling_and_expired_iterators():
+    client = FakeKinesis()
+    client.add_shard('a')
+    client.put('a', b'0', b'1', b'2', b'3')
+    client.errors = ['ProvisionedThroughputExceededException',
+                     'ExpiredIteratorException']
+    connector = FakeConnector()
+    with Running(source(client, connector)):
+        wait_for(lambda: len(connector.data()) == 4)
+    assert(connector.data() == [b'0', b'1', b'2', b'3'])
+
+
+def test_checkpoints_are_taken_before_flushing():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'checkpoints.json')
+        connector = FakeConnector()
+        kinesis_source = source(FakeKinesis(), connector, checkpoint_path=path)
+        checkpoints = kinesis_source.checkpoints
+        checkpoints.update('a', '1')
+        # A reader reads more while the connector is flushing.
+        connector.flushing = lambda: checkpoints.update('a', '2')
+        kinesis_source.checkpoint()
+        assert(ShardCheckpoints(path).get('a') == '1')
+        connector.flushing = None
+        kinesis_source.checkpoint()
+        assert(ShardCheckpoints(path).get('a') == '2')
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_discovery_failures_are_retried():
+    client = FakeKinesis()
+    client.add_shard('a')
+    client.put('a', b'0')
+    list_shards = client.list_shards
+    calls = []
+
+    def failing_list_shards(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise KinesisError('InternalFailure')
+        return list_shards(**kwargs)
+
+    client.list_shards = failing_list_shards
+    connector = FakeConnector()
+    with Running(source(client, connector)) as running:
+        wait_for(lambda: connector.data() == [b'0'])
+        assert(not running._stopping)
@@ -0,0 +1,136 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import wallaroo
+import wallaroo.log
+
+
+class CapturedStderr(object):
+    def __init__(self):
+        self.lines = []
+
+    def __enter__(self):
+        wallaroo.log.drain()
+        self._stderr = sys.stderr
+        sys.stderr = self
+        return self
+
+    def __exit__(self, *exc_info):
+        wallaroo.log.drain()
+        sys.stderr = self._stderr
+
+    def write(self, data):
+        self.lines.extend(data.splitlines())
+
+    def flush(self):
+        pass
+
+
+def reset(level, sample=1):
+    wallaroo.log.configure(level=level, sample=sample, stage_samples={})
+
+
+def test_level():
+    reset('info')
+    log = wallaroo.log.logger("test_level")
+    with CapturedStderr() as err:
+        log.debug("hidden {}", 1)
+        log.info("shown {}", 2)
+        log.error("shown {}", 3)
+    assert(len(err.lines) == 2)
+    assert(err.lines[0].endswith(" INFO test_level: shown 2"))
+    assert(err.lines[1].endswith(" ERROR test_level: shown 3"))
+    assert(log.is_enabled_for(wallaroo.log.INFO))
+    assert(not log.is_enabled_for(wallaroo.log.DEBUG))
+    reset('off')
+    with CapturedStderr() as err:
+        log.error("hidden")
+    assert(err.lines == [])
+
+
+def test_arguments_are_formatted_when_logged():
+    reset('info')
+    log = wallaroo.log.logger("test_formatted")
+    state = [1]
+    with CapturedStderr() as err:
+        log.info("before {}", state)
+        state.append(2)
+        log.info("after {}", state)
+        log.info("bad {0} {1}", 1)
+    assert([l.split(": ", 1)[1] for l in err.lines[:2]] ==
+           ["before [1]", "after [1, 2]"])
+    assert("format failed" in err.lines[2])
+
+
+def test_sampling():
+    reset('debug', sample=3)
+    log = wallaroo.log.logger("test_sampling")
+    with CapturedStderr() as err:
+        for i in range(9):
+            log.debug("debug {}", i)
+        log.warning("not sampled")
+        log.warning("not sampled")
+    assert([l.split(": ", 1)[1] for l in err.lines] ==
+           ["debug 2", "debug 5", "debug 8", "not sampled", "not sampled"])
+
+
+def test_stage_samples_override_logger_sample():
+    reset('debug')
+    log = wallaroo.log.logger("test_stage_samples", sample=2)
+    wallaroo.log.configure(stage_samples={"test_stage_samples": 5})
+    with CapturedStderr() as err:
+        for i in range(10):
+            log.info("info {}", i)
+    assert(len(err.lines) == 2)
+    wallaroo.log.configure(stage_samples={})
+    with CapturedStderr() as err:
+        for i in range(10):
+            log.info("info {}", i)
+    assert(len(err.lines) == 5)
+
+
+def test_full_buffer_drops_oldest():
+    reset('debug')
+    wallaroo.log.configure(buffer_size=2)
+    try:
+        log = wallaroo.log.logger("test_full_buffer")
+        with CapturedStderr() as err:
+            for i in range(5):
+                log.info("info {}", i)
+        assert(err.lines[0].endswith("info 3"))
+        assert(err.lines[1].endswith("info 4"))
+        assert(err.lines[2].endswith("dropped 3 records"))
+    finally:
+        wallaroo.log.configure(
+            buffer_size=wallaroo.log.DEFAULT_BUFFER_SIZE)
+
+
+def test_log_parse_options():
+    assert(wallaroo.log_parse_options(["--other", "x"]) ==
+           (None, None, None))
+    assert(wallaroo.log_parse_options(
+        ["--log-level", "debug", "--log-sample", "100,TraceID=10"]) ==
+        ("debug", 100, {"TraceID": 10}))
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5),
+                    reason="needs sys.is_finalizing")
+def test_records_logged_at_shutdown_are_written():
+    script = "\n".join([
+        "import wallaroo.log",
+        "class Late(object):",
+        "    def __del__(self):",
+        "        wallaroo.log.logger('late').error('collected')",
+        "late = Late()",
+        "late.cycle = late"])
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(wallaroo.__file__))] +
+        [p for p in [env.get("PYTHONPATH")] if p])
+    output = subprocess.check_output([sys.executable, "-c", script],
+                                     env=env, stderr=subprocess.STDOUT,
+                                     timeout=10)
+    assert(output.endswith(b" ERROR late: collected\n"))
@@ -0,0 +1,136 @@
+import pickle
+import struct
+
+import pytest
+
+import wallaroo
+from wallaroo.schema import Schema, SchemaError
+from wallaroo.serialization import Registry
+
+
+Quote = Schema("Quote", [
+    ("fix_type", "B"),
+    ("symbol", "4s"),
+    ("bid", "d"),
+    ("offer", "d")]).record
+
+QUOTE_BYTES = struct.pack(">B4sdd", 2, b"ABCD", 1.5, 2.5)
+
+
+class Tick(object):
+    def __init__(self, symbol, price):
+        self.symbol = symbol
+        self.price = price
+
+
+def test_schema_layout():
+    s = Schema("Padded", [("a", "H"), ("b", "I", 4), ("c", "4s")])
+    assert(s.format == ">H2xI4s")
+    assert(s.size == 12)
+    assert(s.fields == ("a", "b", "c"))
+
+
+def test_unpack_from_returns_record():
+    s = Schema("Quote", [("fix_type", "B"), ("symbol", "4s"),
+                         ("bid", "d"), ("offer", "d")])
+    q = s.unpack_from(memoryview(b"xx" + QUOTE_BYTES), 2)
+    assert(q == (2, b"ABCD", 1.5, 2.5))
+    assert((q.symbol, q.offer) == (b"ABCD", 2.5))
+
+
+def test_records_can_be_pickled():
+    q = Quote(2, b"ABCD", 1.5, 2.5)
+    assert(pickle.loads(pickle.dumps(q)) == q)
+
+
+def test_pack_reads_attributes():
+    s = Schema("Tick", [("symbol", "4s"), ("price", "d")], byte_order="<")
+    assert(s.pack(Tick(b"ABCD", 1.5)) == struct.pack("<4sd", b"ABCD", 1.5))
+    assert(s.pack((b"ABCD", 1.5)) == struct.pack("<4sd", b"ABCD", 1.5))
+    buf = bytearray(14)
+    s.pack_into(buf, 2, Tick(b"ABCD", 1.5))
+    assert(bytes(buf[2:]) == struct.pack("<4sd", b"ABCD", 1.5))
+
+
+def test_custom_record():
+    s = Schema("Tick", [("symbol", "4s"), ("price", "d")], record=Tick)
+    t = s.unpack_from(struct.pack(">4sd", b"ABCD", 1.5))
+    assert(isinstance(t, Tick))
+    assert((t.symbol, t.price) == (b"ABCD", 1.5))
+
+
+def test_invalid_fields():
+    with pytest.raises(SchemaError):
+        Schema("Bad", [("a", "q")], byte_order="@")
+    with pytest.raises(SchemaError):
+        Schema("Bad", [("a", "ii")])
+    with pytest.raises(SchemaError):
+        Schema("Bad", [("a", "I"), ("b", "I", 2)])
+    with pytest.raises(SchemaError):
+        Schema("Bad", [("a", "Z")])
+
+
+quote_schema = Schema("QuoteMessage", [
+    ("fix_type", "B"),
+    ("symbol", "4s"),
+    ("bid", "d"),
+    ("offer", "d")])
+
+
+@quote_schema.decoder()
+def quote_decoder(quote):
+    if quote.fix_type != 2:
+        return None
+    return quote.symbol, (quote.bid + quote.offer) / 2
+
+
+@quote_schema.encoder()
+def quote_encoder(data):
+    symbol, mid = data
+    return (2, symbol, mid, mid)
+
+
+def test_schema_decoder():
+    assert(quote_decoder.header_length() == 4)
+    assert(quote_decoder.zero_copy() is True)
+    assert(quote_decoder.payload_length(struct.pack(">I", 21)) == 21)
+    assert(quote_decoder.decode(memoryview(QUOTE_BYTES)) == (b"ABCD", 2.0))
+    assert(quote_decoder.decode(struct.pack(">B4sdd", 1, b"ABCD", 1, 1))
+           is None)
+
+
+def test_schema_encoder():
+    expected = struct.pack(">B4sdd", 2, b"ABCD", 2.0, 2.0)
+    assert(quote_encoder.encode((b"ABCD", 2.0)) ==
+           struct.pack(">I", len(expected)) + expected)
+
+
+def test_schema_decoder_and_encoder_serialization():
+    decoder = pickle.loads(pickle.dumps(quote_decoder))
+    assert(decoder.decode(QUOTE_BYTES) == (b"ABCD", 2.0))
+    encoder = pickle.loads(pickle.dumps(quote_encoder))
+    assert(encoder.encode((b"ABCD", 2.0))[4:] ==
+           struct.pack(">B4sdd", 2, b"ABCD", 2.0, 2.0))
+
+
+def test_unframed_encoder():
+    s = Schema("Pair", [("a", "H"), ("b", "H")])
+
+    @s.encoder(length_fmt=None)
+    def pair_encoder(data):
+        return data
+
+    assert(pair_encoder.encode((1, 2)) == struct.pack(">HH", 1, 2))
+
+
+def test_schema_codec():
+    r = Registry()
+    r.register(Quote, Schema("Quote", [
+        ("fix_type", "B"),
+        ("symbol", "4s"),
+        ("bid", "d"),
+        ("offer", "d")], record=Quote).codec())
+    q = Quote(2, b"ABCD", 1.5, 2.5)
+    data = r.serialize(q)
+    assert(len(data) == 2 + 21)
+    assert(r.deserialize(data) == q)
@@ -0,0 +1,111 @@
+import pickle
+import sys
+
+import pytest
+
+import wallaroo
+from wallaroo.serialization import (MarshalCodec, PickleCodec, Registry,
+                                    SerializationError, StructCodec)
+
+
+class Point(object):
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+class Tick(object):
+    __slots__ = ('symbol', 'price')
+
+    def __init__(self, symbol, price):
+        self.symbol = symbol
+        self.price = price
+
+
+def test_unregistered_types_are_pickled():
+    r = Registry()
+    data = r.serialize({'a': [1, 2]})
+    assert(data == pickle.dumps({'a': [1, 2]}, pickle.HIGHEST_PROTOCOL))
+    assert(r.deserialize(data) == {'a': [1, 2]})
+
+
+def test_legacy_pickles_can_be_read():
+    r = Registry()
+    r.register(Point, MarshalCodec(['x', 'y']))
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        assert(r.deserialize(pickle.dumps((1, 'a'), protocol)) == (1, 'a'))
+
+
+def test_struct_codec():
+    r = Registry()
+    tag = r.register(Tick, StructCodec('>4sd', ['symbol', 'price']))
+    data = r.serialize(Tick(b'ABCD', 1.5))
+    assert(tag == 0)
+    # marker, one byte tag and the struct payload
+    assert(len(data) == 2 + 12)
+    t = r.deserialize(data)
+    assert(isinstance(t, Tick))
+    assert((t.symbol, t.price) == (b'ABCD', 1.5))
+
+
+def test_struct_codec_factory():
+    r = Registry()
+    r.register(Point, StructCodec('<ii', ['x', 'y'], factory=Point))
+    p = r.deserialize(r.serialize(Point(3, -4)))
+    assert((p.x, p.y) == (3, -4))
+
+
+def test_struct_codec_rejects_mismatched_fields():
+    with pytest.raises(SerializationError):
+        StructCodec('<ii', ['x'])
+
+
+def test_marshal_codec():
+    r = Registry()
+    r.register(Point, MarshalCodec(['x', 'y']))
+    data = r.serialize(Point({'k': [1, 2.5]}, None))
+    p = r.deserialize(data)
+    assert((p.x, p.y) == ({'k': [1, 2.5]}, None))
+    assert(b'Point' not in data)
+
+
+def test_pickle_codec():
+    r = Registry()
+    r.register(Point, PickleCodec())
+    p = r.deserialize(r.serialize(Point(1, bytearray(b'xyz'))))
+    assert((p.x, p.y) == (1, bytearray(b'xyz')))
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8),
+                    reason="pickle protocol 5 needs Python 3.8")
+def test_pickle_codec_out_of_band():
+    r = Registry()
+    r.register(Point, PickleCodec(protocol=5))
+    payload = pickle.PickleBuffer(bytearray(b'x' * 1000))
+    p = r.deserialize(r.serialize(Point(1, payload)))
+    assert(p.x == 1)
+    assert(bytes(p.y) == b'x' * 1000)
+
+
+def test_explicit_and_large_tags():
+    r = Registry()
+    assert(r.register(Point, MarshalCodec(['x', 'y']), tag=300) == 300)
+    assert(r.register(Tick, MarshalCodec(['symbol', 'price'])) == 0)
+    p = r.deserialize(r.serialize(Point(1, 2)))
+    assert((p.x, p.y) == (1, 2))
+    with pytest.raises(SerializationError):
+        r.register(dict, MarshalCodec([]), tag=300)
+    with pytest.raises(SerializationError):
+        r.register(Point, MarshalCodec(['x', 'y']))
+
+
+def test_unknown_tag():
+    r = Registry()
+    r.register(Point, MarshalCodec(['x', 'y']))
+    data = r.serialize(Point(1, 2))
+    with pytest.raises(SerializationError):
+        Registry().deserialize(data)
+
+
+def test_default_serialize_uses_registry():
+    assert(wallaroo.deserialize(wallaroo.serialize([1, 'two'])) == [1, 'two'])
@@ -0,0 +1,59 @@
+import os
+import threading
+import time
+
+from wallaroo.experimental.supervisor import ConnectorSupervisor, split
+
+
+def test_split():
+    assert(split(range(7), 3) == [[0, 3, 6], [1, 4], [2, 5]])
+    assert(split(["a", "b"], 4) == [["a"], ["b"]])
+    assert(split([1], 0) == [[1]])
+
+
+def count_and_exit(items, stats):
+    stats.add(len(items), sum(items))
+
+
+def count_forever(items, stats):
+    stats.add(1, os.getpid())
+    while True:
+        time.sleep(1)
+
+
+def run_until(supervisor, done, timeout=10):
+    def watch():
+        deadline = time.time() + timeout
+        while not done(supervisor.stats()) and time.time() < deadline:
+            time.sleep(0.01)
+        supervisor.stop()
+    watcher = threading.Thread(target=watch)
+    watcher.start()
+    supervisor.run(poll_interval=0.01)
+    watcher.join()
+
+
+def test_workers_are_restarted():
+    supervisor = ConnectorSupervisor(count_and_exit, [1, 2, 3, 4, 5],
+                                     processes=2, restart_delay=0.01,
+                                     max_restart_delay=0.02)
+    run_until(supervisor, lambda stats: all(m >= 6 for m, _ in stats))
+    # Worker 0 has [1, 3, 5] and worker 1 has [2, 4], both with an
+    # average of 3, and each has run at least twice.
+    for messages, size in supervisor.stats():
+        assert(messages >= 6)
+        assert(size >= 3 * (messages - 3))
+
+
+def test_workers_are_stopped():
+    supervisor = ConnectorSupervisor(count_forever, processes=3)
+    assert(len(supervisor) == 3)
+    run_until(supervisor, lambda stats: all(m == 1 for m, _ in stats))
+    for messages, pid in supervisor.stats():
+        assert(messages == 1)
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            pass
+        else:
+            assert(False)
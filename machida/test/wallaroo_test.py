@@ -1,5 +1,12 @@
+import os
 import pickle
 import struct
+import subprocess
+import sys
+import time
+
+import pytest
+
 import wallaroo
 
 
@@ -116,6 +123,328 @@ def test_my_state_computation_multi_serialization():
            (["hello", "world"], 1))
 
 
+#
+# Test vectorized computation
+#
+
+
+@wallaroo.computation(name="My Vectorized Computation", vectorized=True)
+def my_vectorized_computation(data):
+    return data * 2
+
+
+@wallaroo.computation(name="My Vectorized Computation 2", vectorized=True)
+def my_vectorized_computation2(data):
+    return data + 1
+
+
+def test_my_vectorized_computation():
+    assert(my_vectorized_computation.name() == "My Vectorized Computation")
+    assert(my_vectorized_computation.compute(3) == 6)
+    assert(isinstance(my_vectorized_computation,
+                      wallaroo.ComputationVectorized))
+    assert(not my_computation._is_vectorized)
+
+
+def test_my_vectorized_computation_serialization():
+    deserialized = pickle.loads(pickle.dumps(my_vectorized_computation))
+    assert(deserialized.compute(3) == 6)
+
+
+def _vectorized_pipeline_stages(*computations, **kwargs):
+    pipeline = wallaroo.source("Source", wallaroo.TCPSourceConfig(
+        "localhost", "7000", my_decoder))
+    for c in computations:
+        pipeline = pipeline.to(c)
+    pipeline = pipeline.key_by(my_partition).to_sink(
+        wallaroo.TCPSinkConfig("localhost", "7001", my_encoder))
+    (_, _, vs, _) = wallaroo.build_application("App", pipeline, **kwargs)
+    return vs[0][1:]
+
+
+def test_vectorized_output_is_split_at_boundaries():
+    stages = _vectorized_pipeline_stages(
+        my_vectorized_computation, my_vectorized_computation2,
+        my_computation, my_vectorized_computation)
+    assert(stages[0] == ("to", my_vectorized_computation))
+    assert(isinstance(stages[1][1], wallaroo._VectorizedSplit))
+    assert(stages[2] == ("to", my_computation))
+    assert(isinstance(stages[3][1], wallaroo._VectorizedSplit))
+    assert(stages[4][0] == "key_by")
+
+    stages = _vectorized_pipeline_stages(
+        my_vectorized_computation, my_vectorized_computation2,
+        my_computation, my_vectorized_computation, fuse=True)
+    # The four stateless stages are also fused into one
+    computations = stages[0][1]._computations
+    assert(computations[0] is my_vectorized_computation)
+    assert(isinstance(computations[1], wallaroo._VectorizedSplit))
+    assert(computations[2] is my_computation)
+    assert(isinstance(computations[3], wallaroo._VectorizedSplit))
+    assert(stages[1][0] == "key_by")
+
+
+def test_vectorized_split_serialization():
+    split = _vectorized_pipeline_stages(my_vectorized_computation)[0][1]
+    deserialized = pickle.loads(pickle.dumps(split))
+    assert(deserialized.name() == "My Vectorized Computation")
+    assert(deserialized.compute_multi(3) == [6])
+
+
+def test_vectorized_split_numpy_arrays():
+    numpy = pytest.importorskip("numpy")
+    split = _vectorized_pipeline_stages(my_vectorized_computation)[0][1]
+    assert(split.compute_multi(numpy.array([1.5, 2.0])) == [3.0, 4.0])
+    records = numpy.array([(1, 2.5), (2, 3.5)],
+                          dtype=[("id", "i4"), ("value", "f8")])
+    out = wallaroo._split_records(records)
+    assert(len(out) == 2)
+    assert((out[1].id, out[1]["value"]) == (2, 3.5))
+    assert(wallaroo._split_records(numpy.float64(1.5)) == [1.5])
+    assert(wallaroo._split_records(None) == [])
+
+
+#
+# Test batch computations
+#
+
+
+@wallaroo.computation_batch(name="Double Batch", batch_size=2)
+def double_batch(data):
+    return [d * 2 if d != 0 else None for d in data]
+
+
+@wallaroo.computation_batch(name="Add One Batch")
+def add_one_batch(data):
+    return [d + 1 for d in data]
+
+
+class Total(object):
+    def __init__(self):
+        self.total = 0
+
+
+@wallaroo.state_computation_batch(name="Running Total", state=Total)
+def running_total(data, state):
+    state.total += sum(data)
+    return ([state.total], True)
+
+
+def test_batch_computation():
+    assert(double_batch.name() == "Double Batch")
+    assert(double_batch.compute_batch([1, 0, 2]) == [2, None, 4])
+    assert(isinstance(double_batch, wallaroo.ComputationBatch))
+    assert(isinstance(running_total, wallaroo.StateComputationBatch))
+    state = running_total.initial_state()
+    assert(running_total.compute_batch([1, 2], state) == ([3], True))
+
+
+def test_batch_computation_serialization():
+    assert(pickle.loads(pickle.dumps(double_batch)) is double_batch)
+    assert(pickle.loads(pickle.dumps(running_total)) is running_total)
+
+
+def test_batch_size_validation():
+    for bad in (0, -1, 1.5, True, None):
+        with pytest.raises(wallaroo.WallarooParameterError):
+            wallaroo.computation_batch("Bad", batch_size=bad)(
+                lambda data: data)
+    assert(add_one_batch._batch_size == wallaroo.DEFAULT_BATCH_SIZE)
+
+
+def test_batches_are_passed_whole_and_split_at_boundaries():
+    stages = _pipeline_stages(double_batch, add_one_batch, add_one,
+                              add_one_batch, fuse=False)
+    assert([s[1]._computation for s in stages[:2]] ==
+           [double_batch, add_one_batch])
+    # A batch only goes on as one message to another batch computation
+    assert(stages[0][1].compute_multi([1, 0, 2, 3]) == [[2, 4, 6]])
+    assert(stages[1][1].compute_multi([2, 4]) == [3, 5])
+    assert(stages[2] == ("to", add_one))
+    assert(stages[3][1].compute_multi(1) == [2])
+    assert(stages[0][1].compute_multi([0]) == [])
+
+
+def test_batch_computation_calls_are_capped_at_batch_size():
+    calls = []
+
+    @wallaroo.computation_batch(name="Record Batches", batch_size=2)
+    def record_batches(data):
+        calls.append(list(data))
+        return data
+
+    stage = _pipeline_stages(record_batches)[0][1]
+    assert(stage.compute_multi([1, 2, 3, 4, 5]) == [1, 2, 3, 4, 5])
+    assert(calls == [[1, 2], [3, 4], [5]])
+
+
+@wallaroo.key_extractor
+def parity(data):
+    return data % 2
+
+
+def test_state_batches_are_grouped_by_key():
+    stages = _pipeline_stages(add_one_batch, parity, running_total,
+                              add_one_batch)
+    # The batch computation in front of the key_by is fused with the
+    # grouping stage
+    assert(len(stages) == 4)
+    groups = stages[0][1].compute_multi([1, 2, 4, 3])
+    assert(groups == [[2, 4], [3, 5]])
+    assert(stages[1][0] == "key_by")
+    assert(stages[1][1].extract_key(groups[1]) ==
+           parity.extract_key(1))
+    assert(stages[2][0] == "to_state")
+    state = stages[2][1].initial_state()
+    assert(stages[2][1].compute_multi([1, 2], state) == ([[3]], True))
+    assert(stages[2][1].compute_multi([4], state) == ([[7]], True))
+    assert(stages[3][1].compute_multi([7]) == [8])
+    deserialized = pickle.loads(pickle.dumps(stages[1][1]))
+    assert(deserialized.extract_key([3]) == parity.extract_key(1))
+    deserialized = pickle.loads(pickle.dumps(stages[2][1]))
+    assert(deserialized.name() == "Running Total")
+    assert(deserialized.compute_multi([1], Total()) == ([[1]], True))
+
+
+#
+# Test stateless stage fusion
+#
+
+
+@wallaroo.computation(name="Add One")
+def add_one(data):
+    return data + 1
+
+
+@wallaroo.computation(name="Drop Odd")
+def drop_odd(data):
+    if data % 2:
+        return None
+    return data
+
+
+@wallaroo.computation_multi(name="Count To")
+def count_to(data):
+    return list(range(data)) + [None]
+
+
+def _pipeline_stages(*stages, **kwargs):
+    pipeline = wallaroo.source("Source", wallaroo.TCPSourceConfig(
+        "localhost", "7000", my_decoder))
+    for stage in stages:
+        if isinstance(stage, wallaroo.KeyExtractor):
+            pipeline = pipeline.key_by(stage)
+        else:
+            pipeline = pipeline.to(stage)
+    pipeline = pipeline.to_sink(
+        wallaroo.TCPSinkConfig("localhost", "7001", my_encoder))
+    (_, _, vs, _) = wallaroo.build_application(
+        "App", pipeline, fuse=kwargs.get("fuse", True))
+    return vs[0][1:-1]
+
+
+def test_fusion_is_off_by_default():
+    stages = _pipeline_stages(add_one, drop_odd, add_one, fuse=False)
+    assert(stages == [("to", add_one), ("to", drop_odd), ("to", add_one)])
+
+
+def test_fused_computations():
+    stages = _pipeline_stages(add_one, drop_odd, add_one)
+    assert(len(stages) == 1)
+    fused = stages[0][1]
+    assert(isinstance(fused, wallaroo._FusedComputation))
+    assert(fused.name() == "Add One -> Drop Odd -> Add One")
+    assert(fused.compute(1) == 3)
+    assert(fused.compute(2) is None)
+
+
+def test_fused_computations_serialization():
+    fused = _pipeline_stages(add_one, drop_odd, add_one)[0][1]
+    deserialized = pickle.loads(pickle.dumps(fused))
+    assert(deserialized.name() == "Add One -> Drop Odd -> Add One")
+    assert(deserialized.compute(1) == 3)
+
+
+def test_fused_multi_computations():
+    fused = _pipeline_stages(add_one, count_to, drop_odd, add_one)[0][1]
+    assert(isinstance(fused, wallaroo._FusedComputationMulti))
+    assert(fused.compute_multi(6) == [1, 3, 5, 7])
+    assert(fused.compute_multi(-1) == [])
+    deserialized = pickle.loads(pickle.dumps(fused))
+    assert(deserialized.compute_multi(4) == [1, 3, 5])
+
+
+def test_fusion_stops_at_state_and_key_by():
+    stages = _pipeline_stages(add_one, my_state_computation, add_one,
+                              my_partition, add_one, drop_odd)
+    assert(stages[0] == ("to", add_one))
+    assert(stages[1] == ("to_state", my_state_computation))
+    assert(stages[2] == ("to", add_one))
+    assert(stages[3] == ("key_by", my_partition))
+    assert(isinstance(stages[4][1], wallaroo._FusedComputation))
+
+
+#
+# Test pipeline building
+#
+
+
+def _source(name):
+    return wallaroo.source(name, wallaroo.TCPSourceConfig(
+        "localhost", "7000", my_decoder))
+
+
+def _sink():
+    return wallaroo.TCPSinkConfig("localhost", "7001", my_encoder)
+
+
+def _stage_names(vs):
+    return [[stage[1] if stage[0] == "source" else stage[0]
+             for stage in v] for v in vs]
+
+
+def test_pipelines_share_stages():
+    base = _source("Source").to(my_state_computation)
+    left = base.key_by(my_partition)
+    right = base.to(my_state_computation)
+    (_, _, vs, _) = wallaroo.build_application("App", left.to_sink(_sink()))
+    assert(_stage_names(vs) == [["Source", "to_state", "key_by", "to_sink"]])
+    (_, _, vs, _) = wallaroo.build_application("App", right.to_sink(_sink()))
+    assert(_stage_names(vs) ==
+           [["Source", "to_state", "to_state", "to_sink"]])
+    assert(not base.__is_closed__())
+
+
+def test_merged_pipeline_layout():
+    a = _source("A").key_by(my_partition)
+    b = _source("B")
+    c = _source("C")
+    p = c.merge(a.merge(b).to(my_state_computation)).to(my_state_computation)
+    (_, root, vs, es) = wallaroo.build_application("App", p.to_sink(_sink()))
+    assert(root == 1)
+    assert(_stage_names(vs) == [["C"], ["to_state", "to_sink"], ["A", "key_by"],
+                                ["to_state"], ["B"]])
+    assert(es == [[], [0, 3], [], [2, 4], []])
+
+
+def test_no_stages_after_sink():
+    p = _source("Source").to_sink(_sink())
+    with pytest.raises(wallaroo.WallarooParameterError):
+        p.to(my_state_computation)
+
+
+def test_deep_pipelines():
+    p = _source("Source")
+    for _ in range(5000):
+        p = p.to(my_state_computation)
+    for _ in range(2000):
+        p = p.merge(_source("Other"))
+    (_, root, vs, es) = wallaroo.build_application("App", p.to_sink(_sink()))
+    assert(len(vs[0]) == 5001)
+    assert(len(vs) == 4001)
+    assert(es[root] == [root - 2, root + 1])
+
+
 #
 # Test state
 #
@@ -176,6 +505,62 @@ def test_MyState_serialization():
     assert(deserialized2.y == 2)
 
 
+#
+# Test arity validation and wrapper classes
+#
+
+
+class Callable(object):
+    def __call__(self, data):
+        return data
+
+    def method(self, data, extra=None):
+        return data
+
+
+def test_arity_validation():
+    wallaroo.computation("Callable")(Callable())
+    wallaroo.computation("Method")(Callable().method)
+    wallaroo.computation("Varargs")(lambda *args: args)
+    wallaroo.computation("Default")(lambda data, extra=1: data)
+    wallaroo.state_computation("Default", state=list)(
+        lambda data, state=None: data)
+    for bad in (lambda: None, lambda a, b: None, Callable.method):
+        with pytest.raises(wallaroo.WallarooParameterError):
+            wallaroo.computation("Bad")(bad)
+    with pytest.raises(wallaroo.WallarooParameterError):
+        wallaroo.computation("Not callable")(1)
+
+
+def test_wrappers_with_the_same_function_name_are_kept_apart():
+    inc = wallaroo.computation("inc")(lambda data: data + 1)
+    mul = wallaroo.computation("mul")(lambda data: data * 10)
+    first = wallaroo.state_computation("twice", state=list)(
+        lambda data, state: (1, True))
+    second = wallaroo.state_computation("twice", state=list)(
+        lambda data, state: (2, True))
+    for wrapper, value in ((inc, 4), (mul, 30)):
+        assert(pickle.loads(pickle.dumps(wrapper)).compute(3) == value)
+    for wrapper, value in ((first, 1), (second, 2)):
+        assert(pickle.loads(pickle.dumps(wrapper)).compute(3, []) ==
+               (value, True))
+
+    def make(n):
+        @wallaroo.computation("add")
+        def add(data):
+            return data + n
+        return add
+    adders = [make(n) for n in range(3)]
+    assert([pickle.loads(pickle.dumps(a)).compute(1) for a in adders] ==
+           [1, 2, 3])
+
+
+def test_wrapper_classes_are_shared():
+    assert(type(my_computation) is type(my_computation2))
+    assert(type(my_computation) is not type(my_state_computation))
+    assert(pickle.loads(pickle.dumps(my_computation)) is my_computation)
+
+
 #
 # Test partition serialization
 #
@@ -197,6 +582,91 @@ def test_my_partition_serialization():
     assert(deserialized.extract_key('abcde') == 'a')
 
 
+@wallaroo.key_extractor
+def my_identity_partition(data):
+    return data
+
+
+def test_string_and_bytes_keys_are_unchanged():
+    assert(my_identity_partition.extract_key('abc') == 'abc')
+    assert(my_identity_partition.extract_key(b'abc') == b'abc')
+
+
+def test_int_keys():
+    keys = [my_identity_partition.extract_key(n)
+            for n in (0, 1, 97, 255, 0x110000, -1, 2 ** 63 - 1, -2 ** 63,
+                      2 ** 70)]
+    assert(all(isinstance(k, bytes) for k in keys))
+    assert(len(set(keys)) == len(keys))
+    assert(my_identity_partition.extract_key(97) != 'a')
+    assert(my_identity_partition.extract_key(97) ==
+           my_identity_partition.extract_key(97))
+    assert(my_identity_partition.extract_key(2 ** 70) ==
+           my_identity_partition.extract_key(2 ** 70))
+
+
+def test_bytes_keys_do_not_collide_with_tagged_keys():
+    key = my_identity_partition.extract_key
+    for other in (97, -1, 2 ** 70, (1, 'a'), ()):
+        encoded = key(other)
+        assert(key(encoded) != encoded)
+    assert(key(b'\xfcab') != key(b'ab'))
+    assert(key(b'\xfcab') != key(key(b'\xfcab')))
+    assert(key(b'\xfbab') == b'\xfbab')
+    assert(key(b'') == b'')
+
+
+def test_int_keys_are_cached():
+    first = my_identity_partition.extract_key(12345)
+    assert(my_identity_partition.extract_key(12345) is first)
+
+
+def test_tuple_keys():
+    key = my_identity_partition.extract_key
+    assert(isinstance(key((1, 'a')), bytes))
+    assert(key((1, 'a')) == key((1, u'a')))
+    assert(key((1, 'a')) != key(('a', 1)))
+    assert(key(('ab', 'c')) != key(('a', 'bc')))
+    assert(key((1, (2, 3))) != key((1, 2, 3)))
+    assert(key(()) != key(''))
+
+
+def test_unsupported_keys():
+    for bad in (1.5, None, [1]):
+        try:
+            my_identity_partition.extract_key(bad)
+        except TypeError:
+            pass
+        else:
+            assert(False)
+
+
+@wallaroo.key_extractor(memo_size=2)
+def my_memo_partition(data):
+    return data[0]
+
+
+def test_key_extractor_memo():
+    assert(my_partition.memo_stats() is None)
+    memo = my_memo_partition._memo
+    memo.hits = memo.misses = 0
+    keys = [my_memo_partition.extract_key(d)
+            for d in ('ab', 'ac', 'b', (1, 2), 'ad', 'c', 'ae')]
+    assert(keys == ['a', 'a', 'b', my_partition.extract_key((1,)), 'a',
+                    'c', 'a'])
+    # 'a' is found in the previous generation twice
+    assert(my_memo_partition.memo_stats() == (3, 4))
+    assert(len(memo._current) + len(memo._previous) <= 4)
+    deserialized = pickle.loads(pickle.dumps(my_memo_partition))
+    assert(deserialized.extract_key('abcde') == 'a')
+
+
+def test_invalid_memo_size():
+    for bad in (-1, 1.5, "10", True):
+        with pytest.raises(wallaroo.WallarooParameterError):
+            wallaroo.key_extractor(memo_size=bad)(lambda data: data)
+
+
 #
 # Test decoder
 #
@@ -221,6 +691,29 @@ def test_my_decoder_serialization():
     assert(deserialized.decode('hello') == "decoded: 'hello'")
 
 
+@wallaroo.decoder(header_length=4, length_fmt='>I', zero_copy=True)
+def my_zero_copy_decoder(data):
+    return struct.unpack_from('>H', data)[0]
+
+
+def test_my_decoder_not_zero_copy():
+    assert(my_decoder.zero_copy() is False)
+
+
+def test_my_zero_copy_decoder():
+    assert(my_zero_copy_decoder.zero_copy() is True)
+    assert(my_zero_copy_decoder.payload_length(
+        memoryview(struct.pack('>I', 10))) == 10)
+    assert(my_zero_copy_decoder.decode(
+        memoryview(struct.pack('>HH', 7, 8))) == 7)
+
+
+def test_my_zero_copy_decoder_serialization():
+    serialized = pickle.dumps(my_zero_copy_decoder)
+    deserialized = pickle.loads(serialized)
+    assert(deserialized.zero_copy() is True)
+
+
 #
 # Test encoder
 #
@@ -239,3 +732,120 @@ def test_my_encoder_serialization():
     serialized = pickle.dumps(my_encoder)
     deserialized = pickle.loads(serialized)
     assert(deserialized.encode('hello') == "encoded: 'hello'")
+
+
+#
+# Test buffered output
+#
+
+
+class RecordingStream(object):
+    def __init__(self):
+        self.buffered = []
+        self.flushed = []
+
+    def write(self, data):
+        self.buffered.append(data)
+
+    def flush(self):
+        self.flushed.extend(self.buffered)
+        self.buffered = []
+
+    def isatty(self):
+        return False
+
+
+def test_log_writer_buffers_until_flush():
+    stream = RecordingStream()
+    writer = wallaroo.LogWriter(stream, max_latency=60, max_size=1024)
+    writer.write('a\n')
+    writer.writelines(['b\n', 'c\n'])
+    assert(stream.flushed == [])
+    writer.flush_due()
+    assert(stream.flushed == [])
+    writer.flush()
+    assert(stream.flushed == ['a\n', 'b\n', 'c\n'])
+    assert(writer.isatty() is False)
+
+
+def test_log_writer_flushes_when_full():
+    stream = RecordingStream()
+    writer = wallaroo.LogWriter(stream, max_latency=60, max_size=4)
+    writer.write('ab')
+    assert(stream.flushed == [])
+    writer.write('cd')
+    assert(stream.flushed == ['ab', 'cd'])
+
+
+def test_log_writer_flushes_when_due():
+    stream = RecordingStream()
+    writer = wallaroo.LogWriter(stream, max_latency=0, max_size=1024)
+    writer.write('a')
+    assert(stream.flushed == ['a'])
+    writer = wallaroo.LogWriter(stream, max_latency=0.01, max_size=1024)
+    writer.write('b')
+    time.sleep(0.5)
+    assert(stream.flushed == ['a', 'b'])
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5),
+                    reason="needs sys.is_finalizing")
+def test_log_writer_writes_at_shutdown():
+    # Objects collected at shutdown can still write to a LogWriter they
+    # kept, as logging handlers do, after threads can no longer be started.
+    script = "\n".join([
+        "import sys",
+        "import threading",
+        "import wallaroo",
+        "class Late(object):",
+        "    out = sys.stdout",
+        "    def __del__(self):",
+        "        self.out.write('late\\n')",
+        "late = Late()",
+        "late.cycle = late"])
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(wallaroo.__file__))] +
+        [p for p in [env.get("PYTHONPATH")] if p])
+    output = subprocess.check_output([sys.executable, "-c", script],
+                                     env=env, stderr=subprocess.STDOUT,
+                                     timeout=10)
+    assert(output == b"late\n")
+
+
+#
+# Test lazy submodule imports
+#
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason="needs module __getattr__")
+def test_submodules_are_imported_on_first_access():
+    script = "\n".join([
+        "import sys",
+        "import wallaroo",
+        "assert 'wallaroo.experimental' not in sys.modules",
+        "assert 'argparse' not in sys.modules",
+        "assert wallaroo.experimental.SourceConnectorConfig",
+        "assert 'wallaroo.experimental' in sys.modules"])
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(wallaroo.__file__))] +
+        [p for p in [env.get("PYTHONPATH")] if p])
+    subprocess.check_call([sys.executable, "-c", script], env=env)
+
+
+@pytest.mark.skipif(sys.version_info >= (3, 7),
+                    reason="submodules are imported on first access")
+def test_submodules_imported_up_front():
+    script = "\n".join([
+        "import sys",
+        "import wallaroo",
+        "assert 'wallaroo.experimental' in sys.modules",
+        "assert 'wallaroo.serialization' in sys.modules",
+        "assert 'wallaroo.schema' not in sys.modules"])
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(wallaroo.__file__))] +
+        [p for p in [env.get("PYTHONPATH")] if p])
+    subprocess.check_call([sys.executable, "-c", script], env=env)
@@ -33,6 +33,9 @@ def application_setup(args):
     parser.add_argument("--partitions", type=int, default=40,
                     help="Number of partitions for use with internal source")
     pargs, _ = parser.parse_known_args(args)
+    # Tracing is off unless enabled with --log-level debug, and can be
+    # sampled with --log-sample
+    wallaroo.log.configure(*wallaroo.log_parse_options(args))
 
     if pargs.gen_source:
         print("Using internal source generator")
@@ -174,17 +177,21 @@ class WindowState(object):
         return self._window.clone()
 
 
+trace_id_log = wallaroo.log.logger("TraceID")
+trace_window_log = wallaroo.log.logger("TraceWindow")
+
+
 @wallaroo.computation(name="TraceID")
 def trace_id(msg):
-    print("trace_id({})".format(msg))
+    trace_id_log.debug("trace_id({})", msg)
     return Message(msg.key + ".TraceID", msg.value())
 
 
 @wallaroo.state_computation(name="TraceWindow", state=WindowState)
 def trace_window(msg, state):
-    print("trace_window({}, {})".format(msg, state))
+    trace_window_log.debug("trace_window({}, {})", msg, state)
     state.push(msg)
-    print("trace_window.updated: {}".format(state))
+    trace_window_log.debug("trace_window.updated: {}", state)
     return Message(msg.key + ".TraceWindow", state.window())
 
 
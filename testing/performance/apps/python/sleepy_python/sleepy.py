@@ -28,7 +28,7 @@ def application_setup(args):
     ok_sink = wallaroo.TCPSinkConfig(out_host, out_port, ok_encoder)
 
     inputs = wallaroo.source("Counting Sheep", nonce_source)
-    pipeline = (inputs.
+    pipeline = (inputs
         .to(process_nonce)
         .key_by(extract_key)
         .to(busy_sleep)
@@ -64,13 +64,6 @@ def process_nonce(nonce):
     return nonce
 
 
-@wallaroo.state_computation(name="Count sheep", state=DreamData)
-def busy_sleep(data, state):
-    delay(delay_ms)
-    state.sheep += 1
-    return None
-
-
 class DreamData(object):
     __slots__ = ('sheep')
 
@@ -78,12 +71,18 @@ class DreamData(object):
         self.sheep = 0
 
 
-partitions = [str(x) for x in range(0, 60)]
+@wallaroo.state_computation(name="Count sheep", state=DreamData)
+def busy_sleep(data, state):
+    delay(delay_ms)
+    state.sheep += 1
+    return None
+
+
+PARTITION_COUNT = 60
 
 @wallaroo.key_extractor
-    def extract_key(tuple):
-        global partitions
-        return str(partitions[tuple[0] % len(partitions)])
+def extract_key(tuple):
+    return tuple[0] % PARTITION_COUNT
 
 # Set by --delay_ms argument
 delay_ms = 0